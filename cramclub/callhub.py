@@ -2,13 +2,24 @@
 Wrapper for CallHub operations.
 """
 import re
-import json
-from requests import get, post, put, delete, exceptions
+import copy
+from functools import partial
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests import exceptions
 from singleton.singleton import Singleton
 
 from cramlog import CramLog
 from cramcfg import CramCfg
-from cramconst import CUSTOM_FIELDS, CUSTOM_FIELD_CONTACTID
+from cramhttp import make_session
+from crammetrics import CramMetrics
+from cramrate import RequestScheduler
+from cramstream import load_listing
+from cramjson import loads, dumps
+from cramdiff import phonebook_diff, contact_digest
+from cramfields import contact_id
+from cramconst import CUSTOM_FIELDS, CUSTOM_FIELD_CONTACTID, CALLHUB_CONCURRENCY, \
+    CALLHUB_RATE_LIMIT, CALLHUB_ATTEMPTS, CALLHUB_BACKOFF
 # unused CUSTOM_FIELD_FEDERAL, CUSTOM_FIELD_STATE
 
 
@@ -29,145 +40,110 @@ def sanitise_crm_contact(rocket_url, crm_contact):
     )
 
 
-def mark_duplicates(crm_contacts, ch_contacts, logger):
-    """Ensure crm_contacts have unique contact numbers."""
-
-    def standardise(country_code, region_code, phone_number):
-        """
-        I tried so hard to avoid having to write this.
-        Alas, inadequacies in the CallHub API forced it upon me.
-        This an approximation of the full algorithm they use internally
-        when creating a new contact.
-        """
-        phn = phone_number.replace(' ', '')
-        if len(phn) == 12 and phn[0:3] == (country_code + '0'): # 610?????????
-            phn = country_code + phn[3:]
-        if (len(phn) == 11 and phn[0:3] == (country_code + region_code)) or (
-                len(phn) == 11 and phn[0:3] == (country_code + '4')):
-            return phn  # 612???????? landline or 614????????  mobile number
-        if phn[0:1] == '0':
-            phn = phn[1:]
-        if len(phn) == 9 and phn[0:1] == '4': # 4????????  mobile number
-            return country_code + phn
-        if len(phn) == 9 and phn[0:1] == region_code:
-            phn = phn[1:]  # 2???????? landline
-        if len(phn) == 10 and phn[0:2] == country_code:
-            phn = phn[2:]  # 61???????? landline
-        if len(phn) == 9 and phn[0:1] == region_code: # 2????????
-            phn = phn[1:]
-        if len(phn) == 9 and phn[0:1] == '4': # 4????????  mobile number
-            phn = country_code + phn
-        if len(phn) == 8: # ???????? landline
-            phn = country_code + region_code + phn
-        return phn
-    count = 0
-    phone_numbers = [c['contact'] for c in ch_contacts]
-    # Collect CiviCRM ContactID fields from existing contacts in the phone-book.
-    get_contact_id = lambda c: json.loads(
-        c[CUSTOM_FIELDS].replace("'", '"').replace('u"', '"')).get(CUSTOM_FIELD_CONTACTID)
-    crm_ids = [get_contact_id(c) for c in ch_contacts if CUSTOM_FIELDS in c]
-
-    for crm_contact in crm_contacts:
-        # Don't count contacts already in the phone-book as duplicates.
-        # Also skip empty phone numbers.
-        if crm_contact['contact_id'] in crm_ids:
-            continue
-        phone_number = standardise('61', '2', crm_contact['phone'])
-        if not phone_number:
-            continue
-        duplicate = phone_number in phone_numbers
-        crm_contact['duplicate'] = duplicate
-        if duplicate:
-            count = count + 1
-            logger.debug('Duplicate phone number. CiviCRM contact %s.' % \
-                crm_contact['contact_id'])
-        else:
-            phone_numbers.append(phone_number)
-    return count
-
-
-def missing_callhub_contacts(ch_contacts, crm_contacts, crm_ch_id_map):
-    """Gather CallHub contacts not found in CiviCRM id map."""
-    if not ch_contacts:
-        return ([], [])
-
-    missing = []
-    existing = []
-    for crm_contact in crm_contacts:
-        ch_id = crm_ch_id_map.get(crm_contact.get('contact_id'))
-        if ch_id:
-            existing.append(ch_id)
-
-    remainder = []
-    for ch_contact in ch_contacts:
-        contact_id = ch_contact['pk_str'] # id as a string value
-        if contact_id in existing:
-            remainder.append(ch_contact)
-        else:
-            missing.append(contact_id)
-
-    return (missing, remainder)
-
-
 def gather_callhub_ids(id_map, callhub_contacts):
     """Examine CallHub contact details for CiviCRM id."""
     for callhub_contact in callhub_contacts:
-        if (CUSTOM_FIELDS in callhub_contact and
-                callhub_contact[CUSTOM_FIELDS] and
-                CUSTOM_FIELD_CONTACTID in callhub_contact[CUSTOM_FIELDS]):
-            # Gather the contact id
-            custom_fields = json.loads(
-                callhub_contact[CUSTOM_FIELDS].replace("'", '"').replace('u"', '"'))
-            crm_id = custom_fields[CUSTOM_FIELD_CONTACTID]
-            if not crm_id:
-                continue
-            # Assume a valid CiviCRM identifier in this custom field
-            # and add it to the map. As string everywhere.
-            id_map[crm_id] = callhub_contact['pk_str'] # id as a string
-
-
-def missing_crm_contacts(crm_contacts, crm_ch_id_map):
-    """
-    Return a new list CRM contacts missing from CallHub,
-    and the CallHub ids of the existing CallHub entries.
-    """
-    # Another O(NxN) operation dodged with dict lookup.
-    missing, existing = ([], []) # This is the return value
-    for crm_contact in crm_contacts:
-        if crm_contact.get('duplicate'):
+        # Gather the contact id
+        crm_id = contact_id(callhub_contact)
+        if not crm_id:
             continue
+        # Assume a valid CiviCRM identifier in this custom field
+        # and add it to the map. As string everywhere.
+        id_map[crm_id] = callhub_contact['pk_str'] # id as a string
 
-        ch_id = crm_ch_id_map.get(crm_contact.get('contact_id'))
-        if ch_id:
-            existing.append(ch_id)
-        else:
-            missing.append(crm_contact)
-    return (missing, existing)
 
+def listing_page_count(first_page):
+    """Number of pages in a listing, worked out from its first page."""
+    page_size = len(first_page['results'])
+    if not first_page['next'] or not page_size:
+        return 1
+    return (int(first_page['count']) + page_size - 1) // page_size
 
 
-@Singleton
-class CallHub(object):
+class CallHubClient(object):
     """
     CallHub API wrapper.
     Implements limited required functionality.
     """
-    def __init__(self, crypter):
+    def __init__(self, crypter, cram=None, metrics=None):
         """
         Set up configured URLs, API keys and field identifiers.
+        `cram` and `metrics` default to the CramCfg and CramMetrics singletons.
         """
-        cram = CramCfg.instance() # pylint: disable-msg=E1101
+        cram = cram or CramCfg.instance() # pylint: disable-msg=E1101
         self.url = cram.cfg['callhub']['url']
-        self.civicrm_url = cram.cfg['civicrm']['url']
-        self.rocket_url = cram.cfg['rocket']['url']
-        self.crm_custom = cram.cfg['civicrm']['custom'] \
-            if 'custom' in cram.cfg['civicrm'] else {}
+        self.configure(cram)
+        # Requests in flight at once. 1 follows the 'next' links serially.
+        self.concurrency = max(1, int(cram.cfg['callhub']['concurrency'])) \
+            if 'concurrency' in cram.cfg['callhub'] else CALLHUB_CONCURRENCY
 
         authtoken = crypter.decrypt(cram.cfg['callhub']['api_key'])
         self.headers = {
             'Authorization': 'Token ' + authtoken,
         }
         self.logger = CramLog.instance() # pylint: disable-msg=E1102
+        self.contacts_count = 0 # Total reported by the latest contacts scan.
+        # Replaced by each hosted instance sharing the session for its runs.
+        self.metrics = metrics or CramMetrics.instance()
+
+        # Keep-alive connections; the session sends the authorization header.
+        # Error responses are retried by the scheduler, not the session.
+        self.session = make_session(
+            cram.cfg, 'callhub', headers=self.headers, status_retry=(),
+            record=self.record_response)
+
+        def callhub_cfg(name, default):
+            return cram.cfg['callhub'][name] if name in cram.cfg['callhub'] else default
+
+        # Rate limit in requests per second (0 is unlimited), with bursts
+        # of up to 'concurrency' requests. The number of requests in flight
+        # adapts between 1 and 'max_concurrency' as CallHub throttles.
+        # Thread pools are sized to that maximum and gated by the scheduler.
+        self.scheduler = RequestScheduler(
+            session=self.session,
+            logger=self.logger,
+            rate=float(callhub_cfg('rate_limit', CALLHUB_RATE_LIMIT)),
+            burst=self.concurrency,
+            concurrency=self.concurrency,
+            max_concurrency=int(callhub_cfg('max_concurrency', self.concurrency)),
+            attempts=int(callhub_cfg('attempts', CALLHUB_ATTEMPTS)),
+            backoff=float(callhub_cfg('backoff', CALLHUB_BACKOFF)),
+            timeout=cram.cfg['timeout'])
+
+
+    def configure(self, cram):
+        """The instance's settings for the contacts it pushes."""
+        self.civicrm_url = cram.cfg['civicrm']['url']
+        self.rocket_url = cram.cfg['rocket']['url']
+        self.crm_custom = cram.cfg['civicrm']['custom'] \
+            if 'custom' in cram.cfg['civicrm'] else {}
+        # Update CallHub contacts whose CiviCRM fields have changed since last pushed.
+        change_cfg = cram.cfg['change_detection'] if 'change_detection' in cram.cfg else {}
+        self.change_detection = 'use' in change_cfg and change_cfg['use']
+        # Contacts with no digest yet are taken as up to date, rather than all pushed.
+        self.change_seed = change_cfg['seed'] if 'seed' in change_cfg else True
+
+
+    def share(self, cram, metrics):
+        """
+        A client for another instance on this CallHub account. The session,
+        scheduler and so rate limit are shared; the contacts it pushes are built
+        from the instance's own configuration `cram`, and timed in its `metrics`.
+        """
+        club = copy.copy(self)
+        club.configure(cram)
+        club.metrics = metrics
+        return club
+
+
+    def record_response(self, response, *args, **kwargs):
+        """Session response hook; counts the request in the current metrics."""
+        return self.metrics.record_response(response, *args, **kwargs)
+
+
+    def request(self, method, url, **kwargs):
+        """Every CallHub request is made through the scheduler."""
+        return self.scheduler.request(method, url, **kwargs)
 
 
     def get_contact_fields(self):
@@ -179,7 +155,7 @@ class CallHub(object):
         NB: The names DO NOT match the actual fields used in the requests!
         """
         contact_fields = '%s/contacts/fields/' % self.url
-        response = get(url=contact_fields, headers=self.headers)
+        response = self.request('get', contact_fields)
         return response.content
 
 
@@ -191,21 +167,35 @@ class CallHub(object):
         However, it MAY update the custom_fields; This needs further confirmation,
         and the behaviour may also change if CallHub make their API work correctly.
         """
+        return self.post_contact(ch_contact)[0]
+
+
+    def post_contact(self, ch_contact):
+        """
+        create_contact(), also telling whether CallHub created the contact
+        or returned the one it found: (contact, created).
+        """
         create_contact = self.url + '/contacts/'
-        response = post(
-            url=create_contact,
-            headers=self.headers,
-            data=ch_contact)
+        try:
+            response = self.request('post', create_contact, data=ch_contact)
+        except exceptions.RequestException as err:
+            self.logger.error('Create Contact failed: %s' % str(err))
+            return {}, False
+        return self.created_contact(ch_contact, response), response.ok
+
+
+    def created_contact(self, ch_contact, response):
+        """The contact created, or found, by a create_contact() response. {} if neither."""
         #self.logger.info(
         #    'New contact: "%s"' % ch_contact[CUSTOM_FIELDS][CUSTOM_FIELD_CONTACTID])
         content = {}
         if response.ok:
-            content = response.json()
+            content = loads(response.content)
             self.logger.info('Created Contact: %s' % sanitised_callhub_contact(content))
 
         elif response.status_code == 400:
             self.logger.warn('Create Contact bad request: HTTP Error %d' % response.status_code)
-            response2 = response.json()
+            response2 = loads(response.content)
             non_field_errors = response2.get('non_field_errors')
             email_error = response2.get('email')
             if non_field_errors:
@@ -223,101 +213,367 @@ class CallHub(object):
         return content
 
 
+    def create_contacts(self, crm_contacts):
+        """
+        Create the CallHub contacts for a list of CiviCRM contacts.
+        Contacts are created through a bounded pool of concurrent requests.
+        Returns {crm_id: (CallHub contact, created)} for the contacts created
+        or found.
+        """
+        ch_contacts = self.callhub_contacts_from(crm_contacts)
+        if not ch_contacts:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.limit.maximum) as pool:
+            results = list(pool.map(self.post_contact, [c for _, c in ch_contacts]))
+        return self.created_contacts(ch_contacts, results)
+
+
+    def callhub_contacts_from(self, crm_contacts):
+        """(crm_id, CallHub contact fields) of each CiviCRM contact to create."""
+        return [
+            (crm_contact['contact_id'], self.make_callhub_contact_from(crm_contact))
+            for crm_contact in crm_contacts]
+
+
+    def created_contacts(self, ch_contacts, results):
+        """
+        {crm_id: (CallHub contact, created)} of the post_contact() `results`
+        for `ch_contacts`. Failures are logged.
+        """
+        created = {}
+        for (crm_id, ch_contact), result in zip(ch_contacts, results):
+            if not result[0]:
+                self.logger.warn('Failed to create or retrieve contact: %s' % \
+                    sanitised_callhub_contact(ch_contact))
+                continue
+            created[crm_id] = result
+        return created
+
+
     def update_contact(self, ch_id, ch_contact):
         """Use 'ch_contact' fields to update CallHub contact 'ch_id'."""
         update_contact = self.url + '/contacts/%s/' % ch_id
-        response = put(
-            url=update_contact,
-            data=ch_contact,
-            headers=self.headers)
+        try:
+            response = self.request('put', update_contact, data=ch_contact)
+        except exceptions.RequestException as err:
+            self.logger.error('Update Contact failed: %s' % str(err))
+            return {}
+        return self.updated_contact(response)
+
+
+    def updated_contact(self, response):
+        """The contact updated by an update_contact() response. {} on failure."""
         content = {}
         if response.ok:
-            content = response.json()
+            content = loads(response.content)
             self.logger.info('Updated Contact: %s' % sanitised_callhub_contact(content))
         else:
             self.logger.debug('Update Contact failed: %s. %s' % (response.reason, response.text))
         return content
 
 
+    def contact_changed(self, crm_ch_id_map, pending, crm_contact, ch_id): # pylint: disable-msg=W0613
+        """
+        phonebook_diff() `changed` test: True if a mapped CiviCRM contact's
+        CallHub fields differ from those last pushed.
+        The new digest is stored straight away, so a contact in several groups
+        is pushed once. `pending` keeps {crm_id: (previous digest, CallHub fields)}
+        for update_contacts(); restore_digests() puts back any left unpushed.
+        """
+        crm_id = crm_contact['contact_id']
+        ch_contact = self.make_callhub_contact_from(crm_contact)
+        digest = contact_digest(ch_contact)
+        previous = crm_ch_id_map.set_digest(crm_id, digest)
+        if previous == digest or (not previous and self.change_seed):
+            return False
+        pending[crm_id] = (previous, ch_contact)
+        return True
+
+
+    def update_contacts(self, updates, pending, crm_ch_id_map):
+        """
+        Push changed contacts, a list of (ch_id, crm_contact), through a bounded
+        pool of concurrent requests. Updated contacts leave `pending`.
+        Returns the number updated.
+        """
+        crm_ids = [crm_contact['contact_id'] for _, crm_contact in updates]
+        with ThreadPoolExecutor(max_workers=self.scheduler.limit.maximum) as pool:
+            results = list(pool.map(
+                self.update_contact,
+                [ch_id for ch_id, _ in updates],
+                [pending[crm_id][1] for crm_id in crm_ids]))
+        return self.updated_contacts(crm_ids, results, pending)
+
+
+    def updated_contacts(self, crm_ids, results, pending): # pylint: disable-msg=R0201
+        """
+        Count the update_contact() `results` for `crm_ids`, taking those
+        updated out of `pending`.
+        """
+        updated = 0
+        for crm_id, result in zip(crm_ids, results):
+            if result:
+                updated += 1
+                pending.pop(crm_id, None)
+        return updated
+
+
+    def restore_digests(self, pending, crm_ch_id_map): # pylint: disable-msg=R0201
+        """
+        Put back the previous digest of each contact still `pending`, i.e.
+        not pushed because its update failed or the group was abandoned part
+        way through, so it is tried again next run.
+        """
+        for crm_id, (previous, _) in pending.items():
+            crm_ch_id_map.set_digest(crm_id, previous)
+        pending.clear()
+
+
+    def get_page(self, page_url):
+        """Retrieve one page of a paginated listing, decoded as it is read. None on failure."""
+        get_response = self.request('get', page_url, stream=True)
+        if get_response.status_code != 200:
+            get_response.close()
+            return None
+        return load_listing(get_response)
+
+
+    def contacts_page_url(self, page):
+        """URL of a numbered contacts page."""
+        return self.url + '/contacts?page=%d' % page
+
+
+    def gather_contacts_page(self, crm_ch_id_map, page, response_content):
+        """
+        Gather ids from a contacts page's content, None if it was not retrieved.
+        The first page also holds the total. Returns False on failure.
+        """
+        if response_content is None:
+            self.logger.critical('Failed to retrieve CallHub Contacts page %d' % page)
+            return False
+
+        if page == 1:
+            self.contacts_count = int(response_content['count'])
+        gather_callhub_ids(
+            id_map=crm_ch_id_map,
+            callhub_contacts=response_content['results'])
+        return True
+
+
+    def contacts_first_page(self, crm_ch_id_map):
+        """Gather ids from the first contacts page, which also holds the total."""
+        response_content = self.get_page(self.contacts_page_url(1))
+        if not self.gather_contacts_page(crm_ch_id_map, 1, response_content):
+            return None
+        return response_content
+
+
     def contacts(self):
         """Retrieve an id {crm:ch_id} mapping of all contacts in CallHub"""
 
         crm_ch_id_map = {}
         try:
+            response_content = self.contacts_first_page(crm_ch_id_map)
+            if response_content is None:
+                return crm_ch_id_map
+
+            if self.concurrency > 1:
+                page_count = listing_page_count(response_content)
+                self.contacts_pages(crm_ch_id_map, range(2, page_count + 1))
+                return crm_ch_id_map
+
             page = 1
-            next_page = self.url + '/contacts?page=%d' % page
+            next_page = response_content['next']
             while next_page:
-                get_response = get(url=next_page, headers=self.headers)
-                if get_response.status_code != 200:
-                    self.logger.critical('Failed to retrieve CallHub Contacts page %d' % page)
-                    next_page = None
-                    continue
-
-                response_content = get_response.json()
-                next_page = response_content['next']
                 page += 1
-                gather_callhub_ids(
-                    id_map=crm_ch_id_map,
-                    callhub_contacts=response_content['results'])
+                response_content = self.get_page(next_page)
+                if not self.gather_contacts_page(crm_ch_id_map, page, response_content):
+                    break
+                next_page = response_content['next']
 
-        except exceptions.ConnectionError as conn_err:
-            self.logger.error(str(conn_err))
+        except exceptions.RequestException as err:
+            self.logger.error(str(err))
 
         return crm_ch_id_map
 
 
+    def contacts_refresh(self, crm_ch_id_map, known_count, known):
+        """
+        Re-scan only the pages that can hold contacts added since a scan
+        that found `known_count` contacts, `known` the id map it built.
+        The listing order is not documented so the pages at both ends are scanned,
+        each end up to a page holding one of the contacts already known.
+        Deletions hide additions from the count, so when the innermost page
+        scanned at either end holds only new contacts every page is scanned.
+        Returns the current CallHub contact total, None on failure.
+        """
+        try:
+            first_ids = {}
+            response_content = self.contacts_first_page(first_ids)
+            if response_content is None:
+                return None
+
+            page_size = len(response_content['results'])
+            if not page_size:
+                return self.contacts_count
+
+            page_count = listing_page_count(response_content)
+            added = max(self.contacts_count - known_count, 0)
+            # The pages holding the first and the last known contact, were none removed.
+            head_last = min(added // page_size + 1, page_count)
+            tail_first = max(min((known_count - 1) // page_size + 1, page_count), 1)
+            pages = sorted(set(range(2, head_last + 1)) |
+                           set(range(max(tail_first, 2), page_count + 1)))
+            self.logger.info('Refreshing %d of %d CallHub Contacts pages' % (
+                len(pages) + 1, page_count))
+            page_ids = self.contacts_page_ids(pages)
+            page_ids[1] = first_ids
+
+            def only_new(page):
+                ids = page_ids.get(page)
+                return bool(ids) and \
+                    all(known.get(crm_id) != ch_id for crm_id, ch_id in ids.items())
+
+            if only_new(head_last) or only_new(tail_first):
+                rest = [page for page in range(2, page_count + 1) if page not in page_ids]
+                self.logger.info(
+                    'CallHub Contacts were added and removed. Scanning %d more pages' % len(rest))
+                page_ids.update(self.contacts_page_ids(rest))
+            for ids in page_ids.values():
+                crm_ch_id_map.update(ids)
+
+        except exceptions.RequestException as err:
+            self.logger.error(str(err))
+            return None
+
+        return self.contacts_count
+
+
+    def contacts_pages(self, crm_ch_id_map, pages):
+        """
+        Fetch the numbered contacts pages, through a bounded thread pool
+        when configured for concurrency.
+        """
+        for ids in self.contacts_page_ids(pages).values():
+            crm_ch_id_map.update(ids)
+
+
+    def contacts_page_ids(self, pages):
+        """{page: {crm_id: ch_id}} of the numbered contacts pages retrieved."""
+        page_urls = [self.contacts_page_url(page) for page in pages]
+
+        page_ids = {}
+        with ThreadPoolExecutor(max_workers=self.scheduler.limit.maximum) as pool:
+            for page, response_content in zip(pages, pool.map(self.get_page, page_urls)):
+                ids = {}
+                if self.gather_contacts_page(ids, page, response_content):
+                    page_ids[page] = ids
+        return page_ids
+
+
     def delete_contact(self, ch_id):
         """Retrieve an id {crm:ch_id} mapping of all contacts in CallHub"""
         next_page = self.url + ('/contacts/%s/' % ch_id)
-        del_response = delete(url=next_page, headers=self.headers)
+        try:
+            del_response = self.request('delete', next_page)
+        except exceptions.RequestException as err:
+            self.logger.critical('Failed to delete CallHub Contact %s: %s' % (ch_id, err))
+            return
         if del_response.status_code != 200:
             self.logger.critical('Failed to delete CallHub Contact %s' % ch_id)
 
 
+    def phonebook_page(self, page_url):
+        """Retrieve one page of phonebook contacts, decoded as it is read. None on failure."""
+        try:
+            response = self.request('get', page_url, stream=True)
+            if not response.ok:
+                response.close()
+                self.logger.error('Failed to retrieve phonebook page: %s' % page_url)
+                return None
+            return load_listing(response)
+        except exceptions.RequestException as err:
+            self.logger.error(str(err))
+            return None
+
+
+    def phonebook_pages(self, phonebook_id):
+        """
+        Generate the contacts in a phonebook a page (list) at a time.
+        When configured for concurrency, the remaining pages are fetched through
+        a bounded thread pool once the first gives the total, and each is
+        yielded as it arrives, so not necessarily in order.
+        """
+        content = self.phonebook_page(self.phonebook_url(phonebook_id))
+        if content is None:
+            return
+        yield content['results']
+
+        if self.concurrency > 1:
+            page_urls = self.phonebook_page_urls(phonebook_id, content)
+            with ThreadPoolExecutor(max_workers=self.scheduler.limit.maximum) as pool:
+                for future in as_completed([pool.submit(self.phonebook_page, page_url)
+                                            for page_url in page_urls]):
+                    content = future.result()
+                    if content is not None:
+                        yield content['results']
+            return
+
+        next_url = content['next']
+        while next_url:
+            content = self.phonebook_page(next_url)
+            if content is None:
+                return
+            yield content['results']
+            next_url = content['next']
+
+
+    def phonebook_url(self, phonebook_id):
+        """URL of a phonebook's contacts."""
+        return '%s/phonebooks/%s/contacts/' % (self.url, phonebook_id)
+
+
+    def phonebook_page_urls(self, phonebook_id, first_page):
+        """URLs of the pages of a phonebook's contacts after `first_page`."""
+        list_url = self.phonebook_url(phonebook_id)
+        return ['%s?page=%d' % (list_url, page)
+                for page in range(2, listing_page_count(first_page) + 1)]
+
+
     def phonebook_get_contacts(self, phonebook_id):
         """Retrieve all contacts in a phonebook"""
         contacts = []
-        next_url = '%s/phonebooks/%s/contacts/' % (self.url, phonebook_id)
-        while next_url:
-            retry_count = 0
-            while retry_count < 3:
-                try:
-                    response = get(url=next_url, headers=self.headers)
-                    break
-                except ConnectionError as conn_err:
-                    if retry_count < 3:
-                        self.logger.warn('%s. Retrying... %d' % (str(conn_err), retry_count))
-                    else:
-                        self.logger.error(str(conn_err))
-                    retry_count += 1
-
-            if response.ok:
-                content = response.json()
-                contacts.extend(content['results'])
-                next_url = content['next']
-            else:
-                next_url = None
+        for page in self.metrics.timed(self.phonebook_pages(phonebook_id), 'phonebook_fetch'):
+            contacts.extend(page)
         return contacts
 
 
     def phonebook_clear(self, phonebook_id, contact_ids):
         """Retrieve all contacts, then build a delete all request"""
-        phonebook_contacts = '%s/phonebooks/%s/contacts/' % (self.url, phonebook_id)
+        error_text = 'no contacts given'
         if contact_ids:
-            headers = {'Content-Type': 'application/json'}
-            headers.update(self.headers)
-            delete_result = delete(
-                url=phonebook_contacts,
-                headers=headers,
-                data=json.dumps({'contact_ids': contact_ids}))
+            try:
+                delete_result = self.request(
+                    'delete', self.phonebook_url(phonebook_id),
+                    headers={'Content-Type': 'application/json'},
+                    data=dumps({'contact_ids': contact_ids}))
+            except exceptions.RequestException as err:
+                self.logger.error(str(err))
+                return self.phonebook_not_cleared(phonebook_id, str(err))
             if delete_result.ok:
-                return delete_result.json()
-        # Consistent return result makes calling code cleaner.
+                return loads(delete_result.content)
+            error_text = delete_result.text
+        return self.phonebook_not_cleared(phonebook_id, error_text)
+
+
+    def phonebook_not_cleared(self, phonebook_id, error_text):
+        """Consistent return result makes calling code cleaner."""
         return {
             'url': self.url,
             'id': phonebook_id,
             'count': -1,
-            'error': delete_result.text
+            'error': error_text
             }
 
 
@@ -366,22 +622,32 @@ class CallHub(object):
 
     def phonebook_add_existing(self, phonebook_id, ch_contact_ids):
         """Add a list of contacts to a phonebook."""
-        phonebook_contacts = '%s/phonebooks/%s/contacts/' % (self.url, phonebook_id)
-        headers = {'Content-Type': 'application/json'}
-        headers.update(self.headers)
-        response = post(
-            url=phonebook_contacts,
-            headers=headers,
-            data=json.dumps({'contact_ids': ch_contact_ids}))
+        try:
+            response = self.request(
+                'post', self.phonebook_url(phonebook_id),
+                headers={'Content-Type': 'application/json'},
+                data=dumps({'contact_ids': ch_contact_ids}))
+            error_text = response.text
+        except exceptions.RequestException as err:
+            response = None
+            error_text = str(err)
+        return self.phonebook_added(phonebook_id, ch_contact_ids, response, error_text)
+
+
+    def phonebook_added(self, phonebook_id, ch_contact_ids, response, error_text):
+        """
+        The phonebook_add_existing() result: its response's content, or
+        a stand-in phonebook with count '+1' and the sanitised error.
+        """
         content = {}
-        if response.ok:
+        if response is not None and response.ok:
             self.logger.info(
                 'Phonebook: "%s" Add existing contacts: "%s"' %
                 (phonebook_id, str(ch_contact_ids)))
-            content = response.json()
+            content = loads(response.content)
         else:
             sanitised_error = re.sub("Phonenumber:'([0-9][0-9][0-9])[0-9]+'", \
-                r"Phonenumber:'\1????????'", response.text)
+                r"Phonenumber:'\1????????'", error_text)
             content = {
                 'url': '%s/phonebooks/%s/' % (self.url, phonebook_id),
                 'id': int(phonebook_id),
@@ -396,69 +662,129 @@ class CallHub(object):
         return content
 
 
-    def phonebook_update(self, phonebook_id, crm_contacts, crm_ch_id_map):
-        """Create all contacts and add them to phonebook"""
-        ch_contacts = self.phonebook_get_contacts(phonebook_id)
-        mark_duplicates(crm_contacts, ch_contacts, self.logger)
+    def phonebook_update(self, phonebook_id, crm_contacts, crm_ch_id_map, ch_contacts=None):
+        """
+        Create all contacts and add them to phonebook.
+        `ch_contacts` are the phonebook's contacts when already fetched.
+        """
+        if ch_contacts is None:
+            # Pages are indexed by the diff as they arrive.
+            # Time spent waiting on them counts as fetching, not diffing.
+            ch_contacts = chain.from_iterable(self.metrics.timed(
+                self.phonebook_pages(phonebook_id), 'phonebook_fetch'))
+        pending = {}
+        try:
+            diff = self.diff_phonebook(crm_contacts, ch_contacts, crm_ch_id_map, pending)
+
+            # Remove contacts not in the crm_contacts list
+            if diff.remove:
+                with self.metrics.phase('phonebook_remove'):
+                    clear_content = self.phonebook_clear(
+                        phonebook_id=phonebook_id,
+                        contact_ids=list(diff.remove))
+                self.phonebook_removed(phonebook_id, diff, clear_content)
+
+            # Push CiviCRM changes to existing contacts; unchanged ones cost nothing.
+            if diff.update:
+                with self.metrics.phase('update'):
+                    updated = self.update_contacts(diff.update, pending, crm_ch_id_map)
+                self.phonebook_updated(phonebook_id, diff, updated)
+
+            # Create missing contacts.
+            to_create = self.contacts_to_create(diff)
+            with self.metrics.phase('create'):
+                created = self.create_contacts(to_create) if to_create else {}
+            existing = self.record_created(diff, to_create, created, crm_ch_id_map)
+
+            if not existing:
+                # We're done here.
+                return
+
+            # Update the phonebook with all these CallHub contact ids.
+            with self.metrics.phase('phonebook_add'):
+                result = self.phonebook_add_existing(
+                    phonebook_id=phonebook_id, ch_contact_ids=existing)
+            self.check_phonebook_add(phonebook_id, existing, result)
+        finally:
+            # Changed contacts not pushed, e.g. the CiviCRM group timed out
+            # during the diff, keep their previous digest.
+            self.restore_digests(pending, crm_ch_id_map)
+
+
+    # The phonebook_update() steps, shared with the asyncio client.
+
+    def diff_phonebook(self, crm_contacts, ch_contacts, crm_ch_id_map, pending):
+        """
+        Diff a CiviCRM group against its phonebook's contacts. With change
+        detection, changed contacts are kept in `pending`. See contact_changed().
+        """
+        changed = partial(self.contact_changed, crm_ch_id_map, pending) \
+            if self.change_detection else None
+        with self.metrics.phase('diff'):
+            return phonebook_diff(
+                crm_contacts, ch_contacts, crm_ch_id_map, self.logger, changed)
 
-        # Remove contacts not in the crm_contacts list
-        missing_callhub, remaining = missing_callhub_contacts(
-            ch_contacts=ch_contacts,
-            crm_contacts=crm_contacts,
-            crm_ch_id_map=crm_ch_id_map)
 
-        if missing_callhub:
-            clear_content = self.phonebook_clear(
-                phonebook_id=phonebook_id,
-                contact_ids=missing_callhub)
-            self.logger.debug('Removed %d contacts from phonebook: %s. %d/%d remaining.' % \
-                (len(missing_callhub), phonebook_id, int(clear_content['count']), len(ch_contacts)))
+    def phonebook_removed(self, phonebook_id, diff, clear_content):
+        """Log the phonebook_clear() of the contacts `diff` removes."""
+        self.logger.debug('Removed %d contacts from phonebook: %s. %d/%d remaining.' % \
+            (len(diff.remove), phonebook_id, int(clear_content['count']),
+             len(diff.keep) + len(diff.remove)))
 
-        # Identify new CRM contacts.
-        ## Note: `existing` is a list of CallHub ids.
-        missing, existing = missing_crm_contacts(crm_contacts, crm_ch_id_map)
 
-        # Skip adding contacts that are already in the phonebook.
-        for ch_contact in ch_contacts:
-            callhub_id = ch_contact['pk_str']
-            if callhub_id in existing:
-                existing.remove(callhub_id)
+    def phonebook_updated(self, phonebook_id, diff, updated):
+        """Log the update_contacts() of the contacts `diff` found changed."""
+        self.logger.info('Phonebook: "%s" Updated %d of %d changed contacts' % (
+            phonebook_id, updated, len(diff.update)))
 
-        # Extract contact numbers from the ones remaining in the phonebook.
-        contact_numbers = [x['contact'] for x in remaining]
 
-        # Create missing contacts.
-        for crm_contact in missing:
+    def contacts_to_create(self, diff):
+        """The CiviCRM contacts `diff` found with no CallHub contact, that have a phone."""
+        to_create = []
+        for crm_contact in diff.create:
             if not crm_contact['phone']:
                 self.logger.warn('Missing phone number: %s' % \
                     sanitise_crm_contact(self.rocket_url, crm_contact))
                 continue
+            to_create.append(crm_contact)
+        return to_create
 
-            if crm_contact['duplicate']:
-                continue
 
-            ch_contact = self.make_callhub_contact_from(crm_contact)
-            new_contact = self.create_contact(ch_contact)
-            if not new_contact:
-                self.logger.warn('Failed to create or retrieve contact: %s' % \
-                    sanitised_callhub_contact(ch_contact))
+    def record_created(self, diff, to_create, created, crm_ch_id_map):
+        """
+        Map the contacts `created` for `to_create`. Returns `diff.add`,
+        the CallHub ids to add to the phonebook, with the new contacts.
+        """
+        ## Note: `existing` is a list of CallHub ids not yet in the phonebook.
+        existing = diff.add
+        for crm_contact in to_create:
+            if crm_contact['contact_id'] not in created:
                 continue
+            new_contact, was_created = created[crm_contact['contact_id']]
+
+            # Remember the new contact straight away, with what was pushed.
+            # A contact CallHub found by its number keeps its own details,
+            # so its digest is unknown.
+            crm_ch_id_map.record(
+                crm_contact['contact_id'], new_contact['pk_str'],
+                contact_digest(self.make_callhub_contact_from(crm_contact)) if was_created else 0)
 
             # Prevent adding two entries with the same contact number!
             # Surprisingly common for two people to share a mobile phone.
-            if new_contact['contact'] not in contact_numbers:
+            if new_contact['contact'] not in diff.numbers:
                 existing.append(new_contact['pk_str']) # id as a string
+        return existing
 
-        if not existing:
-            # We're done here.
-            return
 
-        # Update the phonebook with all these CallHub contact ids.
-        result = self.phonebook_add_existing(
-            phonebook_id=phonebook_id, ch_contact_ids=existing)
+    def check_phonebook_add(self, phonebook_id, existing, result):
+        """Log a phonebook_add_existing() failure."""
         if result.get('count') == '+1': # Special value to indicate failure.
             self.logger.error('CallHub.phonebook_update(): ' + \
                 'Failed to add to phonebook %s: %s' % (
                     phonebook_id, result.get('error', 'no error message')))
         else:
             assert int(result.get('count', '-1')) >= len(existing)
+
+
+# The client of the command line instance.
+CallHub = Singleton(CallHubClient)
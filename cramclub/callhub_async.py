@@ -0,0 +1,354 @@
+"""
+Asyncio CallHub client, alongside the synchronous CallHubClient.
+Requests share one aiohttp connection pool and are fanned out under the
+CallHub client's adaptive limit, so a whole sync can be driven from one
+event loop without a thread per request in flight.
+aiohttp is optional: without it cramhttp_async.has_aiohttp() is False and
+CramIo uses the synchronous clients.
+"""
+import time
+import asyncio
+
+from callhub import listing_page_count
+from cramrate import RETRY_STATUS, retry_after
+from cramhttp_async import AsyncResponse, ASYNC_ERRORS, aiohttp, read_listing
+from cramjson import dumps
+
+# Seconds between looks for room under the limit. Requests the event loop
+# finishes wake its waiters straight away, those of other threads do not.
+LIMIT_POLL = 0.05
+
+
+class AsyncCallHub(object):
+    """
+    Asyncio counterpart of a CallHubClient, whose configuration, headers,
+    rate limit and retry settings, contact building, change detection and
+    result handling it shares. Open it, with `async with` or open() and
+    close(), in the event loop that uses it.
+    """
+    def __init__(self, club):
+        self.club = club
+        self.url = club.url
+        self.logger = club.logger
+        # The token bucket, adaptive limit and any throttling pause are
+        # shared with the sync client.
+        self.scheduler = club.scheduler
+        self.session = None
+        self.released = None # Set as a request of the event loop finishes.
+
+
+    @property
+    def metrics(self):
+        """The club's metrics, which a host replaces for each run."""
+        return self.club.metrics
+
+
+    async def open(self):
+        """Start the connection pool."""
+        maximum = self.scheduler.limit.maximum
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=maximum),
+            headers=dict(self.club.session.headers),
+            timeout=aiohttp.ClientTimeout(total=self.scheduler.timeout))
+        self.released = asyncio.Event()
+        return self
+
+
+    async def close(self):
+        """Close the connection pool."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    async def __aenter__(self):
+        return await self.open()
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    async def wait_for_pause(self):
+        """Hold off while the API is throttling requests."""
+        delay = self.scheduler.paused_until - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    async def acquire(self):
+        """As AdaptiveLimit.acquire(), without blocking the event loop."""
+        limit = self.scheduler.limit
+        while True:
+            self.released.clear()
+            if limit.try_acquire():
+                return
+            try:
+                await asyncio.wait_for(self.released.wait(), LIMIT_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def release(self, throttled):
+        """As AdaptiveLimit.release(), waking the requests waiting in acquire()."""
+        self.scheduler.limit.release(throttled)
+        self.released.set()
+
+
+    async def request(self, method, url, data=None, headers=None, stream=False):
+        """
+        As RequestScheduler.request(): rate limited, in flight no more than
+        the adaptive limit, 429 and 5xx responses and connection errors retried.
+        Returns the last AsyncResponse, or raises the last connection error.
+        With `stream` a 200 response's listing is decoded as it is read.
+        """
+        scheduler = self.scheduler
+        for attempt in range(1, scheduler.attempts + 1):
+            await self.wait_for_pause()
+            wait = scheduler.bucket.take()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = scheduler.bucket.take()
+            await self.acquire()
+            start = time.perf_counter()
+            try:
+                async with self.session.request(
+                        method, url, data=data, headers=headers) as raw:
+                    if stream and raw.status == 200:
+                        listing, content = await read_listing(raw), b''
+                    else:
+                        listing, content = None, await raw.read()
+            except ASYNC_ERRORS as err:
+                self.release(throttled=False)
+                if attempt == scheduler.attempts:
+                    raise
+                delay = scheduler.backoff_delay(attempt)
+                self.logger.warn('%s. Retrying in %.1f seconds... %d' % (
+                    str(err) or type(err).__name__, delay, attempt))
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled, e.g. a group timing out.
+                self.release(throttled=False)
+                raise
+            self.release(throttled=raw.status == 429)
+            response = AsyncResponse(
+                method, url, data if isinstance(data, str) else None,
+                raw, content, time.perf_counter() - start, listing)
+            self.metrics.record_response(response)
+            if response.status_code not in RETRY_STATUS or attempt == scheduler.attempts:
+                return response
+
+            delay = retry_after(response)
+            if delay is None:
+                delay = scheduler.backoff_delay(attempt)
+            if response.status_code == 429:
+                scheduler.pause(delay)
+            self.logger.warn('%s %s: HTTP Error %d. Retrying in %.1f seconds... %d' % (
+                method.upper(), url, response.status_code, delay, attempt))
+            await asyncio.sleep(delay)
+        return response
+
+
+    async def post_contact(self, ch_contact):
+        """As CallHubClient.post_contact()"""
+        try:
+            response = await self.request('post', self.url + '/contacts/', data=ch_contact)
+        except ASYNC_ERRORS as err:
+            self.logger.error('Create Contact failed: %s' % (str(err) or type(err).__name__))
+            return {}, False
+        return self.club.created_contact(ch_contact, response), response.ok
+
+
+    async def create_contacts(self, crm_contacts):
+        """As CallHubClient.create_contacts(), the single creates all at once."""
+        ch_contacts = self.club.callhub_contacts_from(crm_contacts)
+        results = await asyncio.gather(
+            *[self.post_contact(ch_contact) for _, ch_contact in ch_contacts])
+        return self.club.created_contacts(ch_contacts, results)
+
+
+    async def update_contact(self, ch_id, ch_contact):
+        """As CallHubClient.update_contact()"""
+        try:
+            response = await self.request(
+                'put', self.url + '/contacts/%s/' % ch_id, data=ch_contact)
+        except ASYNC_ERRORS as err:
+            self.logger.error('Update Contact failed: %s' % (str(err) or type(err).__name__))
+            return {}
+        return self.club.updated_contact(response)
+
+
+    async def update_contacts(self, updates, pending, crm_ch_id_map):
+        """As CallHubClient.update_contacts()"""
+        crm_ids = [crm_contact['contact_id'] for _, crm_contact in updates]
+        results = await asyncio.gather(*[
+            self.update_contact(ch_id, pending[crm_id][1])
+            for (ch_id, _), crm_id in zip(updates, crm_ids)])
+        return self.club.updated_contacts(crm_ids, results, pending)
+
+
+    async def get_page(self, page_url):
+        """Retrieve one page of a paginated listing, decoded as it is read. None on failure."""
+        response = await self.request('get', page_url, stream=True)
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+
+    async def contacts(self):
+        """As CallHubClient.contacts(): {crm_id: ch_id} of all contacts in CallHub."""
+        club = self.club
+        crm_ch_id_map = {}
+        try:
+            content = await self.get_page(club.contacts_page_url(1))
+            if not club.gather_contacts_page(crm_ch_id_map, 1, content):
+                return crm_ch_id_map
+
+            if club.concurrency > 1:
+                pages = range(2, listing_page_count(content) + 1)
+                contents = await asyncio.gather(*[
+                    self.get_page(club.contacts_page_url(page)) for page in pages])
+                for page, content in zip(pages, contents):
+                    club.gather_contacts_page(crm_ch_id_map, page, content)
+                return crm_ch_id_map
+
+            page = 1
+            next_page = content['next']
+            while next_page:
+                page += 1
+                content = await self.get_page(next_page)
+                if not club.gather_contacts_page(crm_ch_id_map, page, content):
+                    break
+                next_page = content['next']
+
+        except ASYNC_ERRORS as err:
+            self.logger.error(str(err) or type(err).__name__)
+
+        return crm_ch_id_map
+
+
+    async def delete_contact(self, ch_id):
+        """As CallHubClient.delete_contact()"""
+        try:
+            response = await self.request('delete', self.url + '/contacts/%s/' % ch_id)
+        except ASYNC_ERRORS as err:
+            self.logger.critical('Failed to delete CallHub Contact %s: %s' % (
+                ch_id, str(err) or type(err).__name__))
+            return
+        if response.status_code != 200:
+            self.logger.critical('Failed to delete CallHub Contact %s' % ch_id)
+
+
+    async def phonebook_page(self, page_url):
+        """Retrieve one page of phonebook contacts, decoded as it is read. None on failure."""
+        try:
+            response = await self.request('get', page_url, stream=True)
+        except ASYNC_ERRORS as err:
+            self.logger.error(str(err) or type(err).__name__)
+            return None
+
+        if not response.ok:
+            self.logger.error('Failed to retrieve phonebook page: %s' % page_url)
+            return None
+        return response.json()
+
+
+    async def phonebook_get_contacts(self, phonebook_id):
+        """
+        Retrieve all contacts in a phonebook. With 'concurrency' above 1 the
+        pages after the first are fetched at once, else by their 'next' links.
+        """
+        content = await self.phonebook_page(self.club.phonebook_url(phonebook_id))
+        if content is None:
+            return []
+        contacts = list(content['results'])
+
+        if self.club.concurrency > 1:
+            contents = await asyncio.gather(*[
+                self.phonebook_page(page_url)
+                for page_url in self.club.phonebook_page_urls(phonebook_id, content)])
+            for content in contents:
+                if content is not None:
+                    contacts.extend(content['results'])
+            return contacts
+
+        next_url = content['next']
+        while next_url:
+            content = await self.phonebook_page(next_url)
+            if content is None:
+                break
+            contacts.extend(content['results'])
+            next_url = content['next']
+        return contacts
+
+
+    async def phonebook_clear(self, phonebook_id, contact_ids):
+        """As CallHubClient.phonebook_clear()"""
+        error_text = 'no contacts given'
+        if contact_ids:
+            try:
+                response = await self.request(
+                    'delete', self.club.phonebook_url(phonebook_id),
+                    headers={'Content-Type': 'application/json'},
+                    data=dumps({'contact_ids': contact_ids}))
+            except ASYNC_ERRORS as err:
+                error_text = str(err) or type(err).__name__
+                self.logger.error(error_text)
+                return self.club.phonebook_not_cleared(phonebook_id, error_text)
+            if response.ok:
+                return response.json()
+            error_text = response.text
+        return self.club.phonebook_not_cleared(phonebook_id, error_text)
+
+
+    async def phonebook_add_existing(self, phonebook_id, ch_contact_ids):
+        """As CallHubClient.phonebook_add_existing()"""
+        try:
+            response = await self.request(
+                'post', self.club.phonebook_url(phonebook_id),
+                headers={'Content-Type': 'application/json'},
+                data=dumps({'contact_ids': ch_contact_ids}))
+            error_text = response.text
+        except ASYNC_ERRORS as err:
+            response = None
+            error_text = str(err) or type(err).__name__
+        return self.club.phonebook_added(phonebook_id, ch_contact_ids, response, error_text)
+
+
+    async def phonebook_update(self, phonebook_id, crm_contacts, crm_ch_id_map, ch_contacts=None):
+        """As CallHubClient.phonebook_update()"""
+        club = self.club
+        if ch_contacts is None:
+            async with self.metrics.async_phase('phonebook_fetch'):
+                ch_contacts = await self.phonebook_get_contacts(phonebook_id)
+        pending = {}
+        try:
+            diff = club.diff_phonebook(crm_contacts, ch_contacts, crm_ch_id_map, pending)
+
+            if diff.remove:
+                async with self.metrics.async_phase('phonebook_remove'):
+                    clear_content = await self.phonebook_clear(
+                        phonebook_id=phonebook_id,
+                        contact_ids=list(diff.remove))
+                club.phonebook_removed(phonebook_id, diff, clear_content)
+
+            if diff.update:
+                async with self.metrics.async_phase('update'):
+                    updated = await self.update_contacts(diff.update, pending, crm_ch_id_map)
+                club.phonebook_updated(phonebook_id, diff, updated)
+
+            to_create = club.contacts_to_create(diff)
+            async with self.metrics.async_phase('create'):
+                created = await self.create_contacts(to_create) if to_create else {}
+            existing = club.record_created(diff, to_create, created, crm_ch_id_map)
+
+            if not existing:
+                return
+
+            async with self.metrics.async_phase('phonebook_add'):
+                result = await self.phonebook_add_existing(
+                    phonebook_id=phonebook_id, ch_contact_ids=existing)
+            club.check_phonebook_add(phonebook_id, existing, result)
+        finally:
+            club.restore_digests(pending, crm_ch_id_map)
@@ -5,6 +5,8 @@ Package level import
 __all__ = [
     'CiviCRM',
     'CivicrmError',
+    'AsyncCiviCRM',
 ]
 
 from civicrm.civicrm import CiviCRM, CivicrmError
+from civicrm.civicrm_async import AsyncCiviCRM
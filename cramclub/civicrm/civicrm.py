@@ -55,6 +55,11 @@ The following optional values can be supplied when intializing:
                             the connection timesout.
                             Defaults to None, this means the connection will
                             hang until closed.
+    session=S               A requests.Session (or compatible) used for
+                            every call, so connections are kept alive.
+                            Defaults to the requests module functions.
+    loads=F                 Decodes response bodies (bytes), e.g. a faster
+                            JSON library's. Defaults to json.loads.
 
 e.g.
     url = 'www.example.org/path/to/civi/codebase/civicrm/extern/rest.php'
@@ -104,6 +109,29 @@ what you are doing in this case, and we can save an extra API call for speed.
 
 * The  replace API call is undocumented, AFAIK, so not implemented, use
 getaction if you must.
+
+* Chained calls, e.g. 'api.CustomValue.get', and parameters with nested
+values, e.g. id={'IN': [1, 2, 3]}, are sent JSON encoded in the json
+parameter, as PHP would mangle the dots in their names. chained() returns
+the checked results of a chained call from a record::
+
+    contacts = civicrm.get('Contact', id={'IN': [1, 2]},
+                           **{'api.CustomValue.get': {}})
+    custom_values = civicrm.chained(contacts[0], 'CustomValue')
+
+* iter_get() generates the values of a get while the response is read,
+decoded by an incremental parser, rather than decoding the whole body::
+
+    for contact in civicrm.iter_get('Contact', parser, group=[12]):
+        ...
+
+* batch() makes several calls, on any entities, in one request (api3.call)
+and returns their results by name::
+
+    results = civicrm.batch({
+        'contacts': ('Contact', 'get', {'group': 12}),
+        'fields': ('CustomField', 'get', {'custom_group_id': 3}),
+    })
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
@@ -120,13 +148,17 @@ class CivicrmError(Exception):
 class CiviCRM:
     """
     .. class::CiviCRM(
-                    self, url, site_key, api_key,[use_ssl=True], [timeout=None]
+                    self, url, site_key, api_key,[use_ssl=True], [timeout=None],
+                    [session=None], [loads=None]
                     )
     Make calls against the Civicrm API.
     """
+    # Bytes read at a time from iter_get() responses.
+    chunk_size = 65536
 
-    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None):
-        """Set url,api keys, ssl usage, timeout"""
+    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None,
+                 session=None, loads=None):
+        """Set url,api keys, ssl usage, timeout, http session, decoder"""
 
         # strip http(s):// off url
         regex = re.compile('^https?://')
@@ -139,6 +171,9 @@ class CiviCRM:
         self.api_key = api_key
         self.use_ssl = use_ssl
         self.timeout = timeout
+        # A requests.Session keeps connections alive between calls.
+        self.session = session if session is not None else requests
+        self.loads = loads or json.loads
         if self.use_ssl:
             start = 'https://'
         else:
@@ -151,11 +186,12 @@ class CiviCRM:
         if not parameters:
             parameters = {}
         payload = self._construct_payload('get', action, entity, parameters)
-        api_call = requests.get(self.url, params=payload, timeout=self.timeout)
+        api_call = self.session.get(
+            self.url, params=payload, timeout=self.timeout)
         if api_call.status_code != 200:
             raise CivicrmError('request to %s failed with status code %s'
                                % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
+        results = self.loads(api_call.content)
         return self._check_results(results)
 
     def _post(self, action, entity, parameters=None):
@@ -164,13 +200,13 @@ class CiviCRM:
         if not parameters:
             parameters = {}
         postdata = self._construct_payload('post', action, entity, parameters)
-        api_call = requests.post(
+        api_call = self.session.post(
             self.url, data=postdata, timeout=self.timeout
         )
         if api_call.status_code != 200:
             raise CivicrmError('request to %s failed with status code %s'
                                % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
+        results = self.loads(api_call.content)
         # Some entities return things in the values field
         # that don't conform to the normal use elsewhere
         # Here we check for this and just return straight results
@@ -244,7 +280,39 @@ class CiviCRM:
             ]
         if use.lower() == 'post':
             notparams.extend(['body_html', 'body_text'])
-        return self._filter_merge_payload(parameters, payload, notparams)
+        payload = self._filter_merge_payload(parameters, payload, notparams)
+        return self._json_payload(payload)
+
+    def _json_payload(self, payload):
+        """Move chained calls and nested parameters into the json
+        parameter, which CiviCRM merges with the others.
+        """
+        nested = dict((key, value) for key, value in payload.items()
+                      if key.startswith('api.') or isinstance(value, dict))
+        if nested:
+            for key in nested:
+                del payload[key]
+            payload['json'] = json.dumps(nested)
+        return payload
+
+    def _batch_payload(self, calls):
+        """Payload for an api3.call of {name: (entity, action, params)}."""
+        payload = self._payload_template('call', 'api3')
+        payload['json'] = json.dumps(dict(
+            (name, [entity, action, dict(params, sequential=1)])
+            for name, (entity, action, params) in calls.items()))
+        return payload
+
+    def _check_batch(self, results):
+        """Returns the checked results of each batched call by name,
+        or raises the first error. Other keys, e.g. is_error and count,
+        are not results of a call.
+        """
+        if results.get('is_error') == 1:
+            raise CivicrmError(results['error_message'])
+        return dict((name, self._check_results(result))
+                    for name, result in results.items()
+                    if isinstance(result, dict))
 
 
     def _add_options(self, params, **kwargs):
@@ -269,6 +337,31 @@ class CiviCRM:
         else:
             return results
 
+    def chained(self, record, entity, action='get'):
+        """Removes a chained call's results from a record and
+        returns them checked, e.g. the list of values of a get.
+        Returns an empty list if the call was not chained.
+        """
+        results = record.pop('api.%s.%s' % (entity, action), None)
+        if results is None:
+            return []
+        return self._check_results(results)
+
+    def batch(self, calls):
+        """Makes several calls in one request.
+        :param calls: A dictionary of name: (entity, action, params).
+        :return: A dictionary of name: results, as returned by the
+            corresponding method.
+        """
+        payload = self._batch_payload(calls)
+        api_call = self.session.post(
+            self.url, data=payload, timeout=self.timeout
+        )
+        if api_call.status_code != 200:
+            raise CivicrmError('request to %s failed with status code %s'
+                               % (self.url, api_call.status_code))
+        return self._check_batch(self.loads(api_call.content))
+
     def is_valid_option(self, entity, field, value):
         """Takes a value which can be an id or its corresponding
         label, Returns the (corresponding) id if valid, otherwise
@@ -306,6 +399,33 @@ class CiviCRM:
         params = self._add_options(kwargs, limit=limit, offset=offset)
         return self._get('get', entity, params)
 
+    def iter_get(self, entity, parser, **kwargs):
+        """As get, but generates the values as they are read from
+        the response.
+        :param parser: An incremental JSON parser whose feed(chunk)
+            and close() methods return the values completed so far,
+            keeping the other results in its fields dictionary.
+        Raises a CivicrmError as get does, once the values are read.
+        """
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        params = self._add_options(kwargs, limit=limit, offset=offset)
+        payload = self._construct_payload('get', 'get', entity, params)
+        api_call = self.session.get(
+            self.url, params=payload, timeout=self.timeout, stream=True)
+        try:
+            if api_call.status_code != 200:
+                raise CivicrmError('request to %s failed with status code %s'
+                                   % (self.url, api_call.status_code))
+            for chunk in api_call.iter_content(self.chunk_size):
+                for value in parser.feed(chunk):
+                    yield value
+            for value in parser.close():
+                yield value
+        finally:
+            api_call.close()
+        self._check_results(parser.fields)
+
     def getsingle(self, entity, **kwargs):
         """Simple implementation of getsingle action.
         Returns a dictionary.
@@ -0,0 +1,305 @@
+"""
+.. module::civicrm_async
+:synopis:Asyncio access to the CiviCRM v3 API.
+
+AsyncCiviCRM is the CiviCRM class with its API calls made by aiohttp.
+Payloads are built and results checked by the same CiviCRM methods;
+only the transport differs. Every API method is a coroutine::
+
+    async with AsyncCiviCRM(url, site_key, api_key) as civicrm:
+        search_results = await civicrm.get('Contact', city='Gotham City')
+        count = await civicrm.getcount('Contact', city='Gotham City')
+
+Separate searches, or offset windows of one, can be gathered as usual::
+
+    groups = await asyncio.gather(
+        civicrm.get('Contact', group=[12]), civicrm.get('Contact', group=[13]))
+
+Chained calls and batch() work as for CiviCRM, and iter_get() is an
+async generator::
+
+    async for contact in civicrm.iter_get('Contact', parser, group=[12]):
+        ...
+
+In addition to the CiviCRM options:
+    session=S               An aiohttp.ClientSession shared with other users.
+                            By default one is opened and closed by the
+                            AsyncCiviCRM, with up to `concurrency`
+                            connections.
+    concurrency=N           Calls in flight at once, default 4.
+    on_response=F           Called with each aiohttp response, once read,
+                            its content and the seconds it took.
+
+Create it within the event loop that uses it. aiohttp is needed,
+and is only imported when an AsyncCiviCRM is created.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+import asyncio
+
+from civicrm.civicrm import CiviCRM, CivicrmError, matches_required
+
+
+def query_items(payload):
+    """Payload as (key, str) query items; lists become repeated keys,
+    as requests sends them.
+    """
+    items = []
+    for key, value in payload.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        items.extend((key, str(item)) for item in values)
+    return items
+
+
+class AsyncCiviCRM(CiviCRM):
+    """
+    .. class::AsyncCiviCRM(
+                    self, url, site_key, api_key,[use_ssl=True], [timeout=None],
+                    [session=None], [loads=None], [concurrency=4],
+                    [on_response=None]
+                    )
+    Make calls against the Civicrm API from asyncio.
+    """
+
+    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None,
+                 session=None, loads=None, concurrency=4, on_response=None):
+        """Set url, api keys, ssl usage, timeout, aiohttp session, decoder"""
+        import aiohttp
+        super().__init__(url, site_key, api_key, use_ssl=use_ssl,
+                         timeout=timeout, session=session, loads=loads)
+        self.own_session = session is None
+        if self.own_session:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=concurrency))
+        self.client_timeout = aiohttp.ClientTimeout(total=timeout)
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.on_response = on_response
+
+    async def close(self):
+        """Close the session, if it was opened here."""
+        if self.own_session and not self.session.closed:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _call(self, method, **kwargs):
+        """Make one request. Returns the decoded JSON."""
+        async with self.semaphore:
+            start = time.perf_counter()
+            async with self.session.request(
+                    method, self.url, timeout=self.client_timeout,
+                    **kwargs) as api_call:
+                content = await api_call.read()
+        if self.on_response:
+            self.on_response(api_call, content, time.perf_counter() - start)
+        if api_call.status != 200:
+            raise CivicrmError('request to %s failed with status code %s'
+                               % (self.url, api_call.status))
+        return self.loads(content)
+
+    async def _get(self, action, entity, parameters=None):
+        """Internal method to make api calls using GET."""
+
+        if not parameters:
+            parameters = {}
+        payload = self._construct_payload('get', action, entity, parameters)
+        results = await self._call('GET', params=query_items(payload))
+        return self._check_results(results)
+
+    async def _post(self, action, entity, parameters=None):
+        """Internal method to make api calls using POST."""
+
+        if not parameters:
+            parameters = {}
+        postdata = self._construct_payload('post', action, entity, parameters)
+        results = await self._call('POST', data=query_items(postdata))
+        # As CiviCRM._post, GroupContact results are returned whole.
+        funny_values = ['GroupContact']
+        if entity in funny_values:
+            return results
+        else:
+            return self._check_results(results)
+
+    async def iter_get(self, entity, parser, **kwargs):
+        """As CiviCRM.iter_get, an async generator."""
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        params = self._add_options(kwargs, limit=limit, offset=offset)
+        payload = self._construct_payload('get', 'get', entity, params)
+        async with self.semaphore:
+            start = time.perf_counter()
+            async with self.session.get(
+                    self.url, params=query_items(payload),
+                    timeout=self.client_timeout) as api_call:
+                if api_call.status == 200:
+                    async for chunk in api_call.content.iter_chunked(
+                            self.chunk_size):
+                        for value in parser.feed(chunk):
+                            yield value
+        if self.on_response:
+            self.on_response(api_call, b'', time.perf_counter() - start)
+        if api_call.status != 200:
+            raise CivicrmError('request to %s failed with status code %s'
+                               % (self.url, api_call.status))
+        for value in parser.close():
+            yield value
+        self._check_results(parser.fields)
+
+    async def batch(self, calls):
+        """As CiviCRM.batch."""
+        payload = self._batch_payload(calls)
+        return self._check_batch(
+            await self._call('POST', data=query_items(payload)))
+
+    async def is_valid_option(self, entity, field, value):
+        """As CiviCRM.is_valid_option."""
+        try:
+            options = await self.getoptions(entity, field)
+        except CivicrmError:
+            raise CivicrmError("%s has no defined options for %s"
+                               % (entity, field))
+        labels = dict((value, key) for key, value
+                      in options.items())
+        if type(value) is int and str(value) in options:
+            return value
+        elif value in labels:
+            return labels[value]
+        else:
+            raise CivicrmError("invalid option %s" % value)
+
+    async def _first(self, entity, **kwargs):
+        """Create and return the first record created."""
+        return (await self.create(entity, **kwargs))[0]
+
+    async def add_contact(self, contact_type, **kwargs):
+        """As CiviCRM.add_contact."""
+        required = ['first_name', 'last_name', 'email', 'display_name']
+        missing_fields = matches_required(required, kwargs)
+        if missing_fields:
+            raise CivicrmError('One of the following fields must exist:%s'
+                               % ", ".join(missing_fields))
+        return await self._first('Contact', contact_type=contact_type,
+                                 **kwargs)
+
+    async def add_relationship(self, contact_a, contact_b, relationship,
+                               **kwargs):
+        """As CiviCRM.add_relationship."""
+        relationship_id = None
+        if type(relationship) is int:
+            relationship_id = relationship
+        else:
+            for field in ['name_a_b', 'label_a_b',
+                          'name_b_a', 'label_b_a',
+                          'description']:
+                result = await self.get(
+                    'RelationshipType',
+                    **{field: relationship, 'return': ['id']}
+                )
+                if result:
+                    relationship_id = result[0]['id']
+                    break
+        if not relationship_id:
+            raise CivicrmError('invalid relationship %s' % relationship)
+        kwargs.update({
+            'relationship_type_id': relationship_id,
+            'contact_id_a': contact_a,
+            'contact_id_b': contact_b
+        })
+        return await self._first('Relationship', **kwargs)
+
+    async def add_activity_type(self, label, weight=5, is_active=0, **kwargs):
+        """As CiviCRM.add_activity_type."""
+        kwargs.update({
+            'label': label,
+            'weight': weight,
+            'is_active': is_active
+        })
+        return await self._first('ActivityType', **kwargs)
+
+    async def add_activity(self, activity_type, sourceid,
+                           subject=None, date_time=None, activity_status=None,
+                           activity_medium=None, priority=None, **kwargs):
+        """As CiviCRM.add_activity."""
+        if type(activity_type) is not int:
+            activity_type = await self.is_valid_option(
+                'Activity', 'activity_type_id', activity_type)
+        kwargs['activity_type_id'] = activity_type
+        options = {
+            'activity_status': activity_status,
+            'activity_medium': activity_medium,
+            'priority': priority,
+        }
+        for option, val in options.items():
+            if val:
+                name = option + '_id'
+                if type(val) is not int:
+                    val = await self.is_valid_option('Activity', name, val)
+                kwargs[name] = val
+        kwargs.update({
+            'source_contact_id': sourceid,
+            'subject': subject,
+            'activity_date_time': date_time
+        })
+        return await self._first('Activity', **kwargs)
+
+    async def add_contribution(self, contact_id, total_amount,
+                               financial_type, **kwargs):
+        """As CiviCRM.add_contribution."""
+        if type(financial_type) is not int:
+            financial_type = await self.is_valid_option(
+                'Contribution',
+                'financial_type_id',
+                financial_type
+            )
+        kwargs.update({
+            'financial_type_id': financial_type,
+            'contact_id': contact_id,
+            'total_amount': total_amount,
+        })
+        return await self._first('Contribution', **kwargs)
+
+    async def add_email(self, contact_id, email, email_like=False, **kwargs):
+        """As CiviCRM.add_email."""
+        if email_like and not self.eml.match(email):
+            raise CivicrmError("Might not be an email address")
+        return await self._first('Email', contact_id=contact_id, email=email,
+                                 **kwargs)
+
+    async def add_note(self, entity_id, note, **kwargs):
+        """As CiviCRM.add_note."""
+        return await self._first('Note', entity_id=entity_id, note=note,
+                                 **kwargs)
+
+    async def add_tag(self, name, **kwargs):
+        """As CiviCRM.add_tag."""
+        return await self._first('Tag', name=name, **kwargs)
+
+    async def add_group(self, title, **kwargs):
+        """As CiviCRM.add_group."""
+        return await self._first('Group', title=title, **kwargs)
+
+    async def add_phone(self, contact_id, phone, **kwargs):
+        """As CiviCRM.add_phone."""
+        return await self._first('Phone', contact_id=contact_id,
+                                 phone=phone, **kwargs)
+
+    async def add_address(self, contact_id, location_type, **kwargs):
+        """As CiviCRM.add_address."""
+        if type(location_type) is not int:
+            location_type = await self.is_valid_option(
+                'Address',
+                'location_type_id',
+                location_type
+            )
+        kwargs.update({
+            'contact_id': contact_id,
+            'location_type_id': location_type,
+        })
+        return await self._first('Address', **kwargs)
@@ -0,0 +1,262 @@
+"""
+Performance benchmarks on synthetic data.
+Run from this directory: python crambench.py [diff|fields|json|sync] [--sizes N ...]
+The sync benchmark runs CramIo.process_groups against crammock's local
+CallHub and CiviCRM stand-ins.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from cramdiff import phonebook_diff
+from cramfields import ContactIdCache
+from cramstream import JsonArrayParser, iter_items
+import cramjson
+from cramconst import CUSTOM_FIELDS, CUSTOM_FIELD_CONTACTID
+from cramcfg import CramCfg, save_configuration
+from cramlog import CramLog
+from cramio import CramIo
+import crammock
+
+
+def synthetic_contacts(size):
+    """
+    Build a CiviCRM group of `size` contacts, a {crm_id: ch_id} map covering
+    90% of them and a CallHub phonebook holding 80% of the group plus stale
+    entries. One in fifty CiviCRM contacts shares a mobile number.
+    """
+    crm_contacts = []
+    crm_ch_id_map = {}
+    ch_contacts = []
+    for index in range(size):
+        crm_id = str(100000 + index)
+        number = index - index % 2 if index % 50 < 2 else index
+        crm_contacts.append({
+            'contact_id': crm_id,
+            'phone': '04%08d' % number,
+            'first_name': 'First%d' % index,
+            'last_name': 'Last%d' % index,
+        })
+        if index % 10:
+            crm_ch_id_map[crm_id] = str(1910874392879957535 + index)
+        if index % 5:
+            ch_contacts.append({
+                'pk_str': str(1910874392879957535 + index),
+                'contact': '614%08d' % number,
+                CUSTOM_FIELDS: "{u'%s': u'%s'}" % (CUSTOM_FIELD_CONTACTID, crm_id),
+            })
+    for index in range(size // 20):
+        ch_contacts.append({
+            'pk_str': str(2910874392879957535 + index),
+            'contact': '612%08d' % index,
+            CUSTOM_FIELDS: "{u'%s': u'%d'}" % (CUSTOM_FIELD_CONTACTID, 900000 + index),
+        })
+    return crm_contacts, ch_contacts, crm_ch_id_map
+
+
+def bench_phonebook_diff(sizes=(12500, 25000, 50000, 100000)):
+    """
+    Time phonebook_diff() as the group size doubles.
+    Linear scaling shows as a steady time per contact.
+    """
+    print('phonebook_diff')
+    print('%10s %10s %14s %8s %8s %8s' % (
+        'contacts', 'seconds', 'us/contact', 'add', 'remove', 'create'))
+    for size in sizes:
+        crm_contacts, ch_contacts, crm_ch_id_map = synthetic_contacts(size)
+        start = time.perf_counter()
+        diff = phonebook_diff(crm_contacts, ch_contacts, crm_ch_id_map)
+        elapsed = time.perf_counter() - start
+        print('%10d %10.3f %14.2f %8d %8d %8d' % (
+            size, elapsed, elapsed * 1e6 / size,
+            len(diff.add), len(diff.remove), len(diff.create)))
+
+
+def bench_contact_ids(sizes=(30000,)):
+    """
+    Time extracting the ContactID from CallHub custom_fields: the old
+    quote rewriting json.loads, then ContactIdCache cold and warm.
+    """
+    def rewrite_json(ch_contact):
+        return json.loads(ch_contact[CUSTOM_FIELDS].replace("'", '"').replace('u"', '"')).get(
+            CUSTOM_FIELD_CONTACTID)
+
+    print('contact_id')
+    print('%10s %16s %16s %16s' % ('contacts', 'json us/contact', 'cold us/contact', 'warm us/contact'))
+    for size in sizes:
+        ch_contacts = synthetic_contacts(size)[1]
+        cache = ContactIdCache()
+        timings = []
+        for decode in (rewrite_json, cache.contact_id, cache.contact_id):
+            start = time.perf_counter()
+            for ch_contact in ch_contacts:
+                decode(ch_contact)
+            timings.append((time.perf_counter() - start) * 1e6 / len(ch_contacts))
+        print('%10d %16.2f %16.2f %16.2f' % ((len(ch_contacts),) + tuple(timings)))
+
+
+def callhub_page(size, page=2):
+    """A CallHub contacts listing page of `size` contacts, as returned by the API."""
+    results = []
+    for index in range((page - 1) * size, page * size):
+        pk_str = str(1910874392879957535 + index)
+        results.append({
+            'url': 'https://api.callhub.io/v1/contacts/%s/' % pk_str,
+            'pk_str': pk_str,
+            'contact': '614%08d' % index,
+            'mobile': '614%08d' % index,
+            'first_name': 'First%d' % index,
+            'last_name': 'Last%d' % index,
+            'email': 'contact%d@example.org' % index,
+            'address': '%d Example Street' % index,
+            'city': 'Sydney',
+            'state': 'New South Wales',
+            'country': 'Australia',
+            'zipcode': '2000',
+            'company_name': '',
+            'company_website': '',
+            'job_title': '',
+            'country_code': 'AU',
+            'tags': [],
+            CUSTOM_FIELDS: "{u'%s': u'%d', u'2170': u'Sydney', u'2171': u'Sydney'}" % (
+                CUSTOM_FIELD_CONTACTID, 100000 + index),
+            'created_date': '2020-03-01T10:%02d:00Z' % (index % 60),
+            'updated_date': '2020-03-02T10:%02d:00Z' % (index % 60),
+        })
+    return {
+        'count': size * 10,
+        'next': 'https://api.callhub.io/v1/contacts/?page=%d' % (page + 1),
+        'previous': 'https://api.callhub.io/v1/contacts/?page=%d' % (page - 1),
+        'results': results,
+    }
+
+
+def bench_json(sizes=(100, 1000), rounds=20):
+    """
+    Time each available cramjson codec on CallHub contacts pages:
+    decoding a page whole and streamed, and encoding it.
+    """
+    print('json (%s)' % ', '.join(sorted(cramjson.CODECS)))
+    print('%10s %8s %10s %14s %14s %14s' % (
+        'contacts', 'codec', 'page KB', 'loads us/page', 'stream us/page', 'dumps us/body'))
+    previous = cramjson.CODEC
+    try:
+        for size in sizes:
+            listing = callhub_page(size)
+            body = json.dumps(listing).encode('utf-8')
+            chunks = [body[start:start + 65536] for start in range(0, len(body), 65536)]
+            for name in sorted(cramjson.CODECS):
+                cramjson.use(name)
+                timings = []
+                for run in (
+                        lambda: cramjson.loads(body),
+                        lambda: list(iter_items(chunks, JsonArrayParser())),
+                        lambda: cramjson.dumps(listing)):
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        run()
+                    timings.append((time.perf_counter() - start) * 1e6 / rounds)
+                print('%10d %8s %10.1f %14.1f %14.1f %14.1f' % (
+                    (size, name, len(body) / 1024.0) + tuple(timings)))
+    finally:
+        cramjson.CODEC = previous
+
+
+def bench_cramio(port, groups, concurrency, use_async=False):
+    """
+    Configure a 'bench' instance in a temporary directory pointing at the
+    mock server and return its CramIo.
+    """
+    cfg_dir = tempfile.mkdtemp(prefix='crambench')
+    os.environ['CRAMCLUB_CFG_DIR'] = cfg_dir
+    os.environ['CRAMCLUB_LOG_DIR'] = cfg_dir
+    mock_url = 'http://127.0.0.1:%d' % port
+    save_configuration({
+        'instance': 'bench',
+        'secured': True,
+        'civicrm': {'url': mock_url + '/civicrm', 'use_ssl': False,
+                    'site_key': 'bench', 'api_key': 'bench'},
+        'callhub': {'url': mock_url + '/v1', 'api_key': 'bench',
+                    'concurrency': concurrency, 'async': use_async},
+        'http': {'pool_size': max(10, concurrency * 2)},
+        'rocket': {'url': 'https://rocket.example.org'},
+        'timeout': 60,
+        'csv_cache': {'create': True}, # Full CallHub scan every run.
+        'change_detection': {'use': True},
+        'groups': [{'crm': str(group), 'ch': str(crammock.PHONEBOOK_ID_BASE + group)}
+                   for group in range(1, groups + 1)],
+    }, os.path.join(cfg_dir, 'cramclub.bench.yaml'))
+
+    CramLog.initialize(instance='bench', loglevel='ERROR') # pylint: disable-msg=E1101
+    CramCfg.initialize('bench') # pylint: disable-msg=E1101
+    return CramIo(crammock.PlainCrypter())
+
+
+def bench_sync(sizes=(1000, 30000, 100000), groups=2, latency=0.002, concurrency=8,
+               port=crammock.MOCK_PORT, use_async=False):
+    """
+    Time a full CramIo.process_groups run for each dataset size, with
+    `latency` seconds added to every mock API request.
+    Reports wall time, requests made and peak traced memory.
+    """
+    server = crammock.start_server(port)
+    try:
+        cramio = bench_cramio(port, groups, concurrency, use_async)
+        print('process_groups (%d groups, %.3fs latency, concurrency %d%s)' % (
+            groups, latency, concurrency, ', async' if cramio.use_async else ''))
+        print('%10s %10s %10s %10s %12s' % (
+            'contacts', 'seconds', 'requests', 'req/s', 'peak MB'))
+        for size in sizes:
+            crammock.load(port, size=size, groups=groups,
+                          callhub_latency=latency, civicrm_latency=latency)
+            tracemalloc.start()
+            start = time.perf_counter()
+            cramio.process_groups()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            requests = crammock.stats(port)
+            total = sum(requests.values())
+            print('%10d %10.2f %10d %10.1f %12.1f' % (
+                size, elapsed, total, total / elapsed, peak / 1e6))
+            for endpoint, count in sorted(requests.items()):
+                print('%34s  %s' % (count, endpoint))
+            for phase, seconds in sorted(cramio.metrics.summary()['phases'].items()):
+                print('%34.2fs %s' % (seconds, phase))
+    finally:
+        server.terminate()
+
+
+def main(argv):
+    """Run the chosen benchmarks."""
+    parser = argparse.ArgumentParser(description='CramClub benchmarks.')
+    parser.add_argument('bench', nargs='*', choices=['diff', 'fields', 'json', 'sync'],
+                        default=['diff', 'fields', 'json', 'sync'])
+    parser.add_argument('--sizes', type=int, nargs='+', help='contacts per scenario')
+    parser.add_argument('--groups', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per mock request')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='asyncio CallHub client (needs aiohttp)')
+    args = parser.parse_args(argv)
+
+    if 'diff' in args.bench:
+        bench_phonebook_diff(**({'sizes': args.sizes} if args.sizes else {}))
+    if 'fields' in args.bench:
+        bench_contact_ids(**({'sizes': args.sizes} if args.sizes else {}))
+    if 'json' in args.bench:
+        bench_json(**({'sizes': args.sizes} if args.sizes else {}))
+    if 'sync' in args.bench:
+        bench_sync(groups=args.groups, latency=args.latency, concurrency=args.concurrency,
+                   use_async=args.use_async,
+                   **({'sizes': args.sizes} if args.sizes else {}))
+
+
+# MAIN script execution begins here
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,438 @@
+"""
+Persistent CiviCRM => CallHub contact id map.
+"""
+import os
+import csv
+import sys
+import mmap
+import time
+import zlib
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+
+from cramcfg import load_configuration, save_configuration
+
+# Id map snapshot file layout, little endian:
+#   header: magic, format version, flags (0), entry count, CRC-32 of the columns,
+#           padded to 32 bytes so the columns are 8 byte aligned.
+#   columns: crm_id, ch_id, last_seen, digest; 'count' int64 each, sorted by crm_id.
+IDMAP_MAGIC = b'CRAMIDMP'
+IDMAP_VERSION = 1
+IDMAP_COLUMNS = 4
+IDMAP_HEADER = struct.Struct('<8sHHQI8x')
+
+
+class IdMapError(ValueError):
+    """An id map snapshot file that is not usable."""
+
+
+
+def id_int(value):
+    """A contact id as an int. None if it is not a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def new_columns():
+    """Empty crm_id, ch_id, last_seen and digest columns."""
+    return tuple(array('q') for _ in range(IDMAP_COLUMNS))
+
+
+def extend_column(column, cells):
+    """Append an array or int64 memoryview slice to an array('q') column."""
+    if isinstance(cells, memoryview):
+        column.frombytes(cells.cast('B'))
+    else:
+        column.extend(cells)
+
+
+def convert_csv(csv_file_path, idmap_file_path, sync_file_path, logger):
+    """
+    Convert a CSV id cache into an id map snapshot.
+    Entries already in the snapshot are kept unless the CSV replaces them.
+    Returns the number of entries, None if neither file exists.
+    """
+    id_map = CramIdMap(
+        csv_file_path=csv_file_path,
+        idmap_file_path=idmap_file_path,
+        sync_file_path=sync_file_path,
+        logger=logger)
+    if not id_map.load():
+        return None
+    id_map.save()
+    id_map.close()
+    return len(id_map)
+
+
+class CramIdMap(object):
+    """
+    {crm_id: ch_id} map, compact enough for hundreds of thousands of entries.
+    Ids are strings at the interface but numbers inside: CiviCRM ids and
+    CallHub 'pk_str' both fit 64 bit ints. Entries are held in parallel
+    array('q') columns, crm_id, ch_id, last_seen (seconds since the epoch) and
+    digest, sorted by crm_id and searched by bisection.
+    The digest is a hash of the contact's CallHub fields when last pushed,
+    0 if unknown. See cramdiff.contact_digest(). Entries added since the
+    columns were built sit in a small dict until compact() merges them in.
+
+    The map is saved to a binary id map snapshot: a versioned, checksummed
+    header, then each column. Loading memory maps the snapshot and searches
+    the columns in place, so nothing is parsed up front.
+    The CSV cache file is a journal of entries recorded since the last save,
+    rows: crm_id, ch_id, last_seen, digest. A later row for the same crm_id replaces
+    an earlier one. A CSV file with no id map file beside it is imported whole.
+    Sync state (CallHub contact count and scan times) lives in a YAML file.
+    """
+    def __init__(self, csv_file_path, idmap_file_path, sync_file_path, logger):
+        self.csv_file_path = csv_file_path
+        self.idmap_file_path = idmap_file_path
+        self.sync_file_path = sync_file_path
+        self.logger = logger
+        self.write_back = False # Append recorded entries to the CSV file.
+        # Replaced whole, so lookups outside the lock see a consistent set.
+        self.columns = new_columns()
+        self.overlay = {} # {crm_id: (ch_id, last_seen, digest)} not yet in the columns.
+        self.mapping = None # mmap of the snapshot while the columns are views of it.
+        self.added = 0 # Overlay entries that are not in the columns.
+        self.sync = {
+            'count': 0, # CallHub contact total at the last scan.
+            'last_sync': 0, # Time of the last full or delta scan.
+            'last_full': 0, # Time of the last full scan.
+        }
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.columns[0]) + self.added
+
+
+    def __contains__(self, crm_id):
+        return self.lookup(crm_id) is not None
+
+
+    def __getitem__(self, crm_id):
+        entry = self.lookup(crm_id)
+        if entry is None:
+            raise KeyError(crm_id)
+        return str(entry[0])
+
+
+    def __setitem__(self, crm_id, ch_id):
+        """In memory only. See record()."""
+        self.put(crm_id, ch_id, int(time.time()))
+
+
+    def get(self, crm_id, default=None):
+        """As dict.get()"""
+        entry = self.lookup(crm_id)
+        return default if entry is None else str(entry[0])
+
+
+    def items(self):
+        """As dict.items(), in crm_id order."""
+        self.compact()
+        crm_column, ch_column = self.columns[0:2]
+        for crm, ch in zip(crm_column, ch_column):
+            yield str(crm), str(ch)
+
+
+    def lookup(self, crm_id):
+        """(ch_id, last_seen, digest) as ints for a crm_id. None if not mapped."""
+        crm = id_int(crm_id)
+        if crm is None:
+            return None
+        return self.find(crm)
+
+
+    def find(self, crm):
+        """lookup() by int crm_id."""
+        entry = self.overlay.get(crm)
+        if entry is not None:
+            return entry
+        crm_column, ch_column, seen_column, digest_column = self.columns
+        index = bisect_left(crm_column, crm)
+        if index < len(crm_column) and crm_column[index] == crm:
+            return ch_column[index], seen_column[index], digest_column[index]
+        return None
+
+
+    def put(self, crm_id, ch_id, seen, digest=None):
+        """
+        Add or replace an entry. False if either id is not a number,
+        i.e. a ContactID custom field holding something else.
+        With no `digest` the entry's current one is kept, unless it now
+        maps to a different CallHub contact.
+        """
+        crm, ch = id_int(crm_id), id_int(ch_id)
+        if crm is None or ch is None:
+            return False
+        with self.lock:
+            entry = self.find(crm)
+            if entry is None:
+                self.added += 1
+            if digest is None:
+                digest = entry[2] if entry is not None and entry[0] == ch else 0
+            self.overlay[crm] = (ch, seen, digest)
+        return True
+
+
+    def digest(self, crm_id):
+        """Digest stored for a crm_id. 0 if unknown."""
+        entry = self.lookup(crm_id)
+        return 0 if entry is None else entry[2]
+
+
+    def set_digest(self, crm_id, digest):
+        """Store the digest of a mapped crm_id. Returns the previous one."""
+        crm = id_int(crm_id)
+        with self.lock:
+            entry = self.find(crm) if crm is not None else None
+            if entry is None:
+                return 0
+            self.overlay[crm] = (entry[0], entry[1], digest)
+        return entry[2]
+
+
+    def update(self, id_map):
+        """Merge {crm_id: ch_id} entries, all seen now."""
+        now = int(time.time())
+        for crm_id, ch_id in id_map.items():
+            self.put(crm_id, ch_id, now)
+        # Keep the overlay small relative to the columns.
+        if len(self.overlay) > max(1024, len(self.columns[0]) // 4):
+            self.compact()
+
+
+    def keep_digests(self, previous):
+        """
+        Take the digests `previous`, the map this one replaces, holds for
+        entries mapping to the same CallHub contact. A map built by a full
+        scan otherwise has every digest 0. Returns the number kept.
+        """
+        self.compact()
+        kept = 0
+        with self.lock:
+            self.unmap()
+            crm_column, ch_column, _, digest_column = self.columns
+            for index, crm in enumerate(crm_column):
+                entry = previous.find(crm)
+                if entry is not None and entry[0] == ch_column[index] and entry[2]:
+                    digest_column[index] = entry[2]
+                    kept += 1
+        return kept
+
+
+    def compact(self):
+        """Merge the overlay into new sorted columns."""
+        with self.lock:
+            if not self.overlay:
+                return
+            columns = self.columns
+            crm_column = columns[0]
+            merged = new_columns()
+            start = 0
+            for crm in sorted(self.overlay):
+                index = bisect_left(crm_column, crm, start)
+                for column, cells in zip(merged, columns):
+                    extend_column(column, cells[start:index])
+                for column, value in zip(merged, (crm,) + self.overlay[crm]):
+                    column.append(value)
+                # Skip the replaced entry.
+                start = index + 1 if index < len(crm_column) and crm_column[index] == crm \
+                    else index
+            for column, cells in zip(merged, columns):
+                extend_column(column, cells[start:])
+            self.columns = merged
+            self.overlay = {}
+            self.added = 0
+            self.release(columns)
+
+
+    def record(self, crm_id, ch_id, digest=0):
+        """Add an entry and write it back to the CSV journal at once."""
+        now = int(time.time())
+        if not self.put(crm_id, ch_id, now, digest) or not self.write_back:
+            return
+        with self.lock:
+            with open(self.csv_file_path, 'a', newline='') as csvfile:
+                csv.writer(csvfile, dialect='excel').writerow([crm_id, ch_id, now, digest])
+
+
+    def synced(self, count, full):
+        """Note the CallHub contact total found by a full or delta scan."""
+        now = int(time.time())
+        self.sync['count'] = count
+        self.sync['last_sync'] = now
+        if full:
+            self.sync['last_full'] = now
+
+
+    def load(self):
+        """
+        Map the snapshot, apply the CSV journal and read the sync state.
+        Journal entries stay in the overlay, leaving the snapshot mapped,
+        until save() folds them in.
+        False if there is neither a snapshot nor a CSV file, or the snapshot
+        is unusable: a partial map would have every missing contact created
+        again. The map is then rebuilt by a full CallHub scan.
+        """
+        have_idmap = os.path.exists(self.idmap_file_path)
+        if have_idmap and not self.read_idmap():
+            return False
+        have_csv = os.path.exists(self.csv_file_path)
+        if not have_idmap and not have_csv:
+            return False
+        if have_csv:
+            self.read_csv()
+        if not have_idmap:
+            # An older CSV cache holds the whole map.
+            self.compact()
+        if os.path.exists(self.sync_file_path):
+            self.sync.update(load_configuration(self.sync_file_path, self.logger) or {})
+        return True
+
+
+    def read_idmap(self):
+        """
+        Map the snapshot's columns in place.
+        False, with the reason logged, if the file is unusable.
+        """
+        try:
+            with open(self.idmap_file_path, 'rb') as stream:
+                columns, mapping = map_idmap(stream)
+        except (OSError, ValueError, struct.error) as err:
+            self.logger.error('Ignoring id map file %s: %s' % (self.idmap_file_path, str(err)))
+            return False
+        with self.lock:
+            self.release(self.columns)
+            self.columns = columns
+            self.mapping = mapping
+            self.overlay = {}
+            self.added = 0
+        return True
+
+
+    def unmap(self):
+        """Copy mapped columns into memory and close the mapping."""
+        if self.mapping is None:
+            return
+        views = self.columns
+        self.columns = tuple(array('q', view.tobytes()) if isinstance(view, memoryview) else view
+                             for view in views)
+        self.release(views)
+
+
+    def release(self, columns):
+        """
+        Close the mapping once `columns`, views of it, are replaced.
+        Done only while no group is being processed, as a lookup
+        still holding the old views would fail.
+        """
+        if self.mapping is None:
+            return
+        for column in columns:
+            if isinstance(column, memoryview):
+                column.release()
+        self.mapping[1].release()
+        self.mapping[0].close()
+        self.mapping = None
+
+
+    def close(self):
+        """Release the snapshot mapping."""
+        with self.lock:
+            self.unmap()
+
+
+    def read_csv(self):
+        """Apply the CSV file's rows."""
+        with open(self.csv_file_path, 'r', newline='') as csvfile:
+            csv_reader = csv.reader(csvfile, dialect='excel')
+            for row in csv_reader:
+                if len(row) < 2:
+                    continue
+                # Older files have no last seen time or digest.
+                seen = id_int(row[2]) if len(row) > 2 and row[2] else 0
+                digest = id_int(row[3]) if len(row) > 3 and row[3] else 0
+                if seen is None or digest is None:
+                    continue # e.g. a row cut short by a crash.
+                self.put(row[0], row[1], seen, digest)
+
+
+    def save(self):
+        """
+        Rewrite the snapshot and the sync state, then empty the CSV journal.
+        The snapshot is written aside and renamed into place, so a crash
+        leaves the previous one whole.
+        """
+        self.compact()
+        temp_path = self.idmap_file_path + '.tmp'
+        with self.lock:
+            # Windows will not replace a file that is mapped.
+            self.unmap()
+            columns = self.columns
+            if sys.byteorder == 'big':
+                columns = tuple(array('q', column) for column in columns)
+                for column in columns:
+                    column.byteswap()
+            crc = 0
+            for column in columns:
+                crc = zlib.crc32(column, crc)
+            with open(temp_path, 'wb') as stream:
+                stream.write(IDMAP_HEADER.pack(
+                    IDMAP_MAGIC, IDMAP_VERSION, 0, len(columns[0]), crc))
+                for column in columns:
+                    column.tofile(stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(temp_path, self.idmap_file_path)
+            # Everything journalled is in the snapshot now.
+            open(self.csv_file_path, 'w').close()
+        save_configuration(self.sync, self.sync_file_path)
+
+
+def map_idmap(stream):
+    """
+    Check a snapshot's header and checksum, then memory map it.
+    Returns the columns as int64 memoryviews and the (mmap, memoryview)
+    they belong to. Big endian hosts get copies instead, and no mapping.
+    """
+    header = stream.read(IDMAP_HEADER.size)
+    if len(header) < IDMAP_HEADER.size:
+        raise IdMapError('truncated header')
+    magic, version, _flags, count, crc = IDMAP_HEADER.unpack(header)
+    if magic != IDMAP_MAGIC:
+        raise IdMapError('not an id map file')
+    if version != IDMAP_VERSION:
+        raise IdMapError('unsupported version %d' % version)
+    size = IDMAP_HEADER.size + count * IDMAP_COLUMNS * 8
+    if os.fstat(stream.fileno()).st_size != size:
+        raise IdMapError('expected %d bytes for %d entries' % (size, count))
+
+    mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    data = view[IDMAP_HEADER.size:]
+    if zlib.crc32(data) != crc:
+        data.release()
+        view.release()
+        mapped.close()
+        raise IdMapError('checksum mismatch')
+    cells = data.cast('q')
+    data.release()
+    columns = tuple(cells[index * count:(index + 1) * count]
+                    for index in range(IDMAP_COLUMNS))
+    cells.release()
+    if sys.byteorder == 'big':
+        copies = tuple(array('q', column.tobytes()) for column in columns)
+        for column in copies:
+            column.byteswap()
+        for column in columns:
+            column.release()
+        view.release()
+        mapped.close()
+        return copies, None
+    return columns, (mapped, view)
@@ -15,7 +15,7 @@ def load_configuration(file, logger):
     cfg = {}
     with open(file) as stream:
         try:
-            cfg = yaml.load(stream)
+            cfg = yaml.load(stream, Loader=yaml.SafeLoader)
         except yaml.YAMLError as err:
             logger.critical(str(err))
     return cfg
@@ -33,8 +33,14 @@ class CramPath():
     """
     instance = None  # Name of the current running instance i.e. 'prod'.
     csv = None # CSV file path.
+    idmap = None # Binary id map file path.
+    sync = None # CSV cache sync state file path.
+    metrics = None # Run metrics JSON lines file path.
+    prom = None # Run metrics Prometheus text file path.
     groups = None # Group configuration file path.
     stop = None # Stop file path.
+    state = None # Schedule state file path.
+    control = None # Control socket (or TCP port file) path.
     defaults = None # Default values configuration file path.
     configuration = None # Instance configuration file path.
 
@@ -62,7 +68,13 @@ class CramPath():
         self.logger.info('Configuration directory: ' + groot.as_posix())
 
         self.csv = (groot / (APP_NAME + instance + '.csv')).as_posix()
+        self.idmap = (groot / (APP_NAME + instance + '.idmap')).as_posix()
+        self.sync = (groot / (APP_NAME + instance + '.sync.yaml')).as_posix()
         self.stop = (groot / (APP_NAME + instance + '.stop')).as_posix()
+        self.state = (groot / (APP_NAME + instance + '.state.yaml')).as_posix()
+        self.control = (groot / (APP_NAME + instance + '.sock')).as_posix()
+        self.metrics = (groot / (APP_NAME + instance + '.metrics.jsonl')).as_posix()
+        self.prom = (groot / (APP_NAME + instance + '.prom')).as_posix()
         self.groups = (groot / (APP_NAME + '.groups' + instance + '.yaml')).as_posix()
 
         self.defaults = (groot / ('defaults' + instance + '.yaml')).as_posix()
@@ -72,13 +84,17 @@ class CramPath():
 
 
 
-@Singleton
-class CramCfg(object):
-    """Singleton Configuration object."""
+class CramConfig(object):
+    """
+    Configuration of one instance.
+    The command line's instance is the CramCfg singleton; a host
+    (see cramhost) constructs one per hosted instance.
+    """
 
     def __init__(self, instance):
         self.logger = CramLog.instance() # pylint: disable-msg=E1102
         self.paths = CramPath(instance)
+        self.args = None
         self.secure_keys = [
             ('civicrm', 'api_key'),
             ('civicrm', 'site_key'),
@@ -101,7 +117,13 @@ class CramCfg(object):
 
 
         self.cfg['csv_file_path'] = self.paths.csv
+        self.cfg['idmap_file_path'] = self.paths.idmap
+        self.cfg['sync_file_path'] = self.paths.sync
         self.cfg['stop_file_path'] = self.paths.stop
+        self.cfg['state_file_path'] = self.paths.state
+        self.cfg['control_file_path'] = self.paths.control
+        self.cfg['metrics_file_path'] = self.paths.metrics
+        self.cfg['prom_file_path'] = self.paths.prom
         self.logger.log(70, 'Stop file path: ' + self.cfg['stop_file_path'])
         self.logger.log(70, 'Default configuration: ' + self.paths.defaults)
         self.logger.log(70, 'Configuration file path: ' + self.paths.configuration)
@@ -171,6 +193,7 @@ class CramCfg(object):
 
     def update(self, from_args):
         """Command line arguments override everything"""
+        self.args = from_args # Sub-command options, e.g. sync --group.
 
         self.arg_or_cfg(from_args, 'civicrm', 'site_key')
         self.arg_or_cfg(from_args, 'civicrm', 'api_key')
@@ -185,3 +208,7 @@ class CramCfg(object):
         instance = self.cfg['instance']
         self.logger.debug('Instance configuration: "%s"' % (instance or ''))
         assert from_args.instance == instance
+
+
+# The configuration of the instance named on the command line.
+CramCfg = Singleton(CramConfig)
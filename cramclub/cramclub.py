@@ -16,6 +16,7 @@ import argparse
 import cramcmd
 from cramlog import CramLog
 from cramcfg import CramCfg
+from cramconst import HOST_WORKERS, ID_MAP_REUSE_MINUTES
 
 
 def get_args(argv):
@@ -59,6 +60,21 @@ def get_args(argv):
         help='Time of day to run the job. [env] CRAMCLUB_RUNAT')
     parser_start.set_defaults(cmd=cramcmd.start)
 
+    parser_host = subparsers.add_parser(
+        'host',
+        description='Execute several instances\' schedules in one process')
+    parser_host.add_argument(
+        '--instance', '-i', dest='instances', action='append',
+        help='A configuration to run; repeat for each. e.g. -i nsw_state -i nsw_federal',
+        required=True)
+    parser_host.add_argument(
+        '--workers', '-w', type=int, default=HOST_WORKERS,
+        help='Groups processed at once across all instances')
+    parser_host.add_argument(
+        '--reuse', type=float, default=ID_MAP_REUSE_MINUTES,
+        help='Minutes a shared CallHub id map is reused by other instances')
+    parser_host.set_defaults(cmd=cramcmd.host, instance='host')
+
     parser_stop = subparsers.add_parser(
         'stop',
         description='Halt a running updater')
@@ -77,6 +93,34 @@ def get_args(argv):
         required=True)
     parser_restart.set_defaults(cmd=cramcmd.restart)
 
+    parser_sync = subparsers.add_parser(
+        'sync',
+        description='Have the running updater sync now')
+    parser_sync.add_argument(
+        '--instance', '-i',
+        help='Which configuration to use; e.g. "INSTANCE" => cramclub.INSTANCE.yaml',
+        required=True)
+    parser_sync.add_argument('--group', '-g', help='CiviCRM group id. All groups if omitted.')
+    parser_sync.set_defaults(cmd=cramcmd.sync)
+
+    parser_status = subparsers.add_parser(
+        'status',
+        description='Show the running updater\'s schedule and progress')
+    parser_status.add_argument(
+        '--instance', '-i',
+        help='Which configuration to use; e.g. "INSTANCE" => cramclub.INSTANCE.yaml',
+        required=True)
+    parser_status.set_defaults(cmd=cramcmd.status)
+
+    parser_idmap = subparsers.add_parser(
+        'idmap',
+        description='Convert the CSV id cache into the binary id map snapshot')
+    parser_idmap.add_argument(
+        '--instance', '-i',
+        help='Which configuration to use; e.g. "INSTANCE" => cramclub.INSTANCE.yaml',
+        required=True)
+    parser_idmap.set_defaults(cmd=cramcmd.idmap)
+
     parser_test = subparsers.add_parser(
         'test',
         description='Halt a running updater')
@@ -96,6 +140,10 @@ def main(argv):
     """
     args = get_args(argv)
     CramLog.initialize(instance=args.instance, loglevel=args.loglevel) # pylint: disable-msg=E1101
+    if 'instances' in args:
+        # Host mode. Each hosted instance loads its own configuration.
+        args.cmd(args)
+        return
     CramCfg.initialize(args.instance) # pylint: disable-msg=E1101
     config = CramCfg.instance() # pylint: disable-msg=E1101
     config.update(args)
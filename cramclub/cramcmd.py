@@ -8,6 +8,10 @@ from cramcfg import CramCfg, load_configuration, save_configuration
 from cramlog import CramLog
 from cramconst import APP_NAME, RETRY_TIME
 from cramio import CramIo
+from cramsched import CramScheduler
+from cramhost import CramHost
+from cramctl import control_request
+from cramcache import convert_csv
 from cramcrypt import CramCrypt, get_random_bytes
 import cramtest
 
@@ -87,28 +91,92 @@ def start():
         os.remove(cramio.cram.cfg['stop_file_path'])
 
     # Here is where the work really begins
-    while not cramio.stop_process():
-        if cramio.start_process():
-            cramio.process_groups()
-        # Wait a minute before checking again
-        time.sleep(RETRY_TIME)
+    CramScheduler(cramio).run()
     cram.logger.log(70, 'Stopped')
 
 
+def host(args):
+    """
+    Run several instances' schedules in this one process,
+    sharing CallHub clients and id maps between instances on one account.
+    """
+    logger = CramLog.instance() # pylint: disable-msg=E1102
+    logger.log(70, 'Hosting: %s' % ', '.join(args.instances))
+    cram_host = CramHost(args.instances, workers=args.workers, reuse_minutes=args.reuse)
+    logger.log(70, 'Pass phrase accepted. Running ...')
+    cram_host.run()
+    logger.log(70, 'Stopped')
+
+
 def stop():
     """
-    Create the process stop file.
+    Ask the running instance to stop through its control socket,
+    or failing that create the process stop file.
     This creates a stop file in the default configuration directory.
-    The running instance will see it within 1 minute and halt.
+    The running instance will see it within a second, or once
+    its current group is done, and halt.
     """
     logger = CramLog.instance() # pylint: disable-msg=E1102
     logger.log(70, 'Stopping')
 
     cram = CramCfg.instance() # pylint: disable-msg=E1101
+    if control_request(cram.cfg, {'cmd': 'stop'}):
+        return
     with open(cram.cfg['stop_file_path'], 'w') as stop_file:
         stop_file.write('Stop CramClub instance "%s" running' % cram.cfg['instance'])
 
 
+def sync():
+    """Ask the running instance to sync one group, or all, straight away."""
+    cram = CramCfg.instance() # pylint: disable-msg=E1101
+    request = {'cmd': 'sync'}
+    if getattr(cram.args, 'group', None):
+        request['group'] = cram.args.group
+    reply = control_request(cram.cfg, request)
+    if reply is None:
+        cram.logger.critical('No updater running for instance "%s"' % cram.cfg['instance'])
+    elif not reply['ok']:
+        cram.logger.critical(reply['error'])
+    else:
+        print('Queued: %d' % reply['queued'])
+
+
+def status():
+    """Show the running instance's schedule and progress."""
+    cram = CramCfg.instance() # pylint: disable-msg=E1101
+    reply = control_request(cram.cfg, {'cmd': 'status'})
+    if reply is None:
+        print('Not running')
+        return
+    progress = reply['progress']
+    print('Instance: %s' % reply['instance'])
+    print('Running: %s%s' % (
+        'yes, group %s' % progress['group'] if progress['running'] else 'no',
+        ' (stopping)' if reply['stopping'] else ''))
+    print('Groups: %d of %d' % (progress['done'], progress['groups']))
+    print('Contacts: %d' % progress['contacts'])
+    print('Queued syncs: %d' % reply['queued'])
+    print('Next run: %s' % reply['next_run'])
+
+
+def idmap():
+    """
+    Convert the CSV id cache into the binary id map snapshot.
+    Any existing snapshot's entries are kept unless the CSV replaces them.
+    """
+    cram = CramCfg.instance() # pylint: disable-msg=E1101
+    count = convert_csv(
+        csv_file_path=cram.cfg['csv_file_path'],
+        idmap_file_path=cram.cfg['idmap_file_path'],
+        sync_file_path=cram.cfg['sync_file_path'],
+        logger=cram.logger)
+    if count is None:
+        cram.logger.critical('No usable CSV or id map file: %s' % cram.cfg['csv_file_path'])
+    else:
+        cram.logger.log(70, 'Id map: %d entries written to %s' % (
+            count, cram.cfg['idmap_file_path']))
+
+
 def restart():
     """Stops other running instance and then starts running itself."""
     stop()
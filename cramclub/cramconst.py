@@ -5,6 +5,27 @@ Application constants
 APP_NAME = "cramclub"
 
 RETRY_TIME = 60   # seconds
+STOP_POLL_TIME = 1  # seconds between stop file checks while waiting to run
+CATCH_UP_HOURS = 24  # missed runs this recent are run on start up
+
+PARALLEL_GROUPS = 1  # groups processed at once; 1 is one after another
+HOST_WORKERS = 4  # groups processed at once across all hosted instances
+ID_MAP_REUSE_MINUTES = 60  # a shared id map this fresh is not loaded again
+
+CALLHUB_CONCURRENCY = 1  # requests in flight at once; 1 is serial
+CALLHUB_RATE_LIMIT = 0  # requests per second; 0 is unlimited
+CALLHUB_ATTEMPTS = 5  # tries per request on 429, 5xx and connection errors
+CALLHUB_BACKOFF = 1.0  # seconds, doubled on each retry and jittered
+
+CIVICRM_PAGE_SIZE = 1000  # group contacts per request
+CIVICRM_RETRIES = 3
+CIVICRM_WINDOWS = 1  # group pages requested at once by async pulls
+
+HTTP_POOL_SIZE = 10  # keep-alive connections per host
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5  # seconds, doubled on each retry
+HTTP_STATUS_RETRY = (502, 503, 504)
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes read at a time from streamed responses
 
 CUSTOM_FIELDS = 'custom_fields'
 CUSTOM_FIELD_CONTACTID = '2184'
@@ -12,6 +33,19 @@ CUSTOM_FIELD_CONTACTID = '2184'
 CUSTOM_FIELD_FEDERAL = '2170'
 CUSTOM_FIELD_STATE = '2171'
 
+# CiviCRM contact fields read by CallHub.make_callhub_contact_from
+# and the phonebook diff. Group pulls return only these.
+CRM_CONTACT_FIELDS = (
+    'contact_id',
+    'phone',
+    'first_name',
+    'last_name',
+    'email',
+    'street_address',
+    'city',
+    'state_province',
+)
+
 def dot_or_nothing(value):
     """Prefix with a dot (.) if value is not empty."""
     return '.' + value if value else ''
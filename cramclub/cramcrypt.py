@@ -20,13 +20,14 @@ class CramCrypt():
     iv = None
     crypter = None
 
-    def __init__(self, initial_value, salt):
+    def __init__(self, initial_value, salt, passphrase=None):
         """
         `initial_value` base64 encoded bytes[16].
         `salt` base64 encoded bytes[16].
+        `passphrase` is prompted for if not given.
         """
         self.logger = CramLog.instance()  # pylint: disable-msg=E1102
-        self.passphrase = getpass(
+        self.passphrase = passphrase or getpass(
             'Please type the encryption pass phrase and press Enter: ')
         self.iv = initial_value or get_random_bytes(16)
         self.salt = salt or get_random_bytes(16)
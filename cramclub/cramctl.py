@@ -0,0 +1,152 @@
+"""
+Local control socket of a running updater, and its client.
+Requests and replies are single lines of JSON:
+    {"cmd": "sync"}  or  {"cmd": "sync", "group": "CRM_GROUP_ID"}
+    {"cmd": "status"}
+    {"cmd": "stop"}
+A Unix socket is used where available. Elsewhere (Windows) the server
+listens on a localhost TCP port, which the control file records with a
+random token that each request must carry.
+"""
+import os
+import json
+import socket
+import secrets
+import threading
+import socketserver
+
+# Seconds a client waits for a reply.
+CONTROL_TIMEOUT = 10
+
+
+def has_unix_sockets():
+    """True if this platform's Python has Unix domain sockets."""
+    return hasattr(socket, 'AF_UNIX') and hasattr(socketserver, 'UnixStreamServer')
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Answer each request line with a reply line."""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                reply = self.server.control.dispatch(request)
+            except ValueError as err:
+                reply = {'ok': False, 'error': str(err)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class TCPControlServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Localhost TCP control server."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if has_unix_sockets():
+    class UnixControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer): # pylint: disable-msg=E1101
+        """Unix socket control server."""
+        daemon_threads = True
+
+
+class CramControl(object):
+    """
+    Control server for a CramScheduler. Syncs are queued to the scheduler,
+    which runs them between (never during) scheduled runs.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.cramio = scheduler.cramio
+        self.logger = scheduler.logger
+        self.control_file_path = self.cramio.cram.cfg['control_file_path']
+        self.token = None
+        self.server = None
+        self.thread = None
+
+
+    def start(self):
+        """Listen in a background thread. False if another updater is listening."""
+        if control_request(self.cramio.cram.cfg, {'cmd': 'status'}, timeout=1) is not None:
+            self.logger.critical('Control socket in use by another updater: %s' % \
+                self.control_file_path)
+            return False
+        if os.path.exists(self.control_file_path):
+            os.remove(self.control_file_path)
+
+        if has_unix_sockets():
+            self.server = UnixControlServer(self.control_file_path, ControlHandler)
+            os.chmod(self.control_file_path, 0o600)
+        else:
+            self.token = secrets.token_hex(16)
+            self.server = TCPControlServer(('127.0.0.1', 0), ControlHandler)
+            with open(self.control_file_path, 'w') as control_file:
+                json.dump({'port': self.server.server_address[1], 'token': self.token},
+                          control_file)
+            os.chmod(self.control_file_path, 0o600)
+        self.server.control = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.logger.log(70, 'Control socket: %s' % self.control_file_path)
+        return True
+
+
+    def close(self):
+        """Stop listening and remove the control file."""
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        if os.path.exists(self.control_file_path):
+            os.remove(self.control_file_path)
+
+
+    def dispatch(self, request):
+        """Carry out a request. Returns the reply."""
+        if self.token is not None and request.get('token') != self.token:
+            return {'ok': False, 'error': 'bad token'}
+        cmd = request.get('cmd')
+        if cmd == 'sync':
+            group = request.get('group')
+            queued = self.scheduler.request_sync(group)
+            if queued is None:
+                return {'ok': False, 'error': 'unknown group "%s"' % group}
+            self.logger.log(70, 'Sync requested: %s' % ('group %s' % group if group else 'all groups'))
+            return {'ok': True, 'queued': queued}
+        if cmd == 'status':
+            return dict(self.scheduler.status(), ok=True)
+        if cmd == 'stop':
+            self.scheduler.stop()
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown command "%s"' % cmd}
+
+
+def control_request(cfg, request, timeout=CONTROL_TIMEOUT):
+    """
+    Send a request to the instance's running updater.
+    Returns its reply, or None if no updater is listening.
+    """
+    control_file_path = cfg['control_file_path']
+    if not os.path.exists(control_file_path):
+        return None
+    try:
+        if has_unix_sockets():
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) # pylint: disable-msg=E1101
+            connection.settimeout(timeout)
+            connection.connect(control_file_path)
+        else:
+            with open(control_file_path) as control_file:
+                address = json.load(control_file)
+            request = dict(request, token=address['token'])
+            connection = socket.create_connection(('127.0.0.1', address['port']), timeout)
+        with connection:
+            connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            with connection.makefile('rb') as stream:
+                reply = stream.readline()
+    except (OSError, ValueError, KeyError):
+        return None
+    if not reply:
+        return None
+    return json.loads(reply.decode('utf-8'))
@@ -0,0 +1,132 @@
+"""
+Reconcile a CiviCRM group with a CallHub phonebook.
+"""
+import json
+from hashlib import blake2b
+from collections import namedtuple
+
+from cramfields import contact_id
+from cramconst import CUSTOM_FIELDS
+
+
+PhonebookDiff = namedtuple('PhonebookDiff', [
+    'add', # CallHub ids of existing contacts to add to the phonebook, in group order.
+    'remove', # CallHub ids in the phonebook that are no longer in the group.
+    'keep', # CallHub ids in both the phonebook and the group.
+    'create', # CiviCRM contacts with no CallHub contact yet.
+    'numbers', # Contact numbers of the contacts kept in the phonebook.
+    'duplicates', # Count of CiviCRM contacts whose contact number is taken.
+    'update', # (CallHub id, CiviCRM contact) of mapped contacts that have changed.
+])
+
+
+def contact_digest(ch_contact):
+    """
+    Signed 64 bit hash of a CallHub contact's fields, for change detection.
+    Never 0, which the id map uses for unknown.
+    """
+    digest = int.from_bytes(
+        blake2b(json.dumps(ch_contact, sort_keys=True).encode('utf-8'), digest_size=8).digest(),
+        'little', signed=True)
+    return digest or 1
+
+
+def standardise(country_code, region_code, phone_number):
+    """
+    I tried so hard to avoid having to write this.
+    Alas, inadequacies in the CallHub API forced it upon me.
+    This an approximation of the full algorithm they use internally
+    when creating a new contact.
+    """
+    phn = phone_number.replace(' ', '')
+    if len(phn) == 12 and phn[0:3] == (country_code + '0'): # 610?????????
+        phn = country_code + phn[3:]
+    if (len(phn) == 11 and phn[0:3] == (country_code + region_code)) or (
+            len(phn) == 11 and phn[0:3] == (country_code + '4')):
+        return phn  # 612???????? landline or 614????????  mobile number
+    if phn[0:1] == '0':
+        phn = phn[1:]
+    if len(phn) == 9 and phn[0:1] == '4': # 4????????  mobile number
+        return country_code + phn
+    if len(phn) == 9 and phn[0:1] == region_code:
+        phn = phn[1:]  # 2???????? landline
+    if len(phn) == 10 and phn[0:2] == country_code:
+        phn = phn[2:]  # 61???????? landline
+    if len(phn) == 9 and phn[0:1] == region_code: # 2????????
+        phn = phn[1:]
+    if len(phn) == 9 and phn[0:1] == '4': # 4????????  mobile number
+        phn = country_code + phn
+    if len(phn) == 8: # ???????? landline
+        phn = country_code + region_code + phn
+    return phn
+
+
+def phonebook_diff(crm_contacts, ch_contacts, crm_ch_id_map, logger=None, changed=None):
+    """
+    Work out the changes that make a phonebook match a CiviCRM group.
+    The phonebook contacts are indexed once into sets and dicts, then the
+    CiviCRM contacts are read in a single pass, so any iterable will do.
+    CiviCRM contacts not already in the phonebook are marked 'duplicate'
+    when their standardised contact number is taken.
+    `changed(crm_contact, ch_id)`, if given, picks the mapped contacts
+    to update in CallHub.
+    """
+    in_book = set()
+    phone_numbers = set()
+    crm_ids = set()
+    book_numbers = {}
+    for ch_contact in ch_contacts:
+        ch_id = ch_contact['pk_str'] # id as a string value
+        in_book.add(ch_id)
+        book_numbers[ch_id] = ch_contact['contact']
+        phone_numbers.add(ch_contact['contact'])
+        # Collect CiviCRM ContactID fields from existing contacts in the phone-book.
+        if CUSTOM_FIELDS in ch_contact:
+            crm_ids.add(contact_id(ch_contact))
+
+    mapped = set()
+    added = set()
+    add = []
+    create = []
+    update = []
+    duplicates = 0
+    for crm_contact in crm_contacts:
+        crm_id = crm_contact['contact_id']
+        # Don't count contacts already in the phone-book as duplicates.
+        # Also skip empty phone numbers.
+        if crm_id not in crm_ids:
+            phone_number = standardise('61', '2', crm_contact['phone'])
+            if phone_number:
+                duplicate = phone_number in phone_numbers
+                crm_contact['duplicate'] = duplicate
+                if duplicate:
+                    duplicates += 1
+                    if logger:
+                        logger.debug('Duplicate phone number. CiviCRM contact %s.' % crm_id)
+                else:
+                    phone_numbers.add(phone_number)
+
+        ch_id = crm_ch_id_map.get(crm_id)
+        if ch_id:
+            # Phonebook entries of duplicates stay too.
+            mapped.add(ch_id)
+            if changed is not None and changed(crm_contact, ch_id):
+                update.append((ch_id, crm_contact))
+
+        if crm_contact.get('duplicate'):
+            continue
+        if not ch_id:
+            create.append(crm_contact)
+        elif ch_id not in in_book and ch_id not in added:
+            added.add(ch_id)
+            add.append(ch_id)
+
+    keep = in_book & mapped
+    return PhonebookDiff(
+        add=add,
+        remove=in_book - mapped,
+        keep=keep,
+        create=create,
+        numbers=set(book_numbers[ch_id] for ch_id in keep),
+        duplicates=duplicates,
+        update=update)
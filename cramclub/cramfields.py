@@ -0,0 +1,69 @@
+"""
+Decoding of the CallHub contact 'custom_fields' string.
+CallHub returns it as the repr of a Python dict, i.e. "{u'2184': u'12345'}",
+or as JSON for contacts created with it. Only the ContactID is needed,
+so it is matched directly rather than parsing the whole string.
+"""
+import re
+
+from cramconst import CUSTOM_FIELDS, CUSTOM_FIELD_CONTACTID
+
+# The ContactID key, then its value quoted either way with an optional u prefix,
+# or a bare number. Apostrophes in other fields' values do not matter.
+CONTACT_ID_PATTERN = re.compile(
+    r'''['"]%s['"]\s*:\s*(?:u?'([^']*)'|u?"([^"]*)"|(\d+))''' % CUSTOM_FIELD_CONTACTID)
+
+
+def decode_contact_id(custom_fields):
+    """CiviCRM ContactID in a custom_fields string. None if absent."""
+    if CUSTOM_FIELD_CONTACTID not in custom_fields:
+        return None
+    match = CONTACT_ID_PATTERN.search(custom_fields)
+    if match is None:
+        return None
+    quoted, double_quoted, number = match.groups()
+    return quoted if quoted is not None else \
+        double_quoted if double_quoted is not None else number
+
+
+class ContactIdCache(object):
+    """
+    ContactID of CallHub contacts, remembered by 'pk_str'.
+    A cached value is only used while the contact's custom_fields string
+    is unchanged, so edits in CallHub are picked up.
+    """
+    def __init__(self):
+        self.cache = {} # {pk_str: (custom_fields, crm_id)}
+
+
+    def __len__(self):
+        return len(self.cache)
+
+
+    def contact_id(self, ch_contact):
+        """CiviCRM ContactID of a CallHub contact. None if it has none."""
+        custom_fields = ch_contact.get(CUSTOM_FIELDS)
+        if not isinstance(custom_fields, str) or not custom_fields:
+            return None
+        pk_str = ch_contact.get('pk_str')
+        cached = self.cache.get(pk_str)
+        if cached is not None and cached[0] == custom_fields:
+            return cached[1]
+        crm_id = decode_contact_id(custom_fields)
+        if pk_str is not None:
+            self.cache[pk_str] = (custom_fields, crm_id)
+        return crm_id
+
+
+    def clear(self):
+        """Forget all contacts."""
+        self.cache.clear()
+
+
+# Shared by the contact scans and phonebook diffs. Cleared at the end of each run.
+CONTACT_IDS = ContactIdCache()
+
+
+def contact_id(ch_contact):
+    """CiviCRM ContactID custom field of a CallHub contact, memoised."""
+    return CONTACT_IDS.contact_id(ch_contact)
@@ -0,0 +1,94 @@
+"""
+Host mode: several instances' schedules in one process.
+Instances on the same CallHub account share one CallHub session (connections
+and rate limit) and one id map, kept by the first of them, so the account's
+contacts are scanned and held once. All groups are processed on one
+worker pool.
+"""
+import os
+import signal
+import threading
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+
+from cramlog import CramLog
+from cramcfg import CramConfig
+from cramcrypt import CramCrypt
+from cramio import CramIo
+from cramsched import CramScheduler
+from cramconst import STOP_POLL_TIME, HOST_WORKERS, ID_MAP_REUSE_MINUTES
+
+
+class CramHost(object):
+    """
+    Run the schedules of several instances, each in its own thread.
+    The pass phrase is asked for once and used for every instance.
+    """
+    def __init__(self, instances, workers=HOST_WORKERS, reuse_minutes=ID_MAP_REUSE_MINUTES):
+        self.logger = CramLog.instance() # pylint: disable-msg=E1102
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.accounts = {} # {(CallHub url, api key): CramIo of its first instance}
+        self.schedulers = []
+        passphrase = None
+        for instance in instances:
+            cram = CramConfig(instance)
+            if not cram.cfg['secured']:
+                raise RuntimeError('Instance "%s" is not secured' % instance)
+            crypter = CramCrypt(
+                initial_value=b64decode(cram.cfg['iv'].encode('ascii')),
+                salt=b64decode(cram.cfg['salt'].encode('ascii')),
+                passphrase=passphrase)
+            passphrase = crypter.passphrase
+
+            account = (cram.cfg['callhub']['url'], crypter.decrypt(cram.cfg['callhub']['api_key']))
+            lead = self.accounts.get(account)
+            cramio = CramIo(crypter, cram=cram, lead=lead, pool=self.pool)
+            cramio.id_map_reuse = reuse_minutes * 60
+            if lead is None:
+                self.accounts[account] = cramio
+            else:
+                self.logger.log(70, 'Instance "%s" shares the CallHub account of "%s"' % (
+                    instance, lead.cram.cfg['instance']))
+
+            # Clean up from a previous 'stop' command.
+            if cramio.stop_process():
+                os.remove(cram.cfg['stop_file_path'])
+            self.schedulers.append(CramScheduler(cramio))
+        self.logger.log(70, 'Hosting %d instances, %d CallHub accounts, %d workers' % (
+            len(self.schedulers), len(self.accounts), max(1, workers)))
+
+
+    def on_signal(self, signum, frame): # pylint: disable-msg=W0613
+        """Signal handler."""
+        self.logger.log(70, 'Signal %d received. Stopping.' % signum)
+        self.stop()
+
+
+    def stop(self):
+        """Stop every instance."""
+        for scheduler in self.schedulers:
+            scheduler.stop()
+
+
+    def run(self):
+        """
+        Run until every instance has stopped, whether by a signal,
+        its own stop file or control socket.
+        """
+        for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                signal.signal(signum, self.on_signal)
+
+        threads = [
+            threading.Thread(
+                target=scheduler.run, kwargs={'handle_signals': False},
+                name=scheduler.cram.cfg['instance'])
+            for scheduler in self.schedulers]
+        for thread in threads:
+            thread.start()
+        # Joined with a timeout so signals are handled meanwhile.
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(STOP_POLL_TIME)
+        self.pool.shutdown()
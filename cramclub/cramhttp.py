@@ -0,0 +1,96 @@
+"""
+Pooled keep-alive HTTP sessions shared by the CallHub and CiviCRM wrappers.
+"""
+import threading
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry # pylint: disable-msg=E0401
+
+from crammetrics import CramMetrics
+from cramconst import HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, HTTP_STATUS_RETRY
+
+
+class CramAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that remembers the connection pools it has used
+    so connection reuse can be reported.
+    """
+    def __init__(self, **kwargs):
+        self.lock = threading.Lock()
+        self.pools = {}
+        super().__init__(**kwargs)
+
+
+    def send(self, request, **kwargs): # pylint: disable-msg=W0221
+        response = super().send(request, **kwargs)
+        pool = getattr(response.raw, '_pool', None)
+        if pool is not None:
+            with self.lock:
+                self.pools[id(pool)] = pool
+        return response
+
+
+    def stats(self):
+        """Requests made and connections opened across all pools."""
+        with self.lock:
+            pools = list(self.pools.values())
+        requests = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        return {
+            'requests': requests,
+            'connections': connections,
+            'reused': max(0, requests - connections),
+        }
+
+
+def http_config(cfg, service):
+    """
+    Merge the top level 'http' section with the service's own 'http' section.
+    e.g. cfg['http'] overridden by cfg['callhub']['http'].
+    """
+    http_cfg = {}
+    http_cfg.update(cfg.get('http') or {})
+    http_cfg.update(cfg.get(service, {}).get('http') or {})
+    return http_cfg
+
+
+def make_session(cfg, service, headers=None, status_retry=None, record=None):
+    """
+    Build a keep-alive session for `service` ('callhub' or 'civicrm').
+    Configurable per host pool size, adapter retries and default headers.
+    `status_retry` overrides the response status codes the adapter retries.
+    `record` is given each response, CramMetrics' record_response by default.
+    """
+    http_cfg = http_config(cfg, service)
+    pool_size = int(http_cfg.get('pool_size', HTTP_POOL_SIZE))
+    if status_retry is None:
+        status_retry = http_cfg.get('status_retry', HTTP_STATUS_RETRY)
+    retries = Retry(
+        total=int(http_cfg.get('retries', HTTP_RETRIES)),
+        backoff_factor=float(http_cfg.get('backoff', HTTP_BACKOFF)),
+        status_forcelist=status_retry,
+        # Otherwise 429 and 503 with Retry-After are retried regardless.
+        respect_retry_after_header=bool(status_retry),
+        raise_on_status=False)
+    adapter = CramAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retries)
+
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(http_cfg.get('headers') or {})
+    if headers:
+        session.headers.update(headers)
+    # Per endpoint request counts and latencies.
+    session.hooks['response'].append(record or CramMetrics.instance().record_response)
+    return session
+
+
+def session_stats(session):
+    """Connection reuse counters of a session built by make_session()."""
+    adapter = session.get_adapter('https://')
+    if isinstance(adapter, CramAdapter):
+        return adapter.stats()
+    return {'requests': 0, 'connections': 0, 'reused': 0}
@@ -0,0 +1,75 @@
+"""
+aiohttp counterparts of the cramhttp pieces, for the asyncio clients.
+aiohttp is optional: without it has_aiohttp() is False and CramIo uses
+the synchronous clients.
+"""
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from cramjson import loads
+from cramstream import JsonArrayParser, ARRAY_KEYS
+from cramconst import STREAM_CHUNK_SIZE
+
+# aiohttp connection and timeout errors; the counterpart of requests' RequestException.
+ASYNC_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp else ()
+
+
+def has_aiohttp():
+    """True if aiohttp, needed by the asyncio clients, is installed."""
+    return aiohttp is not None
+
+
+async def read_listing(response, keys=ARRAY_KEYS):
+    """
+    As cramstream.load_listing(), for an aiohttp response: its JSON object,
+    the results array built element by element as the body is read.
+    """
+    parser = JsonArrayParser(keys)
+    items = []
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        items.extend(parser.feed(chunk))
+    items.extend(parser.close())
+    listing = dict(parser.fields)
+    if parser.array_key is not None:
+        listing[parser.array_key] = items
+    return listing
+
+
+class AsyncResponse(object):
+    """
+    A fully read aiohttp response, with the parts of requests.Response
+    the CallHub result handling and the run metrics use.
+    `response` is the aiohttp response, `elapsed` in seconds.
+    `listing`, a body already decoded by read_listing(), stands in for `content`.
+    """
+    def __init__(self, method, url, body, response, content, elapsed, listing=None):
+        self.request = SimpleNamespace(method=method.upper(), url=url, body=body)
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.content = content
+        self.listing = listing
+        self.elapsed = timedelta(seconds=elapsed)
+
+
+    @property
+    def ok(self): # pylint: disable-msg=C0103
+        """As requests.Response.ok"""
+        return self.status_code < 400
+
+
+    @property
+    def text(self):
+        """As requests.Response.text"""
+        return self.content.decode('utf-8', 'replace')
+
+
+    def json(self):
+        """As requests.Response.json()"""
+        return self.listing if self.listing is not None else loads(self.content)
@@ -3,12 +3,22 @@ Core update code to pull from CiviCRM and push to club.
 """
 import os
 import time
-import csv
+import asyncio
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
 from cramcfg import CramCfg
 from cramlog import CramLog
-from crampull import CramPull
-from callhub import CallHub
+from crampull import CramPull, CiviCRMPull, GroupTimeout
+from callhub import CallHub, CallHubClient
+from callhub_async import AsyncCallHub
+from cramcache import CramIdMap
+from cramfields import CONTACT_IDS
+from cramhttp import session_stats
+from cramhttp_async import has_aiohttp
+from crammetrics import CramMetrics, RunMetrics
+from cramconst import PARALLEL_GROUPS
 
 
 
@@ -16,37 +26,66 @@ class CramIo(object):
     """
     Core CiviCRM => CallHub processing operations.
     """
-    def __init__(self, crypter):
+    def __init__(self, crypter, cram=None, lead=None, pool=None):
         """
         Uses logger, configuration, CiviCRM and CallHub wrappers.
+        Without `cram` these are the command line instance's singletons.
+        A hosted instance brings its own CramConfig `cram` and gets its own
+        wrappers and metrics, except that it shares the CallHub session, rate limit
+        and id map of `lead`, the first hosted instance on its CallHub account.
+        Groups are then processed on the host's shared `pool`.
         """
         self.logger = CramLog.instance()
-        self.cram = CramCfg.instance()
-
-        CramPull.initialize(crypter)
-        self.crmpull = CramPull.instance()
-
-        CallHub.initialize(crypter)
-        self.club = CallHub.instance()
-        self.crm_ch_id_map = {}
-
+        if cram is None:
+            self.cram = CramCfg.instance()
+            self.metrics = CramMetrics.instance()
+            CramPull.initialize(crypter)
+            self.crmpull = CramPull.instance()
+            CallHub.initialize(crypter)
+            self.club = CallHub.instance()
+        else:
+            self.cram = cram
+            self.metrics = RunMetrics()
+            self.crmpull = CiviCRMPull(crypter, cram, self.metrics)
+            self.club = lead.club.share(cram, self.metrics) if lead is not None else \
+                CallHubClient(crypter, cram, self.metrics)
 
-    def start_process(self):
-        """Check the time to start processing"""
-        when = time.strptime(self.cram.cfg['runat'], '%H:%M')
-        now = time.localtime()
-        start = (
-            now.tm_hour == when.tm_hour and
-            now.tm_min == when.tm_min or (
-                'instance' in self.cram.cfg and
-                self.cram.cfg['instance'] == 'test')
-        )
-        return start
+        self.lead = lead or self # Owner of the CallHub session and id map.
+        self.account_lock = threading.Lock() # The lead's is held by each run.
+        self.pool = pool
+        # Seconds another instance's load of the shared id map stays current.
+        self.id_map_reuse = 0
+        self.id_map_loaded = 0 # When the lead last loaded the id map.
+        self.crm_ch_id_map = None
+        # Groups processed at once. They share the id map, which is thread safe.
+        self.parallel_groups = max(1, int(self.cram.cfg['parallel_groups'])) \
+            if 'parallel_groups' in self.cram.cfg else PARALLEL_GROUPS
+        # Pull from CiviCRM and fetch from CallHub at the same time.
+        self.pipeline = 'pipeline' in self.cram.cfg and self.cram.cfg['pipeline']
+        # Drive runs from an event loop with the asyncio CallHub client.
+        self.use_async = 'async' in self.cram.cfg['callhub'] and self.cram.cfg['callhub']['async']
+        if self.use_async and not has_aiohttp():
+            self.logger.warn('callhub async needs aiohttp. Using the synchronous client.')
+            self.use_async = False
+        self.aclub = None # The asyncio CallHub client of a run in progress,
+        self.acrm = None # its asyncio CiviCRM client,
+        self.loop = None # and its event loop.
+        self.stopping = threading.Event() # Set on a stop signal.
+        self.id_map_ready = False # The id map is loaded and groups may be processed.
+        self.progress_lock = threading.Lock()
+        self.progress = {
+            'running': False,
+            'started': None, # Time the current or last run started.
+            'finished': None,
+            'groups': 0, # Groups in the current or last run.
+            'done': 0, # Groups processed.
+            'group': None, # Phonebook being processed.
+        }
 
 
     def stop_process(self):
-        """Look for process stop file"""
-        return os.path.exists(self.cram.cfg['stop_file_path'])
+        """Stop signalled, or look for process stop file"""
+        return self.stopping.is_set() or os.path.exists(self.cram.cfg['stop_file_path'])
 
 
     def get_contact_ids_map(self):
@@ -68,53 +107,161 @@ class CramIo(object):
             'use' in self.cram.cfg['csv_cache'] and \
             self.cram.cfg['csv_cache']['use']
 
+        refresh_cache = use_cache and \
+            'refresh' in self.cram.cfg['csv_cache'] and \
+            self.cram.cfg['csv_cache']['refresh']
+
+        csv_file_path = self.cram.cfg['csv_file_path'] \
+            if 'csv_file_path' in self.cram.cfg else None
+
+        self.crm_ch_id_map = CramIdMap(
+            csv_file_path=csv_file_path,
+            idmap_file_path=self.cram.cfg['idmap_file_path'],
+            sync_file_path=self.cram.cfg['sync_file_path'],
+            logger=self.logger)
+
         if create_cache or not use_cache:
-            # Retrieve all contacts from CallHub
-            # NB: This can take up to an hour for 30000 contacts.
+            self.scan_contact_ids()
+
+        idmap_file_path = self.cram.cfg['idmap_file_path']
+        if create_cache:
+            self.keep_previous_digests()
+            # Write the generated crm ch id mapping.
+            self.crm_ch_id_map.save()
+            self.logger.info('Created id map cache file: "%s"' % idmap_file_path)
+
+        elif use_cache:
+            # Read the id map, plus any CSV journal (or older CSV cache) entries.
+            self.logger.log(70, 'Using id map cache file: "%s"' % idmap_file_path)
+            if not self.crm_ch_id_map.load():
+                # Rebuild it. The CSV journal only holds entries since the last save.
+                self.logger.error('Id map cache missing or unusable: %s, %s. Scanning CallHub.' % (
+                    idmap_file_path, csv_file_path))
+                self.scan_contact_ids()
+                self.crm_ch_id_map.save()
+            elif refresh_cache:
+                self.refresh_contact_ids()
+
+        # Contacts created from here on are written straight back to the cache.
+        self.crm_ch_id_map.write_back = create_cache or use_cache
+
+        return use_cache or (create_cache and not only_create_cache)
+
+
+    def keep_previous_digests(self):
+        """
+        Carry the change detection digests of the id map being replaced
+        over to the one just built by a full scan, which knows nothing
+        of what was pushed.
+        """
+        previous = CramIdMap(
+            csv_file_path=self.crm_ch_id_map.csv_file_path,
+            idmap_file_path=self.crm_ch_id_map.idmap_file_path,
+            sync_file_path=self.crm_ch_id_map.sync_file_path,
+            logger=self.logger)
+        if previous.load():
+            kept = self.crm_ch_id_map.keep_digests(previous)
+            self.logger.info('Kept %d change detection digests of the previous id map' % kept)
+        previous.close()
+
+
+    def scan_contact_ids(self):
+        """Retrieve all contacts from CallHub into the id map."""
+        # NB: This can take up to an hour for 30000 contacts.
+        start = time.time()
+        if self.loop is not None:
+            # Called from a worker thread of an asyncio run.
+            contacts = asyncio.run_coroutine_threadsafe(self.aclub.contacts(), self.loop).result()
+        else:
+            contacts = self.club.contacts()
+        self.crm_ch_id_map.update(contacts)
+        self.crm_ch_id_map.synced(self.club.contacts_count, full=True)
+        end = time.time()
+        self.logger.info(
+            'Retrieving all club contacts took: %d seconds' % int(end-start))
+
+
+    def refresh_contact_ids(self):
+        """
+        Bring the cached id map up to date with contacts added to CallHub
+        since the last scan. Falls back to a full scan when there is no
+        sync state, or the last full scan is older than 'full_scan_days'.
+        """
+        sync = self.crm_ch_id_map.sync
+        full_scan_days = self.cram.cfg['csv_cache']['full_scan_days'] \
+            if 'full_scan_days' in self.cram.cfg['csv_cache'] else None
+
+        if not sync['last_sync'] or (
+                full_scan_days and time.time() - sync['last_full'] > full_scan_days * 86400):
+            self.scan_contact_ids()
+        else:
             start = time.time()
-            self.crm_ch_id_map = self.club.contacts()
+            found = {}
+            count = self.club.contacts_refresh(found, sync['count'], self.crm_ch_id_map)
+            if count is None:
+                self.logger.warn('CallHub contacts refresh failed. Using cached id map.')
+                return
+            self.crm_ch_id_map.update(found)
+            self.crm_ch_id_map.synced(count, full=False)
             end = time.time()
             self.logger.info(
-                'Retrieving all club contacts took: %d seconds' % int(end-start))
+                'Refreshing club contacts took: %d seconds' % int(end-start))
 
-        if create_cache or use_cache:
-            csv_file_path = self.cram.cfg['csv_file_path'] \
-                if 'csv_file_path' in self.cram.cfg else None
+        self.crm_ch_id_map.save()
 
-        if create_cache:
-            # Write CSV output of the generated crm ch id mapping.
-            with open(csv_file_path, 'w', newline='') as csvfile:
-                csv_writer = csv.writer(csvfile, dialect='excel')
-                for crm_id, ch_id in self.crm_ch_id_map.items():
-                    csv_writer.writerow([crm_id, ch_id])
-                self.logger.info('Created CSV cache file: "%s"' % csv_file_path)
-
-        if use_cache:
-            # Read CSV output of the generated crm ch id mapping.
-            self.logger.log(70, 'Using CSV cache file: "%s"' % csv_file_path)
-            if not os.path.exists(csv_file_path):
-                self.logger.critical('CSV file missing: %s' % csv_file_path)
+
+    def process_group(self, crm_group_id, phonebook_id):
+        """
+        Stream the contact list for the group from CiviCRM,
+        into an update of the corresponding CallHub phonebook.
+        """
+        if self.pipeline:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                self.push_group(
+                    crm_group_id, phonebook_id,
+                    *self.fetch_group(pool, crm_group_id, phonebook_id))
+            return
+
+        self.logger.debug('{crm: "%s", ch: "%s"} CRM group and phone-book' % (crm_group_id, phonebook_id))
+        pages = self.crmpull.group_pages(crm_group_id)
+        try:
+            first_page = next(pages, [])
+            if not first_page:
+                self.logger.info('CiviCRM group %s is empty.' % crm_group_id)
                 return
-            with open(csv_file_path, 'r', newline='') as csvfile:
-                csv_reader = csv.reader(csvfile, dialect='excel')
-                for row in csv_reader:
-                    self.crm_ch_id_map[row[0]] = row[1]
 
-        return use_cache or (create_cache and not only_create_cache)
+            # The whole group is read before the phonebook is changed,
+            # so a timeout part way through leaves the phonebook as it was.
+            self.club.phonebook_update(
+                phonebook_id=phonebook_id,
+                crm_contacts=chain(first_page, chain.from_iterable(pages)),
+                crm_ch_id_map=self.crm_ch_id_map)
+        except GroupTimeout:
+            # Timed out!
+            self.logger.warn('CiviCRM group contacts retrieval timed out. %s' % crm_group_id)
 
 
-    def process_group(self, crm_group_id, phonebook_id):
+    def fetch_group(self, pool, crm_group_id, phonebook_id):
         """
-        Pull the contact list for the group from CiviCRM,
-        then update corresponding CallHub phonebook.
+        Start pulling the CiviCRM group and fetching the CallHub phonebook
+        at the same time. Returns their futures.
         """
+        return (
+            pool.submit(self.crmpull.group, crm_group_id),
+            pool.submit(self.club.phonebook_get_contacts, phonebook_id))
+
+
+    def push_group(self, crm_group_id, phonebook_id, crm_future, ch_future):
+        """Update the phonebook once both fetch_group() futures are done."""
         self.logger.debug('{crm: "%s", ch: "%s"} CRM group and phone-book' % (crm_group_id, phonebook_id))
-        crm_contacts = self.crmpull.group(crm_group_id)
+        crm_contacts = crm_future.result()
+        ch_contacts = ch_future.result()
         if crm_contacts:
             self.club.phonebook_update(
                 phonebook_id=phonebook_id,
                 crm_contacts=crm_contacts,
-                crm_ch_id_map=self.crm_ch_id_map)
+                crm_ch_id_map=self.crm_ch_id_map,
+                ch_contacts=ch_contacts)
         elif crm_contacts is None:
             # Timed out!
             self.logger.warn('CiviCRM group contacts retrieval timed out. %s' % crm_group_id)
@@ -122,16 +269,259 @@ class CramIo(object):
             self.logger.info('CiviCRM group %s is empty.' % crm_group_id)
 
 
-    def process_groups(self):
-        """Loop through all the configured groups and update them."""
-        if not self.get_contact_ids_map():
+    def process_groups_pipelined(self, groups):
+        """
+        Fetch each group's CiviCRM contacts and CallHub phonebook while
+        the previous group is pushed to CallHub.
+        The pulled group is held whole rather than streamed.
+        """
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            pending = None
+            for group in groups:
+                if self.stop_process():
+                    self.logger.info(
+                        'Stopping: Halted prior to phonebook: "%s"' % group['ch'])
+                    break
+                fetching = (group['crm'], group['ch']) + \
+                    self.fetch_group(pool, group['crm'], group['ch'])
+                if pending:
+                    self.run_group(pending[1], self.push_group, *pending)
+                pending = fetching
+            if pending:
+                self.run_group(pending[1], self.push_group, *pending)
+
+
+    def process_groups(self, groups=None, reuse_id_map=False):
+        """
+        Loop through all the configured groups, or just `groups`, and update them.
+        `reuse_id_map` keeps an id map loaded by an earlier run rather than
+        loading it again; entries recorded since are already in it.
+        With callhub 'async' the run is process_groups_async() on a new event loop.
+        """
+        if self.use_async:
+            asyncio.run(self.process_groups_async(groups, reuse_id_map))
             return
+        groups = self.cram.cfg['groups'] if groups is None else groups
+        # Instances sharing a CallHub account take turns.
+        with self.lead.account_lock:
+            # The shared session counts requests in the lead's client's metrics.
+            self.lead.club.metrics = self.metrics
+            self.run_groups(groups, reuse_id_map)
+
+
+    async def process_groups_async(self, groups=None, reuse_id_map=False):
+        """
+        process_groups() driven from the running event loop. CallHub requests
+        are made by an AsyncCallHub and CiviCRM groups pulled by an AsyncCiviCRM;
+        the id map is loaded and saved in worker threads. Up to 'parallel_groups'
+        groups are processed at once.
+        """
+        groups = self.cram.cfg['groups'] if groups is None else groups
+        with self.lead.account_lock:
+            # The shared session counts requests in the lead's client's metrics.
+            self.lead.club.metrics = self.metrics
+            async with AsyncCallHub(self.club) as aclub, self.crmpull.async_api() as acrm:
+                self.aclub, self.acrm, self.loop = aclub, acrm, asyncio.get_event_loop()
+                try:
+                    await self.run_groups_async(groups, reuse_id_map)
+                finally:
+                    self.aclub, self.acrm, self.loop = None, None, None
+
+
+    async def run_groups_async(self, groups, reuse_id_map):
+        """run_groups() on the event loop."""
+        self.metrics.reset()
+        self.progress_update(
+            running=True, started=time.time(), finished=None,
+            groups=len(groups), done=0, group=None)
+        try:
+            await self.loop.run_in_executor(None, self.load_id_map, reuse_id_map)
+            if not self.id_map_ready:
+                return
+
+            self.logger.info('Groups:')
+            parallel = asyncio.Semaphore(self.parallel_groups)
+            await asyncio.gather(*[
+                self.process_group_async(parallel, group) for group in groups])
+
+            if self.crm_ch_id_map.write_back:
+                with self.metrics.phase('id_map'):
+                    await self.loop.run_in_executor(None, self.crm_ch_id_map.save)
+            self.log_http_stats()
+            self.write_metrics()
+        finally:
+            self.run_finished()
 
-        self.logger.info('Groups:')
-        for group in self.cram.cfg['groups']:
+
+    async def process_group_async(self, parallel, group):
+        """
+        Pull the CiviCRM group while the phonebook is fetched,
+        then update the phonebook. False if stopped first.
+        """
+        async with parallel:
             if self.stop_process():
                 self.logger.info(
                     'Stopping: Halted prior to phonebook: "%s"' % group['ch'])
-                break
-            self.process_group(
-                crm_group_id=group['crm'], phonebook_id=group['ch'])
+                return False
+            crm_group_id, phonebook_id = group['crm'], group['ch']
+            self.logger.debug('{crm: "%s", ch: "%s"} CRM group and phone-book' % (
+                crm_group_id, phonebook_id))
+            self.progress_update(group=phonebook_id)
+            crm_contacts, ch_contacts = await asyncio.gather(
+                self.crmpull.group_async(self.acrm, crm_group_id),
+                self.fetch_phonebook_async(phonebook_id))
+            if crm_contacts:
+                await self.aclub.phonebook_update(
+                    phonebook_id=phonebook_id,
+                    crm_contacts=crm_contacts,
+                    crm_ch_id_map=self.crm_ch_id_map,
+                    ch_contacts=ch_contacts)
+            elif crm_contacts is None:
+                # Timed out!
+                self.logger.warn('CiviCRM group contacts retrieval timed out. %s' % crm_group_id)
+            else:
+                self.logger.info('CiviCRM group %s is empty.' % crm_group_id)
+            self.group_done()
+            return True
+
+
+    def load_id_map(self, reuse_id_map):
+        """
+        Have the lead load the id map, unless `reuse_id_map` and it is
+        loaded, or another instance loaded it within `id_map_reuse` seconds.
+        """
+        lead = self.lead
+        reuse = lead.id_map_ready and (
+            reuse_id_map or (lead is not self and \
+                time.time() - lead.id_map_loaded < self.id_map_reuse))
+        if not reuse:
+            with self.metrics.phase('id_map'):
+                lead.id_map_ready = lead.get_contact_ids_map()
+            lead.id_map_loaded = time.time()
+        self.crm_ch_id_map = lead.crm_ch_id_map
+        self.id_map_ready = lead.id_map_ready
+
+        if self.club.change_detection and self.id_map_ready and \
+                not self.crm_ch_id_map.write_back:
+            # Digests are only compared with those of the last run if they are saved.
+            self.logger.warn('change_detection needs csv_cache create or use. Not using it.')
+            self.club.change_detection = False
+
+
+    def run_groups(self, groups, reuse_id_map):
+        """process_groups() holding the CallHub account."""
+        self.metrics.reset()
+        self.progress_update(
+            running=True, started=time.time(), finished=None,
+            groups=len(groups), done=0, group=None)
+        try:
+            self.load_id_map(reuse_id_map)
+            if not self.id_map_ready:
+                return
+
+            self.logger.info('Groups:')
+            if self.pool is not None:
+                # Hosted: the worker pool is shared by all the host's instances.
+                list(self.pool.map(self.process_group_unless_stopped, groups))
+            elif self.parallel_groups > 1:
+                # Each worker checks the stop file before taking its next group.
+                with ThreadPoolExecutor(max_workers=self.parallel_groups) as pool:
+                    list(pool.map(self.process_group_unless_stopped, groups))
+            elif self.pipeline:
+                self.process_groups_pipelined(groups)
+            else:
+                for group in groups:
+                    if not self.process_group_unless_stopped(group):
+                        break
+
+            if self.crm_ch_id_map.write_back:
+                # Fold the journal and the run's content digests into the snapshot.
+                with self.metrics.phase('id_map'):
+                    self.crm_ch_id_map.save()
+            self.log_http_stats()
+            self.write_metrics()
+        finally:
+            self.run_finished()
+
+
+    def run_finished(self):
+        """Mark the run finished and drop what it cached."""
+        self.progress_update(running=False, finished=time.time(), group=None)
+        # Otherwise a daemon or host keeps the ContactID of every CallHub contact it has seen.
+        CONTACT_IDS.clear()
+
+
+    async def fetch_phonebook_async(self, phonebook_id):
+        """All the phonebook's contacts, timed as 'phonebook_fetch'."""
+        async with self.metrics.async_phase('phonebook_fetch'):
+            return await self.aclub.phonebook_get_contacts(phonebook_id)
+
+
+    def progress_update(self, **progress):
+        """Update the run's progress, as reported by the control socket."""
+        with self.progress_lock:
+            self.progress.update(progress)
+
+
+    def group_done(self):
+        """Count a processed group."""
+        with self.progress_lock:
+            self.progress['done'] += 1
+
+
+    def progress_report(self):
+        """Progress of the current or last run, with its contact count so far."""
+        with self.progress_lock:
+            progress = dict(self.progress)
+        progress['contacts'] = self.metrics.contacts
+        return progress
+
+
+    def process_group_unless_stopped(self, group):
+        """Process a configured group. False if the stop file halted it."""
+        if self.stop_process():
+            self.logger.info(
+                'Stopping: Halted prior to phonebook: "%s"' % group['ch'])
+            return False
+        self.run_group(group['ch'], self.process_group, group['crm'], group['ch'])
+        return True
+
+
+    def run_group(self, phonebook_id, push, *args):
+        """Report the group in progress while `push`(*`args`) updates its phonebook."""
+        self.progress_update(group=phonebook_id)
+        push(*args)
+        self.group_done()
+
+
+    def log_http_stats(self):
+        """Report connection reuse for the CiviCRM and CallHub sessions."""
+        for name, session in (('CiviCRM', self.crmpull.session), ('CallHub', self.club.session)):
+            stats = session_stats(session)
+            self.logger.info(
+                '%s HTTP: %d requests, %d connections opened, %d reused' % (
+                    name, stats['requests'], stats['connections'], stats['reused']))
+
+
+    def write_metrics(self):
+        """
+        Log the run's metrics summary and write it out as configured:
+        'json' appends a line per run, 'prometheus' replaces a text file.
+        """
+        self.metrics.finish()
+        summary = self.metrics.summary(self.cram.cfg['instance'])
+        self.logger.info(
+            'Run: %.1f seconds, %d contacts, %.1f contacts/second. Phases: %s' % (
+                summary['seconds'], summary['contacts'], summary['contacts_per_second'],
+                ', '.join('%s %.1fs' % phase for phase in sorted(summary['phases'].items()))))
+
+        metrics_cfg = self.cram.cfg['metrics'] if 'metrics' in self.cram.cfg else {}
+        try:
+            if 'json' in metrics_cfg and metrics_cfg['json']:
+                self.metrics.write_json(
+                    self.cram.cfg['metrics_file_path'], self.cram.cfg['instance'])
+            if 'prometheus' in metrics_cfg and metrics_cfg['prometheus']:
+                self.metrics.write_prometheus(
+                    self.cram.cfg['prom_file_path'], self.cram.cfg['instance'])
+        except OSError as err:
+            self.logger.error('Failed to write metrics: %s' % str(err))
@@ -0,0 +1,48 @@
+"""
+JSON encoding and decoding of API requests and responses.
+orjson is used when installed (pip install orjson), the standard library
+json module otherwise. Both give the same values; orjson encodes without
+spaces after separators, which the APIs do not mind.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec(object):
+    """A named pair of loads(bytes or str) and dumps(obj) -> str functions."""
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+STDLIB = JsonCodec('json', json.loads, json.dumps)
+ORJSON = JsonCodec('orjson', orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8')) \
+    if orjson else None
+
+# Available codecs by name, fastest first.
+CODECS = dict((codec.name, codec) for codec in (ORJSON, STDLIB) if codec)
+
+CODEC = ORJSON or STDLIB
+
+
+def use(name):
+    """Switch to the named codec, e.g. 'json'. Returns the one it replaced."""
+    global CODEC # pylint: disable-msg=W0603
+    previous = CODEC
+    CODEC = CODECS[name]
+    return previous
+
+
+def loads(data):
+    """Decode a JSON document, bytes or str."""
+    return CODEC.loads(data)
+
+
+def dumps(obj):
+    """Encode `obj` as a JSON str."""
+    return CODEC.dumps(obj)
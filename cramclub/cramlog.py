@@ -20,7 +20,7 @@ class CramLog(object):
     def __init__(self, **kwargs):
         # Check for log directory defined by the environment
         if 'CRAMCLUB_LOG_DIR' in os.environ:
-            self.log_dir = os.environ['CRAMCLUB_LOG_DIR']
+            self.log_dir = PurePath(os.environ['CRAMCLUB_LOG_DIR'])
 
         self.instance = 'test'
         if 'instance' in kwargs:
@@ -0,0 +1,222 @@
+"""
+Run metrics: phase timers, HTTP request counts and latencies, throughput.
+"""
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlsplit, parse_qs
+from singleton.singleton import Singleton
+
+from cramconst import APP_NAME
+
+# Request latency histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+def endpoint_name(request):
+    """
+    Group requests by method and path, with numeric ids replaced by {id}.
+    CiviCRM REST calls all share one path so their entity.action is added.
+    """
+    url = urlsplit(request.url)
+    path = re.sub(r'/[0-9]+(?=/|$)', '/{id}', url.path)
+    name = '%s %s' % (request.method, path)
+    if path.endswith('rest.php'):
+        params = parse_qs(url.query)
+        if not params and isinstance(request.body, str):
+            params = parse_qs(request.body)
+        name += ' %s.%s' % (
+            params.get('entity', ['?'])[0], params.get('action', ['?'])[0])
+    return name
+
+
+def label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics(object):
+    """
+    Metrics for one run of process_groups.
+    Phase times are exclusive: time in a nested phase is not counted again
+    by the phase around it. Phases run in parallel threads add up.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+
+    def reset(self):
+        """Start a new run."""
+        with self.lock:
+            self.started = time.time()
+            self.finished = None
+            self.phases = {}
+            self.http = {}
+            self.contacts = 0
+
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as part of phase `name`."""
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+
+
+    @asynccontextmanager
+    async def async_phase(self, name):
+        """
+        phase() for a coroutine. Coroutines interleave on one thread,
+        so these are not nested: time in other phases meanwhile is not taken off.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+
+    def timed(self, iterable, name):
+        """Generate the items of `iterable`, timing each wait as phase `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+    def count_contacts(self, count):
+        """Count CiviCRM contacts processed."""
+        with self.lock:
+            self.contacts += count
+
+
+    def record_response(self, response, *args, **kwargs): # pylint: disable-msg=W0613
+        """requests response hook recording the request's endpoint and latency."""
+        endpoint = endpoint_name(response.request)
+        seconds = response.elapsed.total_seconds()
+        with self.lock:
+            stats = self.http.get(endpoint)
+            if stats is None:
+                stats = self.http[endpoint] = {
+                    'count': 0, 'errors': 0, 'seconds': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS)}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if response.status_code >= 400:
+                stats['errors'] += 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][index] += 1
+                    break
+
+
+    def finish(self):
+        """Mark the end of the run."""
+        self.finished = time.time()
+
+
+    def summary(self, instance=None):
+        """The run's metrics as a JSON ready dict."""
+        with self.lock:
+            seconds = (self.finished or time.time()) - self.started
+            return {
+                'instance': instance,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'seconds': round(seconds, 3),
+                'contacts': self.contacts,
+                'contacts_per_second': round(self.contacts / seconds, 2) if seconds else 0,
+                'phases': dict((name, round(value, 3)) for name, value in self.phases.items()),
+                'http': dict(
+                    (endpoint, {
+                        'count': stats['count'],
+                        'errors': stats['errors'],
+                        'seconds': round(stats['seconds'], 3),
+                        'buckets': dict(zip(
+                            [str(bound) for bound in LATENCY_BUCKETS], stats['buckets'])),
+                    }) for endpoint, stats in self.http.items()),
+            }
+
+
+    def prometheus(self, instance=None):
+        """The run's metrics in Prometheus text exposition format."""
+        summary = self.summary(instance)
+        inst = 'instance_name="%s"' % label(instance or '')
+        lines = [
+            '# HELP %s_run_seconds Duration of the last run.' % APP_NAME,
+            '# TYPE %s_run_seconds gauge' % APP_NAME,
+            '%s_run_seconds{%s} %s' % (APP_NAME, inst, summary['seconds']),
+            '# HELP %s_contacts_processed CiviCRM contacts processed by the last run.' % APP_NAME,
+            '# TYPE %s_contacts_processed gauge' % APP_NAME,
+            '%s_contacts_processed{%s} %d' % (APP_NAME, inst, summary['contacts']),
+            '# HELP %s_contacts_per_second Contacts processed per second.' % APP_NAME,
+            '# TYPE %s_contacts_per_second gauge' % APP_NAME,
+            '%s_contacts_per_second{%s} %s' % (APP_NAME, inst, summary['contacts_per_second']),
+            '# HELP %s_phase_seconds Time spent in each phase of the last run.' % APP_NAME,
+            '# TYPE %s_phase_seconds gauge' % APP_NAME,
+        ]
+        for name, seconds in sorted(summary['phases'].items()):
+            lines.append('%s_phase_seconds{%s,phase="%s"} %s' % (
+                APP_NAME, inst, label(name), seconds))
+
+        lines.extend([
+            '# HELP %s_http_errors HTTP responses with an error status.' % APP_NAME,
+            '# TYPE %s_http_errors gauge' % APP_NAME,
+        ])
+        for endpoint, stats in sorted(summary['http'].items()):
+            lines.append('%s_http_errors{%s,endpoint="%s"} %d' % (
+                APP_NAME, inst, label(endpoint), stats['errors']))
+
+        lines.extend([
+            '# HELP %s_http_request_seconds HTTP request latency per endpoint.' % APP_NAME,
+            '# TYPE %s_http_request_seconds histogram' % APP_NAME,
+        ])
+        for endpoint, stats in sorted(summary['http'].items()):
+            labels = '%s,endpoint="%s"' % (inst, label(endpoint))
+            cumulative = 0
+            for bound, count in stats['buckets'].items():
+                cumulative += count
+                lines.append('%s_http_request_seconds_bucket{%s,le="%s"} %d' % (
+                    APP_NAME, labels, '+Inf' if bound == 'inf' else bound, cumulative))
+            lines.append('%s_http_request_seconds_sum{%s} %s' % (
+                APP_NAME, labels, stats['seconds']))
+            lines.append('%s_http_request_seconds_count{%s} %d' % (
+                APP_NAME, labels, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+
+    def write_json(self, file_path, instance=None):
+        """Append the run's summary as one line of JSON."""
+        with open(file_path, 'a') as stream:
+            stream.write(json.dumps(self.summary(instance), sort_keys=True) + '\n')
+
+
+    def write_prometheus(self, file_path, instance=None):
+        """Replace the Prometheus text file, i.e. for a textfile collector."""
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as stream:
+            stream.write(self.prometheus(instance))
+        os.replace(temp_path, file_path)
+
+
+# Metrics of the command line instance's runs. Hosted instances have their own.
+CramMetrics = Singleton(RunMetrics)
@@ -0,0 +1,455 @@
+"""
+Local stand-ins for the CallHub v1 and CiviCRM REST APIs.
+A single HTTP server answers both:
+    CallHub  http://127.0.0.1:PORT/v1
+    CiviCRM  http://127.0.0.1:PORT/civicrm  (i.e. .../civicrm/extern/rest.php)
+Dataset size and per API latency are set by POST /_mock/load,
+and request counts per endpoint are read from GET /_mock/stats.
+Run standalone: python crammock.py [--port PORT] [--size N] [--groups G]
+"""
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests import get, post
+
+from cramconst import CUSTOM_FIELDS, CUSTOM_FIELD_CONTACTID
+
+MOCK_PORT = 8642
+CH_ID_BASE = 1910874392879957535
+CRM_ID_BASE = 100000
+PHONEBOOK_ID_BASE = 1000
+
+
+class PlainCrypter(object):
+    """Stands in for CramCrypt; configurations of the mock are not secured."""
+    def decrypt(self, value): # pylint: disable-msg=R0201
+        return value
+
+
+def callhub_number(phone):
+    """The mock's stand-in for CallHub's phone number standardisation."""
+    phn = phone.replace(' ', '')
+    return '61' + phn[1:] if phn[0:1] == '0' else phn
+
+
+class MockState(object):
+    """
+    The data behind both APIs.
+    `size` CiviCRM contacts are spread over `groups` groups, numbered from 1.
+    80% already have a CallHub contact, and each group's phonebook holds 70%
+    of those plus stale contacts that have since left the group.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0 # API requests being answered.
+        self.load()
+
+
+    def load(self, size=1000, groups=2, callhub_latency=0.0, civicrm_latency=0.0,
+             page_size=100, civicrm_drops=()):
+        """
+        Build a fresh dataset. `civicrm_drops` numbers the CiviCRM requests,
+        from 1 after the load, answered by closing the connection.
+        """
+        with self.lock:
+            self.callhub_latency = callhub_latency
+            self.civicrm_latency = civicrm_latency
+            self.page_size = page_size
+            self.civicrm_drops = set(civicrm_drops)
+            self.civicrm_requests = 0
+            self.counts = {}
+            self.peak = 0 # Most API requests in flight at once since the load.
+            self.crm_contacts = []
+            self.crm_groups = dict((str(group), []) for group in range(1, groups + 1))
+            self.ch_contacts = {} # pk_str: contact, in creation order
+            self.ch_numbers = {} # contact number: pk_str
+            self.phonebooks = dict(
+                (str(PHONEBOOK_ID_BASE + group), {}) for group in range(1, groups + 1))
+            self.next_ch_id = CH_ID_BASE + size
+
+            for index in range(size):
+                crm_id = str(CRM_ID_BASE + index)
+                group = str(index % groups + 1)
+                # One in fifty shares a mobile number with the contact before.
+                number = index - 1 if index % 50 == 1 else index
+                crm_contact = {
+                    'id': crm_id,
+                    'contact_id': crm_id,
+                    'contact_type': 'Individual',
+                    'sort_name': 'Last%d, First%d' % (index, index),
+                    'display_name': 'First%d Last%d' % (index, index),
+                    'first_name': 'First%d' % index,
+                    'last_name': 'Last%d' % index,
+                    'phone': '04%08d' % number,
+                    'email': 'contact%d@example.org' % index,
+                    'street_address': '%d Example Street' % index,
+                    'city': 'Sydney',
+                    'state_province': 'New South Wales',
+                    'postal_code': '2000',
+                    'country': 'Australia',
+                    'do_not_phone': '0',
+                    'is_deceased': '0',
+                }
+                self.crm_contacts.append(crm_contact)
+                self.crm_groups[group].append(crm_contact)
+
+                if index % 5 == 0:
+                    continue # No CallHub contact yet.
+                ch_contact = self.new_ch_contact(str(CH_ID_BASE + index), crm_contact)
+                phonebook = self.phonebooks[str(PHONEBOOK_ID_BASE + int(group))]
+                if index % 10 < 7:
+                    phonebook[ch_contact['pk_str']] = True
+
+            # Stale phonebook entries, 5% of each group.
+            for stale in range(size // 20):
+                phonebook = self.phonebooks[str(PHONEBOOK_ID_BASE + stale % groups + 1)]
+                ch_contact = self.new_ch_contact(str(self.next_ch_id), {
+                    'contact_id': str(CRM_ID_BASE + size + stale),
+                    'phone': '02%08d' % stale,
+                    'first_name': 'Stale%d' % stale,
+                    'last_name': 'Stale%d' % stale,
+                })
+                self.next_ch_id += 1
+                phonebook[ch_contact['pk_str']] = True
+
+
+    def new_ch_contact(self, pk_str, fields):
+        """Add a CallHub contact made from CiviCRM style fields."""
+        ch_contact = {
+            'url': '/v1/contacts/%s/' % pk_str,
+            'pk_str': pk_str,
+            'contact': callhub_number(fields.get('phone', fields.get('contact', ''))),
+            'first_name': fields.get('first_name', ''),
+            'last_name': fields.get('last_name', ''),
+            'email': fields.get('email', ''),
+            'country_code': 'AU',
+            CUSTOM_FIELDS: "{u'%s': u'%s'}" % (CUSTOM_FIELD_CONTACTID, fields['contact_id'])
+                           if 'contact_id' in fields else fields.get(CUSTOM_FIELDS, '{}'),
+        }
+        self.ch_contacts[pk_str] = ch_contact
+        self.ch_numbers[ch_contact['contact']] = pk_str
+        return ch_contact
+
+
+    def count(self, endpoint):
+        """Count a request to an endpoint."""
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+
+    def drop_civicrm(self):
+        """True if this CiviCRM request is one to drop."""
+        with self.lock:
+            self.civicrm_requests += 1
+            return self.civicrm_requests in self.civicrm_drops
+
+
+    @contextmanager
+    def serving(self):
+        """Count an API request in flight while it is answered."""
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Route requests to the CallHub or CiviCRM stand-in."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't wait on delayed ACKs.
+    disable_nagle_algorithm = True
+    state = None
+
+
+    def log_message(self, format, *args): # pylint: disable-msg=W0622
+        pass
+
+
+    def reply(self, status, content):
+        """Send a JSON response."""
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def body(self):
+        """Read the request body as form fields or JSON."""
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length).decode('utf-8') if length else ''
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(data) if data else {}
+        return dict((key, values[-1]) for key, values in parse_qs(data).items())
+
+
+    def route(self, method):
+        """Dispatch on path prefix."""
+        url = urlsplit(self.path)
+        if url.path.startswith('/_mock/'):
+            self.mock(method, url.path)
+            return
+        with self.state.serving():
+            self.api(method, url)
+
+
+    def api(self, method, url):
+        """Answer a CallHub or CiviCRM request."""
+        query = parse_qs(url.query)
+        if url.path.startswith('/civicrm/'):
+            self.state.count('CiviCRM %s' % method)
+            if self.state.drop_civicrm():
+                # As an overloaded or restarting CiviCRM might.
+                self.close_connection = True
+                return
+            time.sleep(self.state.civicrm_latency)
+            params = query if method == 'GET' else parse_qs(
+                self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+            self.civicrm(dict((key, values if key == 'group' else values[-1])
+                              for key, values in params.items()))
+        elif url.path.startswith('/v1/'):
+            endpoint = re.sub(r'/[0-9]+/', '/{id}/', url.path)
+            self.state.count('CallHub %s %s' % (method, endpoint))
+            time.sleep(self.state.callhub_latency)
+            self.callhub(method, url.path[3:], int(query.get('page', ['1'])[0]))
+        else:
+            self.reply(404, {'detail': 'Not found.'})
+
+
+    def do_GET(self): # pylint: disable-msg=C0103
+        self.route('GET')
+
+
+    def do_POST(self): # pylint: disable-msg=C0103
+        self.route('POST')
+
+
+    def do_PUT(self): # pylint: disable-msg=C0103
+        self.route('PUT')
+
+
+    def do_DELETE(self): # pylint: disable-msg=C0103
+        self.route('DELETE')
+
+
+    def mock(self, method, path):
+        """Control endpoints."""
+        if path == '/_mock/stats':
+            with self.state.lock:
+                self.reply(200, self.state.counts)
+        elif path == '/_mock/load' and method == 'POST':
+            self.state.load(**self.body())
+            self.reply(200, {'contacts': len(self.state.crm_contacts)})
+        else:
+            self.reply(404, {'detail': 'Not found.'})
+
+
+    def page(self, items, page):
+        """Paginate like the CallHub API."""
+        size = self.state.page_size
+        start = (page - 1) * size
+        path = urlsplit(self.path).path
+        return {
+            'count': len(items),
+            'next': ('http://%s:%d%s?page=%d' % (
+                self.server.server_address + (path, page + 1)))
+                    if start + size < len(items) else None,
+            'previous': None,
+            'results': items[start:start + size],
+        }
+
+
+    def callhub(self, method, path, page):
+        """CallHub v1 endpoints used by callhub.py."""
+        state = self.state
+        parts = [part for part in path.split('/') if part]
+        if parts == ['contacts'] and method == 'GET':
+            with state.lock:
+                items = list(state.ch_contacts.values())
+            self.reply(200, self.page(items, page))
+
+        elif parts == ['contacts'] and method == 'POST':
+            fields = self.body()
+            with state.lock:
+                existing = state.ch_numbers.get(callhub_number(fields.get('contact', '')))
+                if existing:
+                    self.reply(400, {
+                        'detail': 'Contact already exists',
+                        'contact': state.ch_contacts[existing]})
+                    return
+                ch_contact = state.new_ch_contact(str(state.next_ch_id), fields)
+                state.next_ch_id += 1
+            self.reply(201, ch_contact)
+
+        elif len(parts) == 2 and parts[0] == 'contacts':
+            with state.lock:
+                ch_contact = state.ch_contacts.get(parts[1])
+                if ch_contact and method == 'PUT':
+                    ch_contact.update(self.body())
+                elif ch_contact and method == 'DELETE':
+                    del state.ch_contacts[parts[1]]
+                    state.ch_numbers.pop(ch_contact['contact'], None)
+            if not ch_contact:
+                self.reply(404, {'detail': 'Not found.'})
+            else:
+                self.reply(200, ch_contact)
+
+        elif len(parts) == 3 and parts[0] == 'phonebooks' and parts[2] == 'contacts':
+            phonebook_id = parts[1]
+            with state.lock:
+                phonebook = state.phonebooks.setdefault(phonebook_id, {})
+                if method == 'GET':
+                    content = self.page(
+                        [state.ch_contacts[ch_id] for ch_id in phonebook
+                         if ch_id in state.ch_contacts], page)
+                else:
+                    contact_ids = self.body().get('contact_ids', [])
+                    for ch_id in contact_ids:
+                        if method == 'POST':
+                            phonebook[str(ch_id)] = True
+                        else:
+                            phonebook.pop(str(ch_id), None)
+                    content = {
+                        'url': '/v1/phonebooks/%s/' % phonebook_id,
+                        'id': int(phonebook_id),
+                        'name': 'Phonebook %s' % phonebook_id,
+                        'count': str(len(phonebook)),
+                    }
+            self.reply(200, content)
+
+        else:
+            self.reply(404, {'detail': 'Not found.'})
+
+
+    def civicrm(self, params):
+        """
+        CiviCRM v3 extern/rest.php, Contact and CustomValue get actions,
+        with id IN lists, chained CustomValue gets and api3.call batches.
+        """
+        if str(params.get('json', '')).startswith('{'):
+            params = dict(params, **json.loads(params['json']))
+        entity = params.get('entity')
+        action = params.get('action')
+        if entity == 'api3' and action == 'call':
+            calls = json.loads(params['json'])
+            results = dict(
+                (name, self.civicrm_result(dict(call[2], entity=call[0], action=call[1])))
+                for name, call in calls.items())
+            # Alongside the results of the calls, as CiviCRM's own.
+            results.update(is_error=0, count=len(calls))
+            self.reply(200, results)
+        else:
+            self.reply(200, self.civicrm_result(params))
+
+
+    def civicrm_result(self, params):
+        """The result of one CiviCRM call."""
+        state = self.state
+        entity = params.get('entity')
+        action = params.get('action')
+        if entity == 'CustomValue' and action == 'get':
+            values = [{'id': '1', 'entity_id': str(params.get('entity_id')), 'latest': 'Sydney'}]
+            return {'is_error': 0, 'version': 3, 'count': len(values), 'values': values}
+        if entity != 'Contact' or action not in ('get', 'getcount'):
+            return {'is_error': 1, 'error_message': 'Not implemented'}
+
+        if 'group' in params:
+            contacts = []
+            for group in params['group']:
+                contacts.extend(state.crm_groups.get(group, []))
+        elif isinstance(params.get('id'), dict):
+            ids = set(str(crm_id) for crm_id in params['id']['IN'])
+            contacts = [c for c in state.crm_contacts if c['id'] in ids]
+        elif 'id' in params:
+            contacts = [c for c in state.crm_contacts if c['id'] == str(params['id'])]
+        else:
+            contacts = state.crm_contacts
+        if action == 'getcount':
+            return {'is_error': 0, 'version': 3, 'result': len(contacts)}
+
+        offset = int(params.get('options[offset]', 0))
+        limit = int(params.get('options[limit]', 25))
+        contacts = contacts[offset:offset + limit] if limit else contacts[offset:]
+        if 'return' in params:
+            fields = set(params['return'].split(',')) | set(['id', 'contact_id'])
+            contacts = [dict((key, value) for key, value in c.items() if key in fields)
+                        for c in contacts]
+        if 'api.CustomValue.get' in params:
+            contacts = [dict(c, **{'api.CustomValue.get': self.civicrm_result(
+                {'entity': 'CustomValue', 'action': 'get', 'entity_id': c['id']})})
+                        for c in contacts]
+        return {'is_error': 0, 'version': 3, 'count': len(contacts), 'values': contacts}
+
+
+def serve(port=MOCK_PORT, **load):
+    """Run the mock server until interrupted."""
+    MockHandler.state = MockState()
+    if load:
+        MockHandler.state.load(**load)
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def serve_in_thread(port=0):
+    """
+    Serve from a daemon thread of this process, e.g. for tests.
+    Port 0 takes a free port. Returns the server; see its server_address.
+    """
+    MockHandler.state = MockState()
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(port=MOCK_PORT):
+    """
+    Serve from a child process so the mock does not compete for the
+    benchmark's interpreter lock. Returns the process once it answers.
+    """
+    process = multiprocessing.Process(target=serve, kwargs={'port': port}, daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            stats(port)
+            return process
+        except IOError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Mock server did not start on port %d' % port)
+
+
+def load(port=MOCK_PORT, **kwargs):
+    """Replace the mock dataset. See MockState.load()."""
+    return post('http://127.0.0.1:%d/_mock/load' % port, json=kwargs).json()
+
+
+def stats(port=MOCK_PORT):
+    """Requests per endpoint since the last load."""
+    return get('http://127.0.0.1:%d/_mock/stats' % port).json()
+
+
+# MAIN script execution begins here
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description='CallHub and CiviCRM mock server.')
+    PARSER.add_argument('--port', type=int, default=MOCK_PORT)
+    PARSER.add_argument('--size', type=int, default=1000)
+    PARSER.add_argument('--groups', type=int, default=2)
+    PARSER.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    ARGS = PARSER.parse_args(sys.argv[1:])
+    serve(ARGS.port, size=ARGS.size, groups=ARGS.groups,
+          callhub_latency=ARGS.latency, civicrm_latency=ARGS.latency)
@@ -1,44 +1,77 @@
 """
 Retrieve CiviCRM group contact list data.
 """
+import asyncio
 from base64 import b64decode
-from requests.exceptions import ReadTimeout, ConnectionError
+from requests.exceptions import ReadTimeout, ConnectionError, ChunkedEncodingError
 from singleton.singleton import Singleton
 
 from civicrm.civicrm import CiviCRM
+from civicrm.civicrm_async import AsyncCiviCRM
 from cramcfg import CramCfg
 from cramlog import CramLog
 from cramcrypt import CramCrypt
+from cramstream import JsonArrayParser
+from cramjson import loads
+from cramhttp import make_session, http_config
+from cramhttp_async import AsyncResponse, ASYNC_ERRORS
+from crammetrics import CramMetrics
+from cramconst import CIVICRM_PAGE_SIZE, CIVICRM_RETRIES, CIVICRM_WINDOWS, CRM_CONTACT_FIELDS, \
+    HTTP_POOL_SIZE
 
 
+# Chained call returning a contact's custom field values with the contact.
+CUSTOM_VALUES = 'api.CustomValue.get'
 
-@Singleton
-class CramPull(object):
+
+class GroupTimeout(RuntimeError):
+    """CiviCRM group contacts retrieval gave up after repeated failures."""
+
+
+
+class CiviCRMPull(object):
     """
     CiviCRM API wrapper class.
     Restricted to pulling information only.
     """
     _api = None
 
-    def __init__(self, crypter):
+    def __init__(self, crypter, cram=None, metrics=None):
         """
         Set up logger and keys from config.
         Load CiviCRM instance.
+        `cram` and `metrics` default to the CramCfg and CramMetrics singletons.
         """
-        cram = CramCfg.instance() # pylint: disable-msg=E1101
+        cram = cram or CramCfg.instance() # pylint: disable-msg=E1101
 
         self.logger = CramLog.instance() # pylint: disable-msg=E1102
         self.rocket_url = cram.cfg['rocket']['url']
+        # Group contacts are retrieved this many at a time.
+        self.page_size = int(cram.cfg['civicrm']['page_size']) \
+            if 'page_size' in cram.cfg['civicrm'] else CIVICRM_PAGE_SIZE
+        # Contact fields returned by group pulls, plus any configured extras.
+        self.return_fields = list(CRM_CONTACT_FIELDS)
+        if 'extra_fields' in cram.cfg['civicrm']:
+            self.return_fields.extend(cram.cfg['civicrm']['extra_fields'])
+        # Pages of a group requested at once by group_async().
+        self.windows = max(1, int(cram.cfg['civicrm']['windows'])) \
+            if 'windows' in cram.cfg['civicrm'] else CIVICRM_WINDOWS
+        # Connections, and so requests in flight, of an async_api().
+        self.pool_size = int(http_config(cram.cfg, 'civicrm').get('pool_size', HTTP_POOL_SIZE))
 
         site_key = crypter.decrypt(cram.cfg['civicrm']['site_key'])
         api_key = crypter.decrypt(cram.cfg['civicrm']['api_key'])
 
+        self.metrics = metrics or CramMetrics.instance()
+        self.session = make_session(cram.cfg, 'civicrm', record=self.metrics.record_response)
         self._api = CiviCRM(
             url=cram.cfg['civicrm']['url'],
             site_key=site_key,
             api_key=api_key,
-            use_ssl=True,
-            timeout=cram.cfg['timeout'])
+            use_ssl=cram.cfg['civicrm']['use_ssl'] if 'use_ssl' in cram.cfg['civicrm'] else True,
+            timeout=cram.cfg['timeout'],
+            session=self.session,
+            loads=loads)
 
 
     def sanitise_crm_contact(self, crm_contact):
@@ -49,50 +82,174 @@ class CramPull(object):
         )
 
 
+    def custom_values(self, crm_contact):
+        """
+        Move the chained CustomValue results of a contact
+        to crm_contact['custom'], keyed by custom field id.
+        """
+        crm_contact['custom'] = dict(
+            (field['id'], field['latest']) for field in self._api.chained(crm_contact, 'CustomValue'))
+        return crm_contact
+
+
     def contact(self, crm_id):
-        """ Retrieve a single contact. """
-        response = self._api.get('Contact', id=crm_id)
+        """ Retrieve a single contact with its custom values, in one request. """
+        response = self._api.get('Contact', id=crm_id, **{CUSTOM_VALUES: {}})
         contact = {}
         if response:
-            contact = response[0]
+            contact = self.custom_values(response[0])
             #self.logger.debug('Contact: {:s}'.format(self.sanitise_crm_contact(contact)))
-            fields = self._api.get('CustomValue', entity_id=crm_id)
-            #self.logger.debug('Custom data: {:s}'.format(str(fields)))
-            contact['custom'] = {}
-            for field in fields:
-                contact['custom'][field['id']] = field['latest']
+            #self.logger.debug('Custom data: {:s}'.format(str(contact['custom'])))
         return contact
 
 
-    def group(self, group_id):
-        """ Retrieve all contacts in a group. """
+    def contacts(self, crm_ids):
+        """
+        Retrieve contacts with their custom values, 'page_size' per request,
+        e.g. for the ids of a whole group. Ordered by id.
+        """
+        crm_ids = list(crm_ids)
         contacts = []
-        retry_count = 0
-        while retry_count < 3:
-            try:
-                contacts = self._api.get(
+        for start in range(0, len(crm_ids), self.page_size):
+            page_ids = crm_ids[start:start + self.page_size]
+            with self.metrics.phase('civicrm_pull'):
+                contacts.extend(self.custom_values(contact) for contact in self._api.iter_get(
                     'Contact',
-                    group=[group_id],
-                    limit=5000,
-                    offset=0)
+                    JsonArrayParser(),
+                    id={'IN': page_ids},
+                    limit=len(page_ids),
+                    **{'options[sort]': 'id', 'return': ','.join(self.return_fields), CUSTOM_VALUES: {}}))
+        return contacts
 
-                self.logger.info('Contacts: {:d}'.format(len(contacts)))
-                break
 
-            except ReadTimeout as err:
-                if retry_count < 3:
+    def group_page(self, group_id, offset):
+        """
+        Retrieve one page of group contacts, retrying it on its own.
+        Raises GroupTimeout once the retries are exhausted.
+        """
+        retry_count = 0
+        while True:
+            try:
+                with self.metrics.phase('civicrm_pull'):
+                    contacts = list(self._api.iter_get(
+                        'Contact',
+                        JsonArrayParser(),
+                        group=[group_id],
+                        limit=self.page_size,
+                        offset=offset,
+                        **{'options[sort]': 'id', 'return': ','.join(self.return_fields)}))
+                self.metrics.count_contacts(len(contacts))
+                return contacts
+
+            except (ReadTimeout, ConnectionError, ChunkedEncodingError) as err:
+                # 'Connection aborted.', ConnectionResetError
+                # 10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None
+                retry_count += 1
+                if retry_count < CIVICRM_RETRIES:
                     self.logger.warn('%s. Retrying... %d' % (str(err), retry_count))
                 else:
                     self.logger.critical(str(err))
-                retry_count += 1
+                    raise GroupTimeout('Group %s at offset %d: %s' % (group_id, offset, str(err)))
 
-            except ConnectionError as conn_err:
-                # 'Connection aborted.', ConnectionResetError
-                # 10054, 'An existing connection was forcibly closed by the remote host', None, 10054, None
-                if retry_count < 3:
-                    self.logger.warn('%s. Retrying... %d' % (str(conn_err), retry_count))
-                else:
-                    self.logger.critical(str(conn_err))
+
+    def group_pages(self, group_id):
+        """
+        Generate the contacts in a group a page (list) at a time,
+        walking 'offset' in 'page_size' chunks.
+        """
+        offset = 0
+        while True:
+            contacts = self.group_page(group_id, offset)
+            self.logger.debug('Contacts: {:d} at offset {:d}'.format(len(contacts), offset))
+            if contacts:
+                yield contacts
+            if len(contacts) < self.page_size:
+                return
+            offset += self.page_size
+
+
+    def async_api(self):
+        """
+        An AsyncCiviCRM for this site, with its own connection pool.
+        Create and close it within the event loop using it.
+        """
+        return AsyncCiviCRM(
+            url=self._api.urlstring,
+            site_key=self._api.site_key,
+            api_key=self._api.api_key,
+            use_ssl=self._api.use_ssl,
+            timeout=self._api.timeout,
+            loads=loads,
+            concurrency=self.pool_size,
+            on_response=self.record_async_response)
+
+
+    def record_async_response(self, response, content, elapsed):
+        """AsyncCiviCRM response hook; counts the request in the metrics."""
+        self.metrics.record_response(
+            AsyncResponse(response.method, str(response.url), None, response, content, elapsed))
+
+
+    async def group_page_async(self, api, group_id, offset):
+        """group_page() through the AsyncCiviCRM `api`."""
+        retry_count = 0
+        while True:
+            try:
+                async with self.metrics.async_phase('civicrm_pull'):
+                    contacts = [contact async for contact in api.iter_get(
+                        'Contact',
+                        JsonArrayParser(),
+                        group=[group_id],
+                        limit=self.page_size,
+                        offset=offset,
+                        **{'options[sort]': 'id', 'return': ','.join(self.return_fields)})]
+                self.metrics.count_contacts(len(contacts))
+                return contacts
+
+            except ASYNC_ERRORS as err:
                 retry_count += 1
+                message = str(err) or type(err).__name__
+                if retry_count < CIVICRM_RETRIES:
+                    self.logger.warn('%s. Retrying... %d' % (message, retry_count))
+                else:
+                    self.logger.critical(message)
+                    raise GroupTimeout('Group %s at offset %d: %s' % (group_id, offset, message))
+
+
+    async def group_async(self, api, group_id):
+        """
+        group() through the AsyncCiviCRM `api`, requesting 'windows'
+        pages at once. None if retrieval timed out.
+        """
+        contacts = []
+        offset = 0
+        try:
+            while True:
+                pages = await asyncio.gather(*[
+                    self.group_page_async(api, group_id, offset + window * self.page_size)
+                    for window in range(self.windows)])
+                for page in pages:
+                    contacts.extend(page)
+                    if len(page) < self.page_size:
+                        self.logger.info('Contacts: {:d}'.format(len(contacts)))
+                        return contacts
+                offset += self.windows * self.page_size
+        except GroupTimeout:
+            return None
 
+
+    def group(self, group_id):
+        """ Retrieve all contacts in a group. None if retrieval timed out. """
+        contacts = []
+        try:
+            for page in self.group_pages(group_id):
+                contacts.extend(page)
+        except GroupTimeout:
+            return None
+
+        self.logger.info('Contacts: {:d}'.format(len(contacts)))
         return contacts
+
+
+# The puller of the command line instance.
+CramPull = Singleton(CiviCRMPull)
@@ -0,0 +1,184 @@
+"""
+Request scheduling for rate limited web APIs.
+"""
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from requests import exceptions
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def retry_after(response):
+    """Seconds to wait given by a Retry-After header, None if absent."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    Allow `rate` requests per second on average, in bursts of up to `burst`.
+    A rate of 0 or None is unlimited.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def take(self):
+        """Take a token if there is one. Returns 0, or the seconds until there is."""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+    def acquire(self):
+        """Wait for and take a token."""
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+
+class AdaptiveLimit(object):
+    """
+    Limit on requests in flight. It grows by one after a limit's worth of
+    successes in a row and halves whenever the API throttles a request,
+    staying between 1 and `maximum`.
+    """
+    def __init__(self, initial, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = min(max(1, initial), self.maximum)
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+
+    def acquire(self):
+        """Wait for room under the limit."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+
+    def try_acquire(self):
+        """Take room under the limit if there is any. False if not."""
+        with self.condition:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+
+    def release(self, throttled):
+        """Finished a request; adjust the limit by its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class RequestScheduler(object):
+    """
+    Central gate for every request to one API.
+    Requests take a token bucket token and a place under the adaptive
+    concurrency limit. 429 and 5xx responses and connection errors are
+    retried with jittered exponential backoff, or after the Retry-After
+    time, and a 429 also pauses every other request for that time.
+    """
+    def __init__(self, session, logger, rate=None, burst=1, concurrency=1,
+                 max_concurrency=1, attempts=5, backoff=1.0, max_backoff=60.0, timeout=None):
+        self.session = session
+        self.logger = logger
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = AdaptiveLimit(concurrency, max_concurrency)
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+
+    def backoff_delay(self, attempt):
+        """Full jitter exponential backoff for the given attempt number."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+    def pause(self, delay):
+        """Hold back all requests for `delay` seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+
+
+    def wait_for_pause(self):
+        """Hold off while the API is throttling requests."""
+        delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def request(self, method, url, **kwargs):
+        """
+        As requests.Session.request(), scheduled and retried.
+        Returns the last response, or raises the last connection error.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(1, self.attempts + 1):
+            self.wait_for_pause()
+            self.bucket.acquire()
+            self.limit.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (exceptions.ConnectionError, exceptions.Timeout) as err:
+                self.limit.release(throttled=False)
+                if attempt == self.attempts:
+                    raise
+                delay = self.backoff_delay(attempt)
+                self.logger.warn('%s. Retrying in %.1f seconds... %d' % (str(err), delay, attempt))
+                time.sleep(delay)
+                continue
+
+            throttled = response.status_code == 429
+            self.limit.release(throttled)
+            if response.status_code not in RETRY_STATUS or attempt == self.attempts:
+                return response
+
+            delay = retry_after(response)
+            if delay is None:
+                delay = self.backoff_delay(attempt)
+            response.close() # Streamed responses hold their connection until closed.
+            if throttled:
+                self.pause(delay)
+            self.logger.warn('%s %s: HTTP Error %d. Retrying in %.1f seconds... %d' % (
+                method.upper(), url, response.status_code, delay, attempt))
+            time.sleep(delay)
+        return response
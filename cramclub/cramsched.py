@@ -0,0 +1,297 @@
+"""
+Run schedule: fire times from 'runat' entries, then sleeping until each.
+"""
+import os
+import re
+import time
+import queue
+import signal
+import threading
+from datetime import datetime, timedelta
+
+from cramcfg import load_configuration, save_configuration
+from cramctl import CramControl
+from cramconst import STOP_POLL_TIME, CATCH_UP_HOURS
+
+# Minute, hour, day of month, month, day of week (0 or 7 is Sunday).
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def cron_field(text, low, high):
+    """
+    Values matched by one cron field: '*', 'a', 'a-b', with an optional
+    '/step', in a comma separated list. 'a/step' runs from a to the top.
+    """
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-', 1)]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('cron field "%s" outside %d-%d' % (text, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronEntry(object):
+    """
+    One schedule entry: a 24h 'HH:MM' time of day, or a five field cron
+    expression, 'minute hour day-of-month month day-of-week'.
+    As cron, when both day fields are restricted either one matching will do.
+    """
+    def __init__(self, text):
+        self.text = text.strip()
+        if re.match(r'^\d{1,2}:\d{2}$', self.text):
+            when = time.strptime(self.text, '%H:%M')
+            fields = [str(when.tm_min), str(when.tm_hour), '*', '*', '*']
+        else:
+            fields = self.text.split()
+            if len(fields) != 5:
+                raise ValueError('runat "%s" is neither HH:MM nor a cron expression' % self.text)
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_RANGES)]
+        if 7 in weekdays:
+            weekdays.add(0)
+        self.weekdays = weekdays
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+
+    def day_matches(self, when):
+        """True if the date of `when` is a day this entry runs."""
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays # cron Sunday is 0.
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+    def next_after(self, when):
+        """First fire time after `when`. None if there is none in five years."""
+        when = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=5 * 366)
+        while when < limit:
+            if when.month not in self.months:
+                when = (when.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        return None
+
+
+class Schedule(object):
+    """
+    The fire times of several entries. 'runat' is a list of entries,
+    or a string of them separated by ';'.
+    e.g. ['03:00', '30 12 * * 1-5'] or '03:00; 30 12 * * 1-5'
+    """
+    def __init__(self, runat):
+        if isinstance(runat, str):
+            runat = runat.split(';')
+        self.entries = [CronEntry(str(entry)) for entry in runat if str(entry).strip()]
+        if not self.entries:
+            raise ValueError('runat has no entries')
+
+
+    def __str__(self):
+        return '; '.join(entry.text for entry in self.entries)
+
+
+    def next_after(self, when):
+        """First fire time of any entry after `when`. None if none ever fire."""
+        times = [fire for fire in (entry.next_after(when) for entry in self.entries) if fire]
+        return min(times) if times else None
+
+
+    def latest(self, since, now):
+        """Latest fire time after `since` and no later than `now`. None if none."""
+        latest = None
+        fire = self.next_after(since)
+        while fire is not None and fire <= now:
+            latest = fire
+            fire = self.next_after(fire)
+        return latest
+
+
+
+class CramScheduler(object):
+    """
+    Sleep until each scheduled run and process the groups.
+    Stops promptly on SIGINT, SIGTERM (SIGBREAK on Windows) or the stop file,
+    which is checked every STOP_POLL_TIME seconds while waiting.
+    The last scheduled run is kept in the state file, so runs missed while
+    not running, or passed during a long run, are caught up with once
+    if within 'catch_up_hours'.
+    Syncs requested through the control socket are run while waiting,
+    with the id map already loaded.
+    """
+    def __init__(self, cramio):
+        self.cramio = cramio
+        self.cram = cramio.cram
+        self.logger = cramio.logger
+        runat = self.cram.cfg['runat']
+        if self.cram.cfg['instance'] == 'test':
+            runat = '* * * * *' # Every minute.
+        self.schedule = Schedule(runat)
+        self.catch_up = timedelta(hours=float(self.cram.cfg['catch_up_hours'])) \
+            if 'catch_up_hours' in self.cram.cfg else timedelta(hours=CATCH_UP_HOURS)
+        self.state_file_path = self.cram.cfg['state_file_path']
+        self.state = {
+            'last_run': 0, # When the last run finished.
+            'last_scheduled': 0, # Fire time of the last run.
+        }
+        if os.path.exists(self.state_file_path):
+            self.state.update(load_configuration(self.state_file_path, self.logger) or {})
+        self.next_run = None
+        self.requests = queue.Queue() # Groups to sync on request; None for all.
+        self.wake = threading.Event() # Set on a request or a stop.
+        control_cfg = self.cram.cfg['control'] if 'control' in self.cram.cfg else {}
+        self.control = CramControl(self) \
+            if 'use' not in control_cfg or control_cfg['use'] else None
+
+
+    def install_signal_handlers(self):
+        """Stop on the usual termination signals. Main thread only."""
+        for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                signal.signal(signum, self.on_signal)
+
+
+    def on_signal(self, signum, frame): # pylint: disable-msg=W0613
+        """Signal handler."""
+        self.logger.log(70, 'Signal %d received. Stopping.' % signum)
+        self.stop()
+
+
+    def stop(self):
+        """Stop waiting, and stop a run before its next group."""
+        self.cramio.stopping.set()
+        self.wake.set()
+
+
+    def request_sync(self, crm_group_id=None):
+        """
+        Queue a sync of one configured group, by CiviCRM group id, or of all.
+        Returns the number of syncs queued, None for an unknown group.
+        """
+        groups = None
+        if crm_group_id is not None:
+            groups = [group for group in self.cram.cfg['groups']
+                      if str(group['crm']) == str(crm_group_id)]
+            if not groups:
+                return None
+        self.requests.put(groups)
+        self.wake.set()
+        return self.requests.qsize()
+
+
+    def status(self):
+        """Schedule and progress, for the control socket."""
+        return {
+            'instance': self.cram.cfg['instance'],
+            'progress': self.cramio.progress_report(),
+            'queued': self.requests.qsize(),
+            'next_run': str(self.next_run) if self.next_run else None,
+            'last_run': self.state['last_run'],
+            'stopping': self.cramio.stop_process(),
+        }
+
+
+    def run_requested(self):
+        """Run queued syncs."""
+        while not self.cramio.stop_process():
+            try:
+                groups = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            self.cramio.process_groups(groups, reuse_id_map=True)
+
+
+    def missed(self, now):
+        """Latest fire time since the last run and within the catch up window."""
+        if not self.state['last_scheduled'] or not self.catch_up:
+            return None
+        since = max(datetime.fromtimestamp(self.state['last_scheduled']), now - self.catch_up)
+        return self.schedule.latest(since, now)
+
+
+    def wait_until(self, when):
+        """Sleep until `when`, running requested syncs. False if stopped first."""
+        while not self.cramio.stop_process():
+            self.run_requested()
+            remaining = (when - datetime.now()).total_seconds()
+            if remaining <= 0:
+                return True
+            self.wake.wait(min(remaining, STOP_POLL_TIME))
+            self.wake.clear()
+        return False
+
+
+    def run(self, handle_signals=True):
+        """
+        Run the groups at each fire time until stopped.
+        A host runs each scheduler in a thread and handles the signals itself.
+        """
+        if handle_signals:
+            self.install_signal_handlers()
+        if self.control is not None:
+            self.control.start()
+        try:
+            self.run_schedule()
+        finally:
+            if self.control is not None:
+                self.control.close()
+
+
+    def run_schedule(self):
+        """The scheduling loop of run()."""
+        now = datetime.now()
+        due = self.missed(now)
+        if due:
+            self.logger.log(70, 'Catching up on missed run: %s' % due)
+        else:
+            due = self.schedule.next_after(now)
+
+        while due is not None:
+            self.next_run = due
+            self.logger.info('Next run of "%s": %s (%s)' % (
+                self.cram.cfg['instance'], due, self.schedule))
+            if not self.wait_until(due):
+                return
+            self.run_once(due)
+
+            now = datetime.now()
+            following = self.schedule.next_after(due)
+            if following is not None and following <= now:
+                # Fire times passed during the run.
+                latest = self.schedule.latest(due, now)
+                if self.catch_up and now - latest <= self.catch_up:
+                    self.logger.log(70, 'Catching up on run passed while busy: %s' % latest)
+                    following = latest
+                else:
+                    following = self.schedule.next_after(now)
+            due = following
+
+        self.logger.critical('runat "%s" never fires' % self.schedule)
+
+
+    def run_once(self, scheduled):
+        """Process the groups and record the run."""
+        self.cramio.process_groups()
+        self.state['last_run'] = int(time.time())
+        self.state['last_scheduled'] = int(scheduled.timestamp())
+        save_configuration(self.state, self.state_file_path)
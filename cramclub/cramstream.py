@@ -0,0 +1,233 @@
+"""
+Incremental decoding of JSON listing responses.
+
+CiviCRM and CallHub wrap their results in an object, e.g.
+{"is_error": 0, "count": 2, "values": [{...}, {...}]} and
+{"count": 2, "next": null, "results": [{...}, {...}]}.
+JsonArrayParser is fed a response body a chunk at a time and returns
+the elements of the 'values' or 'results' array as each completes, so the
+body never exists as bytes, as text and as objects all at once, and
+processing can start before the download finishes.
+"""
+import json
+import codecs
+
+from cramjson import loads
+from cramconst import STREAM_CHUNK_SIZE
+
+# Arrays whose elements are returned one at a time.
+ARRAY_KEYS = ('values', 'results')
+
+WHITESPACE = ' \t\n\r'
+# Characters that may follow a complete value.
+VALUE_END = WHITESPACE + ',]}'
+
+
+class JsonArrayParser(object):
+    """
+    Push parser for a JSON object holding one array of results.
+    feed() and close() return the array elements completed so far;
+    the object's other members are kept in `fields`.
+    """
+    def __init__(self, keys=ARRAY_KEYS):
+        self.keys = keys
+        self.fields = {}
+        self.array_key = None # The member whose elements are returned.
+        self.decoder = json.JSONDecoder()
+        # Element keys, shared as json.loads() shares them within one document;
+        # raw_decode() forgets its own between calls.
+        self.key_cache = {}
+        self.batch_from = 0 # Buffer position up to which batches failed.
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.state = 'start'
+        self.key = None
+        self.final = False
+
+
+    def feed(self, data):
+        """Add the next chunk, bytes or str, of the body. Returns the elements it completed."""
+        if isinstance(data, bytes):
+            data = self.text_decoder.decode(data)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        self.batch_from = 0
+        return self.parse()
+
+
+    def close(self):
+        """
+        The body is complete. Returns any last elements;
+        raises ValueError if the body was cut short.
+        """
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(b'', final=True)
+        self.pos = 0
+        self.batch_from = 0
+        self.final = True
+        items = self.parse()
+        if self.state != 'done':
+            raise ValueError('Incomplete JSON response')
+        return items
+
+
+    def skip(self):
+        """Position of the next non-whitespace character, None at the end of the buffer."""
+        pos = self.pos
+        while pos < len(self.buffer):
+            if self.buffer[pos] not in WHITESPACE:
+                return pos
+            pos += 1
+        self.pos = pos
+        return None
+
+
+    def decode(self, pos):
+        """
+        (value, end) of the JSON value at `pos`, or None if it may not be
+        complete yet. Only strings, objects and arrays end themselves: a number,
+        true, false or null is whole once a delimiter follows it. raw_decode()
+        reads 1 of "1.5" cut after "1." as the number 1.
+        """
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except json.JSONDecodeError:
+            if self.final:
+                raise
+            return None
+        if self.final or self.buffer[end - 1] in '"}]':
+            return value, end
+        if end >= len(self.buffer) or self.buffer[end] not in VALUE_END:
+            return None
+        return value, end
+
+
+    def decode_batch(self, pos):
+        """
+        The list of whole object elements from `pos` to the last complete one
+        in the buffer, decoded at once by cramjson, or None. One decode shares
+        keys and saves a call per element. A cut inside a string leaves it unterminated,
+        so a successful decode is a run of whole elements.
+        """
+        end = len(self.buffer)
+        while True:
+            end = self.buffer.rfind('}', max(pos, self.batch_from), end)
+            if end < 0:
+                return None
+            after = end + 1
+            while after < len(self.buffer) and self.buffer[after] in WHITESPACE:
+                after += 1
+            if after < len(self.buffer) and self.buffer[after] in ',]':
+                break
+        try:
+            batch = loads('[' + self.buffer[pos:end + 1] + ']')
+        except ValueError:
+            self.batch_from = end + 1
+            return None
+        self.pos = end + 1
+        return batch
+
+
+    def expect(self, char, pos, expected):
+        """Raise ValueError unless `char` is one of `expected`."""
+        if char not in expected:
+            raise ValueError('Expected %s at %d of JSON response, found %r' % (
+                ' or '.join(repr(c) for c in expected), pos, char))
+
+
+    def parse(self): # pylint: disable-msg=R0912
+        """Advance through the buffer, returning the array elements completed."""
+        items = []
+        while True:
+            pos = self.skip()
+            if pos is None:
+                return items
+            char = self.buffer[pos]
+            state = self.state
+
+            if state in ('start', 'colon', 'element_end', 'member_end', 'done'):
+                if state == 'start':
+                    self.expect(char, pos, '{')
+                    self.state = 'first_key'
+                elif state == 'colon':
+                    self.expect(char, pos, ':')
+                    self.state = 'value'
+                elif state == 'element_end':
+                    self.expect(char, pos, ',]')
+                    self.state = 'element' if char == ',' else 'member_end'
+                elif state == 'member_end':
+                    self.expect(char, pos, ',}')
+                    self.state = 'key' if char == ',' else 'done'
+                else:
+                    raise ValueError('Extra data at %d of JSON response' % pos)
+                self.pos = pos + 1
+
+            elif state in ('first_key', 'key'):
+                if char == '}' and state == 'first_key':
+                    self.state = 'done'
+                    self.pos = pos + 1
+                    continue
+                self.expect(char, pos, '"')
+                decoded = self.decode(pos)
+                if decoded is None:
+                    return items
+                self.key, self.pos = decoded
+                self.state = 'colon'
+
+            elif state == 'value':
+                if char == '[' and self.key in self.keys and self.array_key is None:
+                    self.array_key = self.key
+                    self.state = 'first_element'
+                    self.pos = pos + 1
+                    continue
+                decoded = self.decode(pos)
+                if decoded is None:
+                    return items
+                self.fields[self.key], self.pos = decoded
+                self.state = 'member_end'
+
+            elif state == 'first_element' and char == ']':
+                self.state = 'member_end'
+                self.pos = pos + 1
+
+            else: # 'element', 'first_element'
+                if char == '{':
+                    batch = self.decode_batch(pos)
+                    if batch is not None:
+                        items.extend(batch)
+                        self.state = 'element_end'
+                        continue
+                decoded = self.decode(pos)
+                if decoded is None:
+                    return items
+                item, self.pos = decoded
+                if isinstance(item, dict):
+                    cache = self.key_cache
+                    item = dict((cache.setdefault(key, key), value) for key, value in item.items())
+                items.append(item)
+                self.state = 'element_end'
+
+
+def iter_items(chunks, parser):
+    """Generate the array elements of a body given as an iterable of chunks."""
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+
+
+def load_listing(response, keys=ARRAY_KEYS):
+    """
+    A streamed requests response's JSON object, its results array
+    built element by element. Reads and closes the response.
+    """
+    parser = JsonArrayParser(keys)
+    try:
+        items = list(iter_items(response.iter_content(STREAM_CHUNK_SIZE), parser))
+    finally:
+        response.close()
+    listing = dict(parser.fields)
+    if parser.array_key is not None:
+        listing[parser.array_key] = items
+    return listing
@@ -1,10 +1,39 @@
 """
 Testing the various Web API behaviour.
+test_crypto() asks for a pass phrase and test_add_contact_to_callhub() uses
+the configured APIs. The rest need neither:
+    python -m pytest cramtest.py -k "not crypto and not callhub"
 """
+import os
+import asyncio
+import json
+import socket
+import time
+import tempfile
+import threading
+from types import SimpleNamespace
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('CRAMCLUB_LOG_DIR', tempfile.gettempdir())
+
 from cramlog import CramLog
-from callhub import CallHub
-from crampull import CramPull
+from callhub import CallHub, CallHubClient
+from callhub_async import AsyncCallHub
+from crampull import CramPull, CiviCRMPull, GroupTimeout
+from civicrm.civicrm import CiviCRM, CivicrmError
 from cramcrypt import CramCrypt
+from cramcache import CramIdMap, IDMAP_HEADER
+from cramdiff import contact_digest, phonebook_diff
+from cramfields import CONTACT_IDS, contact_id
+from cramstream import JsonArrayParser, iter_items
+from cramio import CramIo
+from cramsched import CronEntry
+from cramctl import CramControl, control_request, has_unix_sockets
+from cramrate import TokenBucket, AdaptiveLimit, RequestScheduler
+from cramconst import APP_NAME, CIVICRM_RETRIES
+import crammock
+from crammock import PlainCrypter
 
 
 def test_crypto():
@@ -56,3 +85,914 @@ def test_add_contact_to_callhub():
     result2 = club.update_contact(ch_contact1['pk_str'], ch_contact)
     if result2:
         logger.debug('test_add_contact_to_callhub() updated contact')
+
+
+def offline_club(**callhub_cfg):
+    """A CallHubClient for an unreachable CallHub, with change detection on."""
+    callhub_cfg.setdefault('url', 'http://127.0.0.1:9/v1')
+    callhub_cfg.setdefault('api_key', 'test')
+    return CallHubClient(PlainCrypter(), SimpleNamespace(cfg={
+        'callhub': callhub_cfg,
+        'civicrm': {'url': 'http://127.0.0.1:9/civicrm'},
+        'rocket': {'url': 'https://rocket.example.org'},
+        'change_detection': {'use': True, 'seed': False},
+        'timeout': 1,
+    }))
+
+
+def memory_id_map(directory):
+    """An empty CramIdMap with its files in `directory`."""
+    return CramIdMap(
+        csv_file_path=os.path.join(directory, 'test.csv'),
+        idmap_file_path=os.path.join(directory, 'test.idmap'),
+        sync_file_path=os.path.join(directory, 'test.sync.yaml'),
+        logger=CramLog.instance()) # pylint: disable-msg=E1102
+
+
+def crm_contact(crm_id, **fields):
+    """A CiviCRM group contact."""
+    contact = {
+        'contact_id': crm_id, 'phone': '04%08d' % int(crm_id),
+        'first_name': 'First%s' % crm_id, 'last_name': 'Last%s' % crm_id,
+    }
+    contact.update(fields)
+    return contact
+
+
+def test_restore_digests_on_group_timeout():
+    """
+    A changed contact found before the CiviCRM group times out part way
+    through the diff is not pushed, and keeps its previous digest.
+    """
+    club = offline_club()
+    pushed = []
+    club.update_contact = lambda ch_id, ch_contact: pushed.append(ch_id) or {'pk_str': ch_id}
+    with tempfile.TemporaryDirectory() as directory:
+        id_map = memory_id_map(directory)
+        id_map.put('1', '101', 0, 42)
+
+        def crm_contacts():
+            yield crm_contact('1', first_name='Changed')
+            raise GroupTimeout('Group 1 at offset 1000')
+
+        try:
+            club.phonebook_update('9', crm_contacts(), id_map, ch_contacts=[])
+            assert False, 'GroupTimeout expected'
+        except GroupTimeout:
+            pass
+        assert not pushed
+        assert id_map.digest('1') == 42
+
+
+def test_store_digests_once_pushed():
+    """Changed contacts get their new digest once updated, failed ones keep the old."""
+    club = offline_club()
+    club.update_contact = lambda ch_id, ch_contact: {'pk_str': ch_id} if ch_id == '101' else {}
+    club.phonebook_add_existing = lambda phonebook_id, ch_contact_ids: {'count': '2'}
+    with tempfile.TemporaryDirectory() as directory:
+        id_map = memory_id_map(directory)
+        id_map.put('1', '101', 0, 42)
+        id_map.put('2', '102', 0, 43)
+        contacts = [crm_contact('1'), crm_contact('2')]
+        club.phonebook_update('9', contacts, id_map, ch_contacts=[])
+        assert id_map.digest('1') == contact_digest(club.make_callhub_contact_from(contacts[0]))
+        assert id_map.digest('2') == 43
+
+
+def test_keep_digests_when_rebuilt():
+    """A map rebuilt by a full scan keeps the saved digests of unchanged entries."""
+    with tempfile.TemporaryDirectory() as directory:
+        saved = memory_id_map(directory)
+        saved.put('1', '101', 0, 41)
+        saved.put('2', '102', 0, 42)
+        saved.put('3', '103', 0, 43)
+        saved.save()
+        saved.close()
+
+        previous = memory_id_map(directory)
+        assert previous.load()
+        rebuilt = memory_id_map(directory)
+        rebuilt.update({'1': '101', '2': '202', '4': '104'})
+        assert rebuilt.keep_digests(previous) == 1
+        previous.close()
+        assert rebuilt.digest('1') == 41
+        assert rebuilt.digest('2') == 0 # Now a different CallHub contact.
+        assert rebuilt.digest('4') == 0
+        assert '3' not in rebuilt
+
+
+STREAM_BODIES = [
+    b'{"is_error": 0, "count": 3.0, "values": [{"id": "1", "ratio": 1.5}, '
+    b'{"id": "2", "note": "}, {\\"x\\": ]"}, {"id": "3", "tags": [1e-3, -20, true, null]}]}',
+    b'{"values": [1.5, 2e10, -0.25, false, "a,b", [], {}], "version": 3}',
+    b'{"count": 0, "next": null, "results": []}',
+    '{"results": [{"name": "J\u00f6rg \u2603"}], "count": 12}'.encode('utf-8'),
+]
+
+
+def stream_decode(chunks):
+    """(fields, elements) of a body fed in `chunks`."""
+    parser = JsonArrayParser()
+    items = list(iter_items(chunks, parser))
+    return parser.fields, items
+
+
+def test_stream_split_anywhere():
+    """A body decodes the same however it is cut into chunks."""
+    for body in STREAM_BODIES:
+        whole = json.loads(body.decode('utf-8'))
+        array_key = 'values' if 'values' in whole else 'results'
+        expected = (dict((k, v) for k, v in whole.items() if k != array_key), whole[array_key])
+        assert stream_decode([body]) == expected
+        for cut in range(1, len(body)):
+            assert stream_decode([body[:cut], body[cut:]]) == expected, (body, cut)
+        assert stream_decode([body[i:i+1] for i in range(len(body))]) == expected
+
+
+def test_stream_numbers_cut_short():
+    """A number cut after its point or exponent is not taken as complete."""
+    assert stream_decode([b'{"values": [1.', b'5], "count": 1}']) == ({'count': 1}, [1.5])
+    assert stream_decode([b'{"count": 3.', b'0, "values": []}']) == ({'count': 3.0}, [])
+    assert stream_decode([b'{"values": [2e', b'3]}']) == ({}, [2000.0])
+    assert stream_decode([b'{"values": [tr', b'ue]}']) == ({}, [True])
+
+
+def test_stream_incomplete():
+    """A body cut short or followed by more is an error."""
+    for chunks in ([b'{"values": [1, 2'], [b'{"values": [1.'], [b'{"count": 1} 2']):
+        try:
+            stream_decode(chunks)
+        except ValueError:
+            continue
+        assert False, chunks
+
+
+def test_scan_for_unusable_id_map():
+    """A corrupt id map snapshot is rebuilt by a full CallHub scan."""
+    with tempfile.TemporaryDirectory() as directory:
+        saved = memory_id_map(directory)
+        with open(saved.idmap_file_path, 'wb') as stream:
+            stream.write(b'CRAMIDMP' + b'\xff' * 40)
+        io = SimpleNamespace(
+            logger=CramLog.instance(), # pylint: disable-msg=E1102
+            cram=SimpleNamespace(cfg={
+                'csv_cache': {'use': True, 'refresh': True},
+                'csv_file_path': saved.csv_file_path,
+                'idmap_file_path': saved.idmap_file_path,
+                'sync_file_path': saved.sync_file_path,
+            }),
+            refreshed=False)
+        io.scan_contact_ids = lambda: io.crm_ch_id_map.update({'1': '101', '2': '102'})
+        io.refresh_contact_ids = lambda: setattr(io, 'refreshed', True)
+        assert CramIo.get_contact_ids_map(io)
+        assert not io.refreshed
+        io.crm_ch_id_map.close()
+
+        rebuilt = memory_id_map(directory)
+        assert rebuilt.load()
+        assert dict(rebuilt.items()) == {'1': '101', '2': '102'}
+        rebuilt.close()
+
+
+def test_cron_next_after():
+    """Schedule entries fire at the first matching minute after a time."""
+    friday = datetime(2024, 3, 1, 17, 50, 30)
+    assert CronEntry('17:50').next_after(friday) == datetime(2024, 3, 2, 17, 50)
+    assert CronEntry('9:05').next_after(friday) == datetime(2024, 3, 2, 9, 5)
+    assert CronEntry('*/15 9-17 * * 1-5').next_after(friday) == datetime(2024, 3, 4, 9, 0)
+    assert CronEntry('*/15 9-17 * * 1-5').next_after(datetime(2024, 3, 4, 9, 0)) == \
+        datetime(2024, 3, 4, 9, 15)
+    # Sunday is 0 or 7.
+    assert CronEntry('30 6 * * 7').next_after(friday) == datetime(2024, 3, 3, 6, 30)
+    # Both day fields restricted: either will do.
+    assert CronEntry('0 12 1 * 0').next_after(friday) == datetime(2024, 3, 3, 12, 0)
+    assert CronEntry('0 12 15 * 3').next_after(friday) == datetime(2024, 3, 6, 12, 0)
+    # Across months and years.
+    assert CronEntry('0 0 1 1 *').next_after(friday) == datetime(2025, 1, 1, 0, 0)
+    assert CronEntry('0 0 29 2 *').next_after(datetime(2025, 3, 1)) == datetime(2028, 2, 29)
+    assert CronEntry('0 0 31 2 *').next_after(friday) is None
+
+
+def test_cron_bad_entries():
+    """Entries that are neither HH:MM nor cron expressions are refused."""
+    for text in ('25:00', '9', '* * * *', '60 * * * *', '0 0 0 * *', 'a b c d e'):
+        try:
+            CronEntry(text)
+        except ValueError:
+            continue
+        assert False, text
+
+
+def saved_id_map(directory, count):
+    """Save a snapshot of `count` entries, crm_id n => ch_id 1000 + n, digest n."""
+    id_map = memory_id_map(directory)
+    for crm in range(count, 0, -1):
+        id_map.put(str(crm), str(1000 + crm), 0, crm)
+    id_map.save()
+    id_map.close()
+    return id_map
+
+
+def test_id_map_snapshot():
+    """A saved id map loads mapped in place, with the CSV journal applied over it."""
+    with tempfile.TemporaryDirectory() as directory:
+        saved_id_map(directory, 500)
+        id_map = memory_id_map(directory)
+        assert id_map.load()
+        assert id_map.mapping is not None
+        assert len(id_map) == 500
+        assert id_map['1'] == '1001' and id_map.get('500') == '1500'
+        assert id_map.digest('250') == 250
+        assert '501' not in id_map and 'x' not in id_map
+
+        id_map.write_back = True
+        id_map.record('600', '1600', 6)
+        id_map.record('7', '1700', 7)
+        id_map.close()
+
+        journalled = memory_id_map(directory)
+        assert journalled.load()
+        # The journal waits in the overlay for save(), over the mapped snapshot.
+        assert journalled.mapping is not None and len(journalled.overlay) == 2
+        assert len(journalled) == 501
+        assert journalled['7'] == '1700' and journalled.digest('600') == 6
+        journalled.save()
+        journalled.close()
+        assert os.path.getsize(journalled.csv_file_path) == 0
+
+        reloaded = memory_id_map(directory)
+        assert reloaded.load()
+        assert reloaded['7'] == '1700' and reloaded['600'] == '1600'
+        reloaded.close()
+
+
+def test_id_map_unusable_snapshot():
+    """A snapshot cut short, altered or of another version is not loaded."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = saved_id_map(directory, 100).idmap_file_path
+        with open(path, 'rb') as stream:
+            good = stream.read()
+        version = IDMAP_HEADER.unpack(good[:IDMAP_HEADER.size])[1]
+        altered = bytearray(good)
+        altered[IDMAP_HEADER.size + 8 * 150] ^= 1
+        for bad in (good[:-8], good[:20], bytes(altered),
+                    good[:8] + (version + 1).to_bytes(2, 'little') + good[10:]):
+            with open(path, 'wb') as stream:
+                stream.write(bad)
+            id_map = memory_id_map(directory)
+            assert not id_map.load()
+            assert len(id_map) == 0
+
+
+def test_id_map_compaction():
+    """Entries added over mapped columns are merged in crm_id order."""
+    with tempfile.TemporaryDirectory() as directory:
+        saved_id_map(directory, 10)
+        id_map = memory_id_map(directory)
+        assert id_map.load()
+        id_map.put('5', '2005', 0)       # Another CallHub contact: digest reset.
+        id_map.put('6', '1006', 0)       # Same contact: digest kept.
+        id_map.put('20', '1020', 0, 20)
+        id_map.put('0', '1000', 0, 1)
+        assert len(id_map) == 12
+        assert id_map.digest('5') == 0 and id_map.digest('6') == 6
+        id_map.compact()
+        assert id_map.mapping is None and not id_map.overlay
+        assert list(id_map.columns[0]) == [0] + list(range(1, 11)) + [20]
+        assert dict(id_map.items())['5'] == '2005'
+        assert id_map.digest('6') == 6 and id_map.digest('20') == 20
+        id_map.close()
+
+
+def test_id_map_from_csv():
+    """A CSV cache with no snapshot beside it is imported whole, less malformed rows."""
+    with tempfile.TemporaryDirectory() as directory:
+        id_map = memory_id_map(directory)
+        with open(id_map.csv_file_path, 'w') as csvfile:
+            csvfile.write('1,101\n2,102,1700000000\n1,111,1700000001,9\nx,y\n'
+                          '3,103,17x\n4,104,,4\n5,105,1700000002,9x\n')
+        assert id_map.load()
+        assert dict(id_map.items()) == {'1': '111', '2': '102', '4': '104'}
+        assert id_map.digest('1') == 9 and id_map.digest('4') == 4
+
+
+def book_contact(ch_id, crm_id, number):
+    """A CallHub phonebook contact."""
+    return {'pk_str': ch_id, 'contact': number,
+            'custom_fields': "{u'2184': u'%s'}" % crm_id}
+
+
+def test_phonebook_diff():
+    """A group is reconciled with its phonebook in one pass over each."""
+    book = [
+        book_contact('101', '1', '61400000001'),
+        book_contact('102', '2', '61400000002'),
+        book_contact('199', '9', '61400000009'),
+    ]
+    group = [
+        crm_contact('1'),
+        crm_contact('2'),
+        crm_contact('3'), # Mapped, not in the phonebook.
+        crm_contact('4'), # Not in CallHub.
+        crm_contact('5', phone='0400 000 001'), # Shares 1's number.
+        crm_contact('6'), # Shares 3's CallHub contact.
+        crm_contact('7', phone=''),
+    ]
+    id_map = {'1': '101', '2': '102', '3': '103', '6': '103', '9': '199'}
+    diff = phonebook_diff(
+        (contact for contact in group), iter(book), id_map,
+        changed=lambda contact, ch_id: contact['contact_id'] == '2')
+    assert diff.add == ['103']
+    assert diff.remove == {'199'}
+    assert diff.keep == {'101', '102'}
+    assert [contact['contact_id'] for contact in diff.create] == ['4', '7']
+    assert diff.numbers == {'61400000001', '61400000002'}
+    assert diff.duplicates == 1 and group[4]['duplicate']
+    assert [(ch_id, contact['contact_id']) for ch_id, contact in diff.update] == [('102', '2')]
+
+
+def test_phonebook_diff_empty():
+    """An empty group empties its phonebook; an empty phonebook gets the whole group."""
+    book = [book_contact('101', '1', '61400000001')]
+    diff = phonebook_diff([], book, {'1': '101'})
+    assert diff.remove == {'101'} and not diff.add and not diff.create and not diff.update
+    diff = phonebook_diff([crm_contact('1'), crm_contact('2')], [], {'1': '101'})
+    assert diff.add == ['101'] and not diff.remove
+    assert [contact['contact_id'] for contact in diff.create] == ['2']
+
+
+def test_token_bucket():
+    """Bursts are allowed up to the bucket size, then requests wait for the rate."""
+    assert all(TokenBucket(0, 1).take() == 0 for _ in range(100))
+    bucket = TokenBucket(10, 3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert 0 < bucket.take() <= 0.1
+    bucket.updated -= 10 # Refills, but only to the burst size.
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() > 0
+
+
+def test_adaptive_limit():
+    """The limit grows with successes, halves when throttled and stays in bounds."""
+    limit = AdaptiveLimit(2, 4)
+    assert limit.try_acquire() and limit.try_acquire()
+    assert not limit.try_acquire()
+    limit.release(throttled=False)
+    limit.release(throttled=False)
+    assert limit.limit == 3 # Two successes in a row at a limit of 2.
+    for _ in range(20):
+        limit.acquire()
+        limit.release(throttled=False)
+    assert limit.limit == 4
+    limit.acquire()
+    limit.release(throttled=True)
+    assert limit.limit == 2
+    for _ in range(3):
+        limit.acquire()
+        limit.release(throttled=True)
+    assert limit.limit == 1 and limit.in_flight == 0
+    assert AdaptiveLimit(10, 0).limit == 1
+
+
+def test_adaptive_limit_waits():
+    """acquire() blocks while the limit is reached until a request is released."""
+    limit = AdaptiveLimit(1, 1)
+    limit.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limit.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    limit.release(throttled=False)
+    assert acquired.wait(5)
+    waiter.join()
+    assert limit.in_flight == 1
+
+
+class ScriptedSession(object):
+    """Stands in for a requests session, answering with the given status codes."""
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.requests = 0
+
+
+    def request(self, method, url, **kwargs): # pylint: disable-msg=W0613
+        self.requests += 1
+        return SimpleNamespace(
+            status_code=self.status_codes.pop(0),
+            headers={'Retry-After': '0'}, close=lambda: None)
+
+
+def test_scheduler_retries_throttled():
+    """A 429 is retried after pausing every request, and halves the limit."""
+    session = ScriptedSession(429, 200)
+    scheduler = RequestScheduler(
+        session, CramLog.instance(), concurrency=4, max_concurrency=4, # pylint: disable-msg=E1102
+        attempts=3, backoff=0.01)
+    assert scheduler.request('get', 'http://127.0.0.1:9/').status_code == 200
+    assert session.requests == 2
+    assert scheduler.limit.limit == 2 and scheduler.limit.in_flight == 0
+    assert scheduler.paused_until > 0
+
+    # The last attempt's response is returned, whatever it is.
+    scheduler.session = session = ScriptedSession(503, 500, 200)
+    scheduler.attempts = 2
+    assert scheduler.request('get', 'http://127.0.0.1:9/').status_code == 500
+    assert session.requests == 2
+
+
+def test_deletes_survive_connection_errors():
+    """Deletes that run out of attempts are logged and reported, not raised."""
+    club = offline_club(attempts=1, http={'retries': 0})
+    assert club.delete_contact('1') is None
+    assert club.phonebook_clear('9', ['1'])['count'] == -1
+
+    async def deletes():
+        async with AsyncCallHub(club) as aclub:
+            assert await aclub.delete_contact('1') is None
+            return await aclub.phonebook_clear('9', ['1'])
+    assert asyncio.run(deletes())['count'] == -1
+
+
+def test_run_clears_contact_ids():
+    """The ContactIDs cached during a run are dropped when it ends, however it ends."""
+    for ready in (True, False):
+        assert contact_id(book_contact('101', '1', '61400000001')) == '1'
+        io = SimpleNamespace(
+            metrics=SimpleNamespace(reset=lambda: None),
+            progress={}, id_map_ready=ready, crm_ch_id_map=SimpleNamespace(write_back=False),
+            pool=None, parallel_groups=1, pipeline=False, logger=CramLog.instance(), # pylint: disable-msg=E1102
+            load_id_map=lambda reuse: None,
+            process_group_unless_stopped=lambda group: True,
+            log_http_stats=lambda: None, write_metrics=lambda: None)
+        io.progress_update = io.progress.update
+        io.run_finished = lambda: CramIo.run_finished(io)
+        CramIo.run_groups(io, [{'crm': '1', 'ch': '2'}], False)
+        assert len(CONTACT_IDS) == 0
+        assert not io.progress['running']
+
+
+def test_pipelined_groups():
+    """Each group is fetched while the one before it is pushed, until stopped."""
+    expected = {
+        3: ['fetch 101', 'fetch 102', 'push 101', 'fetch 103', 'push 102', 'push 103'],
+        1: ['fetch 101', 'push 101'],
+    }
+    for stop_after, order in expected.items():
+        events = []
+        io = SimpleNamespace(
+            progress={'done': 0}, progress_lock=threading.Lock(), logger=CramLog.instance(), # pylint: disable-msg=E1102
+            stop_process=lambda: len([e for e in events if 'fetch' in e]) >= stop_after,
+            fetch_group=lambda pool, crm, ch: events.append('fetch ' + ch) or (None, None),
+            push_group=lambda crm, ch, crm_future, ch_future: events.append('push ' + ch))
+        io.progress_update = io.progress.update
+        io.run_group = lambda *args: CramIo.run_group(io, *args)
+        io.group_done = lambda: CramIo.group_done(io)
+        CramIo.process_groups_pipelined(io, [{'crm': str(n), 'ch': '10%d' % n} for n in (1, 2, 3)])
+        assert events == order
+        assert io.progress['done'] == stop_after and io.progress['group'] == order[-1][5:]
+
+
+def test_change_detection_needs_saved_id_map():
+    """Digests held only in memory would have every contact updated each run."""
+    for write_back in (True, False):
+        io = SimpleNamespace(
+            id_map_ready=True, id_map_loaded=time.time(), id_map_reuse=3600,
+            crm_ch_id_map=SimpleNamespace(write_back=write_back),
+            club=SimpleNamespace(change_detection=True),
+            logger=CramLog.instance()) # pylint: disable-msg=E1102
+        io.lead = io
+        CramIo.load_id_map(io, True)
+        assert io.club.change_detection == write_back
+
+
+def listing_club(crm_ids, page_size=5):
+    """
+    An offline club listing contacts with ContactIDs `crm_ids`, CallHub id
+    1000 + ContactID, `page_size` a page. Pages retrieved are kept in `pages`.
+    """
+    club = offline_club()
+    club.pages = []
+
+    def get_page(page_url):
+        page = int(page_url.rsplit('=', 1)[1])
+        club.pages.append(page)
+        start = (page - 1) * page_size
+        return {
+            'count': len(crm_ids),
+            'next': page_url if start + page_size < len(crm_ids) else None,
+            'results': [book_contact(str(1000 + crm), crm, '614%08d' % crm)
+                        for crm in crm_ids[start:start + page_size]],
+        }
+    club.get_page = get_page
+    return club
+
+
+def test_contacts_refresh():
+    """A refresh finds added contacts, even when as many were removed."""
+    before = list(range(1, 24))
+    known = dict((str(crm), str(1000 + crm)) for crm in before)
+    for now, rescan in (
+            (before, False), # Unchanged: the first and last pages.
+            (before + list(range(24, 34)), False), # Added at the end.
+            (list(range(40, 50)) + before, False), # Added at the start.
+            (list(range(40, 43)) + before[:10] + before[13:], False), # Within the first page.
+            (list(range(40, 46)) + before[:8] + before[14:], True),
+            (before[:4] + before[7:] + [50, 51, 52], True),
+            (before[:-2] + [50, 51], False)): # Both within the last page.
+        club = listing_club(now)
+        found = {}
+        assert club.contacts_refresh(found, len(before), known) == len(now)
+        assert set(known) | set(found) >= set(str(crm) for crm in now), now
+        page_count = (len(now) + 4) // 5
+        assert (sorted(club.pages) == list(range(1, page_count + 1))) == rescan, (now, club.pages)
+
+
+def test_shared_club_settings():
+    """An instance sharing a CallHub account pushes contacts built from its own settings."""
+    lead = offline_club()
+    follower = lead.share(SimpleNamespace(cfg={
+        'civicrm': {'url': 'http://127.0.0.1:9/other'},
+        'rocket': {'url': 'https://rocket.example.com'},
+        'change_detection': {'use': False},
+    }), metrics=SimpleNamespace())
+    assert follower.session is lead.session and follower.scheduler is lead.scheduler
+    assert not follower.change_detection and lead.change_detection
+    assert follower.change_seed and not lead.change_seed
+    contact = crm_contact('7')
+    assert follower.make_callhub_contact_from(contact)['company_website'] == \
+        'https://rocket.example.com/7'
+    assert lead.make_callhub_contact_from(contact)['company_website'] == \
+        'https://rocket.example.org/7'
+    assert lead.metrics is not follower.metrics
+
+
+MOCK_SERVERS = []
+
+
+def mock_port(**dataset):
+    """
+    Port of the mock CallHub and CiviCRM APIs, served from this process,
+    loaded with a fresh dataset. See crammock.MockState.load().
+    """
+    if not MOCK_SERVERS:
+        MOCK_SERVERS.append(crammock.serve_in_thread())
+    port = MOCK_SERVERS[0].server_address[1]
+    crammock.load(port, **dataset)
+    return port
+
+
+def mock_club(port, **callhub_cfg):
+    """A CallHubClient of the mock CallHub."""
+    return offline_club(url='http://127.0.0.1:%d/v1' % port, **callhub_cfg)
+
+
+def test_found_contacts_have_no_digest():
+    """A contact CallHub finds by its number, rather than creates, is not taken as pushed."""
+    port = mock_port(size=10, groups=1)
+    club = mock_club(port)
+    new = crm_contact(str(crammock.CRM_ID_BASE + 10))
+    found = crm_contact(str(crammock.CRM_ID_BASE + 2), phone='0400000002')
+    created = club.create_contacts([new, found])
+    assert created[new['contact_id']][1] and not created[found['contact_id']][1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        id_map = memory_id_map(directory)
+        diff = SimpleNamespace(add=[], numbers=set())
+        added = club.record_created(diff, [new, found], created, id_map)
+        assert added == [created[new['contact_id']][0]['pk_str'],
+                         created[found['contact_id']][0]['pk_str']]
+        assert id_map.digest(new['contact_id']) == \
+            contact_digest(club.make_callhub_contact_from(new))
+        assert id_map[found['contact_id']] == str(crammock.CH_ID_BASE + 2)
+        assert id_map.digest(found['contact_id']) == 0
+
+
+def mock_pull(port, **civicrm_cfg):
+    """A CiviCRMPull of the mock CiviCRM. Connection errors are not retried by its session."""
+    civicrm_cfg.update(url='http://127.0.0.1:%d/civicrm' % port, use_ssl=False,
+                       site_key='test', api_key='test')
+    return CiviCRMPull(PlainCrypter(), cram=SimpleNamespace(cfg={
+        'civicrm': civicrm_cfg,
+        'rocket': {'url': 'https://rocket.example.org'},
+        'http': {'retries': 0},
+        'timeout': 5,
+    }))
+
+
+def test_civicrm_payloads():
+    """Chained calls and nested values go in the json parameter, batches as api3.call."""
+    api = CiviCRM('http://127.0.0.1:9/civicrm', 'site', 'key', use_ssl=False)
+    payload = api._construct_payload('get', 'get', 'Contact', { # pylint: disable-msg=W0212
+        'id': {'IN': ['1', '2']}, 'api.CustomValue.get': {}, 'return': 'id'})
+    assert json.loads(payload['json']) == {'id': {'IN': ['1', '2']}, 'api.CustomValue.get': {}}
+    assert payload['return'] == 'id' and 'id' not in payload
+
+    payload = api._batch_payload({'one': ('Contact', 'get', {'id': 1})}) # pylint: disable-msg=W0212
+    assert (payload['entity'], payload['action']) == ('api3', 'call')
+    assert json.loads(payload['json']) == {'one': ['Contact', 'get', {'id': 1, 'sequential': 1}]}
+
+    assert api.chained({'id': '1'}, 'CustomValue') == []
+    try:
+        api.chained({'api.CustomValue.get': {'is_error': 1, 'error_message': 'No'}}, 'CustomValue')
+        assert False, 'CivicrmError expected'
+    except CivicrmError:
+        pass
+
+
+def test_civicrm_batch():
+    """Contacts by id with their custom values, and batched calls, from the mock CiviCRM."""
+    port = mock_port(size=10, groups=2)
+    pull = mock_pull(port)
+    crm_ids = [str(crammock.CRM_ID_BASE + index) for index in (1, 3)]
+    contacts = pull.contacts(crm_ids)
+    assert [contact['id'] for contact in contacts] == crm_ids
+    assert all(contact['custom'] == {'1': 'Sydney'} and 'api.CustomValue.get' not in contact
+               for contact in contacts)
+
+    results = pull._api.batch({ # pylint: disable-msg=W0212
+        'contact': ('Contact', 'get', {'id': crm_ids[0]}),
+        'members': ('Contact', 'getcount', {'group': ['1']}),
+    })
+    assert sorted(results) == ['contact', 'members']
+    assert [contact['id'] for contact in results['contact']] == crm_ids[:1]
+    assert results['members'] == 5
+
+    try:
+        pull._api.batch({ # pylint: disable-msg=W0212
+            'contact': ('Contact', 'get', {'id': crm_ids[0]}),
+            'group': ('Group', 'get', {}),
+        })
+        assert False, 'CivicrmError expected'
+    except CivicrmError as err:
+        assert 'Not implemented' in str(err)
+
+
+def test_async_listings():
+    """The asyncio client's pages, streamed, match the synchronous client's."""
+    port = mock_port(size=300, groups=2, page_size=40)
+    for concurrency in (1, 4):
+        club = mock_club(port, concurrency=concurrency)
+        phonebook_id = str(crammock.PHONEBOOK_ID_BASE + 1)
+
+        async def listings():
+            async with AsyncCallHub(club) as aclub:
+                return await aclub.contacts(), await aclub.phonebook_get_contacts(phonebook_id)
+        contacts, phonebook = asyncio.run(listings())
+        assert len(contacts) == 240 + 15 # With the stale phonebook entries.
+        assert contacts == club.contacts()
+        assert sorted(c['pk_str'] for c in phonebook) == \
+            sorted(c['pk_str'] for c in club.phonebook_get_contacts(phonebook_id))
+
+
+def test_concurrent_contacts_scan():
+    """A concurrent contacts scan fetches each page once and finds what a serial one does."""
+    dataset = dict(size=500, groups=2, page_size=20, callhub_latency=0.01)
+    port = mock_port(**dataset)
+    serial = mock_club(port).contacts()
+    assert len(serial) == 400 + 25 # With the stale phonebook entries.
+    assert crammock.MockHandler.state.peak == 1
+
+    port = mock_port(**dataset)
+    assert mock_club(port, concurrency=4).contacts() == serial
+    assert crammock.stats(port) == {'CallHub GET /v1/contacts': 22}
+    assert 1 < crammock.MockHandler.state.peak <= 4
+
+
+def test_bounded_create_pool():
+    """Contacts are created one POST each, no more in flight than max_concurrency."""
+    port = mock_port(size=10, groups=1, callhub_latency=0.01)
+    club = mock_club(port, concurrency=2, max_concurrency=3)
+    crm_contacts = [crm_contact(str(crammock.CRM_ID_BASE + 100 + n)) for n in range(12)]
+    created = club.create_contacts(crm_contacts)
+    assert sorted(created) == sorted(contact['contact_id'] for contact in crm_contacts)
+    assert all(was_created for _, was_created in created.values())
+    assert len(set(contact['pk_str'] for contact, _ in created.values())) == 12
+    assert crammock.stats(port) == {'CallHub POST /v1/contacts/': 12}
+    assert 1 < crammock.MockHandler.state.peak <= 3
+
+
+def test_group_page_retries():
+    """A dropped CiviCRM group page is retried on its own, until the group times out."""
+    port = mock_port(size=60, groups=2, civicrm_drops=[2, 3])
+    pull = mock_pull(port, page_size=10)
+    pages = list(pull.group_pages('1'))
+    assert [contact['id'] for page in pages for contact in page] == \
+        [str(crammock.CRM_ID_BASE + index) for index in range(0, 60, 2)]
+    # Three full pages, an empty fourth, and the second page twice more.
+    assert crammock.stats(port) == {'CiviCRM GET': 6}
+
+    crammock.load(port, size=60, groups=2, civicrm_drops=list(range(2, 2 + CIVICRM_RETRIES)))
+    pages = pull.group_pages('1')
+    assert len(next(pages)) == 10
+    try:
+        next(pages)
+        assert False, 'GroupTimeout expected'
+    except GroupTimeout as err:
+        assert 'offset 10' in str(err)
+
+
+def mock_groups(*groups):
+    """Configured groups: CiviCRM group n to the mock's phonebook for it."""
+    return [{'crm': str(group), 'ch': str(crammock.PHONEBOOK_ID_BASE + group)} for group in groups]
+
+
+def mock_cramio(port, directory, lead=None, pool=None, **cfg):
+    """
+    A CramIo, configured as a hosted instance is, of the mock APIs.
+    Its files are in `directory`, named as memory_id_map()'s for instance 'test'.
+    """
+    settings = {
+        'instance': 'test',
+        'civicrm': {'url': 'http://127.0.0.1:%d/civicrm' % port, 'use_ssl': False,
+                    'site_key': 'test', 'api_key': 'test'},
+        'callhub': {'url': 'http://127.0.0.1:%d/v1' % port, 'api_key': 'test'},
+        'rocket': {'url': 'https://rocket.example.org'},
+        'timeout': 5,
+        'csv_cache': {'create': True},
+        'change_detection': {'use': True},
+    }
+    settings.update(cfg)
+    for name in ('csv', 'idmap', 'sync.yaml', 'stop', 'state', 'control', 'metrics.jsonl', 'prom'):
+        settings['%s_file_path' % name.split('.')[0]] = os.path.join(
+            directory, '%s.%s' % (settings['instance'], name))
+    return CramIo(PlainCrypter(), cram=SimpleNamespace(cfg=settings), lead=lead, pool=pool)
+
+
+def assert_phonebooks_synced(groups, id_map):
+    """Each group's phonebook holds the CallHub contacts of its CiviCRM contacts."""
+    state = crammock.MockHandler.state
+    for group in groups:
+        assert set(state.phonebooks[group['ch']]) == \
+            set(id_map[contact['id']] for contact in state.crm_groups[group['crm']])
+
+
+def test_parallel_groups():
+    """Groups processed at once share the id map, and each phonebook ends up in step."""
+    port = mock_port(size=300, groups=3, page_size=25)
+    groups = mock_groups(1, 2, 3)
+    with tempfile.TemporaryDirectory() as directory:
+        io = mock_cramio(port, directory, groups=groups, parallel_groups=3)
+        io.process_groups()
+        assert io.progress['done'] == 3
+        assert_phonebooks_synced(groups, io.crm_ch_id_map)
+        # Every CiviCRM contact with no CallHub contact, once.
+        assert crammock.stats(port)['CallHub POST /v1/contacts/'] == 60
+
+        # The contacts created by each group were all recorded in the saved id map.
+        saved = memory_id_map(directory)
+        assert saved.load()
+        assert dict(saved.items()) == dict(io.crm_ch_id_map.items())
+        assert all(contact['id'] in saved for contact in crammock.MockHandler.state.crm_contacts)
+        saved.close()
+        io.crm_ch_id_map.close()
+
+
+def test_run_metrics_output():
+    """Each run appends a JSON summary and replaces the Prometheus file, counting every request."""
+    port = mock_port(size=200, groups=2, page_size=25)
+    groups = mock_groups(1, 2)
+    with tempfile.TemporaryDirectory() as directory:
+        io = mock_cramio(port, directory, groups=groups,
+                         metrics={'json': True, 'prometheus': True})
+        io.process_groups()
+        io.process_groups()
+        io.crm_ch_id_map.close()
+        cfg = io.cram.cfg
+        with open(cfg['metrics_file_path']) as stream:
+            runs = [json.loads(line) for line in stream]
+        with open(cfg['prom_file_path']) as stream:
+            prom = stream.read().splitlines()
+
+    assert len(runs) == 2
+    summary = runs[-1]
+    assert summary['instance'] == 'test' and summary['contacts'] == 200
+    assert set(['id_map', 'civicrm_pull', 'phonebook_fetch']) <= set(summary['phases'])
+    # The two runs' requests add up to those the mock answered.
+    requests = sum(crammock.stats(port).values())
+    first = sum(stats['count'] for stats in runs[0]['http'].values())
+    assert first + sum(stats['count'] for stats in summary['http'].values()) == requests
+
+    samples = dict(line.rsplit(' ', 1) for line in prom if not line.startswith('#'))
+    inst = 'instance_name="test"'
+    assert samples['%s_contacts_processed{%s}' % (APP_NAME, inst)] == '200'
+    for endpoint, stats in summary['http'].items():
+        labels = '%s,endpoint="%s"' % (inst, endpoint)
+        assert samples['%s_http_request_seconds_count{%s}' % (APP_NAME, labels)] == \
+            str(stats['count'])
+        assert samples['%s_http_request_seconds_bucket{%s,le="+Inf"}' % (APP_NAME, labels)] == \
+            str(stats['count'])
+
+
+def test_control_socket():
+    """The control socket answers each request line with a reply line."""
+    with tempfile.TemporaryDirectory() as directory:
+        cfg = {'control_file_path': os.path.join(directory, 'test.control')}
+        stopped = threading.Event()
+        scheduler = SimpleNamespace(
+            cramio=SimpleNamespace(cram=SimpleNamespace(cfg=cfg)),
+            logger=CramLog.instance(), # pylint: disable-msg=E1102
+            request_sync=lambda group=None: None if group == '9' else 1,
+            status=lambda: {'instance': 'test', 'queued': 1},
+            stop=stopped.set)
+        assert control_request(cfg, {'cmd': 'status'}) is None
+        control = CramControl(scheduler)
+        assert control.start()
+        try:
+            # Another updater of the instance will not start.
+            assert not CramControl(scheduler).start()
+            assert control_request(cfg, {'cmd': 'sync'}) == {'ok': True, 'queued': 1}
+            assert control_request(cfg, {'cmd': 'sync', 'group': '9'}) == \
+                {'ok': False, 'error': 'unknown group "9"'}
+            assert control_request(cfg, {'cmd': 'status'}) == \
+                {'ok': True, 'instance': 'test', 'queued': 1}
+            assert control_request(cfg, {'cmd': 'restart'}) == \
+                {'ok': False, 'error': 'unknown command "restart"'}
+
+            if has_unix_sockets():
+                # Several requests on one connection, not all of them usable.
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection: # pylint: disable-msg=E1101
+                    connection.settimeout(5)
+                    connection.connect(cfg['control_file_path'])
+                    connection.sendall(b'[1]\nnot json\n{"cmd": "stop"}\n')
+                    with connection.makefile('rb') as stream:
+                        replies = [json.loads(stream.readline()) for _ in range(3)]
+                assert [reply['ok'] for reply in replies] == [False, False, True]
+                assert replies[0]['error'] == 'request must be a JSON object'
+                assert stopped.is_set()
+        finally:
+            control.close()
+        assert not os.path.exists(cfg['control_file_path'])
+        assert control_request(cfg, {'cmd': 'status'}) is None
+
+        # Over TCP each request carries the control file's token.
+        control.token = 'secret'
+        assert control.dispatch({'cmd': 'status'}) == {'ok': False, 'error': 'bad token'}
+        assert control.dispatch({'cmd': 'status', 'token': 'secret'})['ok']
+
+
+def test_host_account_sharing():
+    """Hosted instances on one CallHub account share its session and id map, not their settings."""
+    port = mock_port(size=200, groups=2, page_size=25)
+    with tempfile.TemporaryDirectory() as lead_dir, \
+            tempfile.TemporaryDirectory() as other_dir, \
+            ThreadPoolExecutor(max_workers=2) as pool:
+        lead = mock_cramio(port, lead_dir, pool=pool, groups=mock_groups(1))
+        other = mock_cramio(port, other_dir, lead=lead, pool=pool, instance='other',
+                            groups=mock_groups(2), rocket={'url': 'https://other.example.org'})
+        other.id_map_reuse = 3600
+        assert other.club.session is lead.club.session
+        assert other.club.scheduler is lead.club.scheduler
+        assert other.club.rocket_url == 'https://other.example.org'
+
+        lead.process_groups()
+        scans = crammock.stats(port)['CallHub GET /v1/contacts']
+        other.process_groups()
+        # The lead's scan was reused.
+        assert crammock.stats(port)['CallHub GET /v1/contacts'] == scans
+        assert other.crm_ch_id_map is lead.crm_ch_id_map
+        assert_phonebooks_synced(mock_groups(1, 2), lead.crm_ch_id_map)
+
+        # Each instance's requests are counted in its own run's metrics.
+        assert 'GET /v1/contacts' in lead.metrics.http
+        assert 'GET /v1/contacts' not in other.metrics.http
+        assert any(endpoint.startswith('GET /v1/phonebooks/') for endpoint in other.metrics.http)
+        lead.crm_ch_id_map.close()
+
+
+def test_async_run_matches_sync():
+    """A run driven by the asyncio clients makes the same requests and changes as a synchronous one."""
+    requests = {}
+    for use_async in (False, True):
+        port = mock_port(size=200, groups=2, page_size=25)
+        groups = mock_groups(1, 2)
+        with tempfile.TemporaryDirectory() as directory:
+            io = mock_cramio(port, directory, groups=groups, callhub={
+                'url': 'http://127.0.0.1:%d/v1' % port, 'api_key': 'test',
+                'concurrency': 4, 'async': use_async})
+            assert io.use_async == use_async
+            io.process_groups()
+            assert io.progress['done'] == 2
+            assert_phonebooks_synced(groups, io.crm_ch_id_map)
+            io.crm_ch_id_map.close()
+        requests[use_async] = crammock.stats(port)
+    assert requests[True] == requests[False]
+
+
+def test_async_group_pull():
+    """The asyncio CiviCRM client pulls a group whole, in order, a window of pages at a time."""
+    crm_ids = [str(crammock.CRM_ID_BASE + index) for index in range(95)]
+    for windows in (1, 3):
+        # The second page is dropped once, and retried on its own.
+        port = mock_port(size=95, groups=1, civicrm_drops=[2])
+        pull = mock_pull(port, page_size=10, windows=windows)
+
+        async def pulled():
+            async with pull.async_api() as api:
+                return await pull.group_async(api, '1')
+        assert [contact['id'] for contact in asyncio.run(pulled())] == crm_ids
+        assert crammock.stats(port) == {'CiviCRM GET': (12 if windows == 3 else 10) + 1}
+
+    # Every request dropped: aiohttp may itself retry one on a kept alive connection.
+    crammock.load(port, size=95, groups=1, civicrm_drops=list(range(1, 4 * CIVICRM_RETRIES)))
+    pull = mock_pull(port, page_size=10)
+    assert asyncio.run(pulled()) is None